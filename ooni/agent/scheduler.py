@@ -1,26 +1,27 @@
 import os
 import errno
+import heapq
 import random
+import itertools
 
 from hashlib import md5
 from datetime import datetime, timedelta
 
 from twisted.application import service
 from twisted.internet import defer, reactor
-from twisted.internet.task import LoopingCall
 from twisted.python.filepath import FilePath
 
 from ooni.scripts import oonireport
 from ooni import resources
 from ooni.utils import log, SHORT_DATE
-from ooni.utils.files import human_size_to_bytes, directory_usage
+from ooni.utils.files import human_size_to_bytes
 from ooni.deck.store import input_store, deck_store, DEFAULT_DECKS
 from ooni.settings import config
 from ooni.contrib import croniter
 from ooni.contrib.dateutil.tz import tz
 
 from ooni.geoip import probe_ip
-from ooni.measurements import list_measurements
+from ooni.measurements import list_measurements, measurement_catalogue
 
 class FileSystemlockAndMutex(object):
     """
@@ -70,7 +71,8 @@ class ScheduledTask(object):
     """
     Two ScheduledTask instances with same identifier are not permited to run
     concurrently.  There should be no ScheduledTask queue waiting for the lock
-    as SchedulerService ticks quite often.
+    as SchedulerService only runs a task once it's due and does not run it
+    again before it has finished.
     """
     _time_format = "%Y-%m-%dT%H:%M:%SZ"
     schedule = None
@@ -109,12 +111,20 @@ class ScheduledTask(object):
         self._last_run_lock.release()
 
     @property
-    def should_run(self):
-        current_time = datetime.utcnow().replace(tzinfo=tz.tzutc())
+    def next_run(self):
+        """
+        The time at which the task should run next. To spread the load, it's
+        delayed from the time set by the schedule by up to 10% of the
+        schedule period.
+        """
         next_cycle = croniter(self.schedule, self.last_run).get_next(datetime)
         delta = (croniter(self.schedule, next_cycle).get_next(datetime) - next_cycle).total_seconds()
-        next_cycle = next_cycle + timedelta(seconds=delta * 0.1 * self._smear_coef)
-        if next_cycle <= current_time:
+        return next_cycle + timedelta(seconds=delta * 0.1 * self._smear_coef)
+
+    @property
+    def should_run(self):
+        current_time = datetime.utcnow().replace(tzinfo=tz.tzutc())
+        if self.next_run <= current_time:
             return True
         return False
 
@@ -199,10 +209,14 @@ class UploadReports(ScheduledTask):
     """
     identifier = 'upload-reports'
     schedule = '@hourly'
+    # How many reports to upload at the same time, if None it's read from
+    # the upload_max_parallel option of ooniprobe.conf
+    maxParallel = None
 
     @defer.inlineCallbacks
     def task(self):
-        yield oonireport.upload_all(upload_incomplete=True)
+        yield oonireport.upload_all(upload_incomplete=True,
+                                    max_parallel=self.maxParallel)
 
 
 class DeleteOldReports(ScheduledTask):
@@ -223,6 +237,7 @@ class DeleteOldReports(ScheduledTask):
             if delta.days >= 7:
                 log.debug("Deleting old report {0}".format(measurement["id"]))
                 measurement_path.child(measurement['id']).remove()
+                measurement_catalogue.remove(measurement['id'])
 
 
 class CheckMeasurementQuota(ScheduledTask):
@@ -238,7 +253,8 @@ class CheckMeasurementQuota(ScheduledTask):
         if config.basic.measurement_quota is None:
             return
         maximum_bytes = human_size_to_bytes(config.basic.measurement_quota)
-        used_bytes = directory_usage(config.measurements_directory)
+        measurements = list_measurements(compute_size=True)
+        used_bytes = sum(measurement['size'] for measurement in measurements)
         warning_path = os.path.join(config.running_path, 'quota_warning')
 
         if (float(used_bytes) / float(maximum_bytes)) >= self._warn_when:
@@ -265,7 +281,7 @@ class CheckMeasurementQuota(ScheduledTask):
         kept_measurements = []
         stale_measurements = []
         remaining_measurements = []
-        measurements_by_date = sorted(list_measurements(compute_size=True),
+        measurements_by_date = sorted(measurements,
                                       key=lambda k: k['test_start_time'])
         for measurement in measurements_by_date:
             if measurement['keep'] is True:
@@ -283,6 +299,7 @@ class CheckMeasurementQuota(ScheduledTask):
             measurement = ordered_measurements.pop(0)
             log.warn("Deleting report {0}".format(measurement["id"]))
             measurement_path.child(measurement['id']).remove()
+            measurement_catalogue.remove(measurement['id'])
             amount_deleted += measurement['size']
 
 
@@ -372,24 +389,74 @@ def run_system_tasks(no_input_store=False):
 class SchedulerService(service.MultiService):
     """
     This service is responsible for running the periodic tasks.
+
+    The time at which every task should run next is computed when it's
+    scheduled and again every time it has run and the tasks are kept in a
+    queue ordered by it. The service only wakes up when the first task of
+    the queue is due.
     """
+    # We wake up at least this often, in case the system clock is changed.
+    maxSleep = 60 * 60
+
     def __init__(self, director, interval=30, _reactor=reactor):
+        """
+        Args:
+            interval: how many seconds to wait before running again a task
+                that is still due after running, because it failed or could
+                not run.
+        """
         service.MultiService.__init__(self)
         self.director = director
         self.interval = interval
 
-        self._looping_call = LoopingCall(self._should_run)
-        self._looping_call.clock = _reactor
+        self._reactor = _reactor
+        self._call = None
+        self._running_tasks = False
+        self._counter = itertools.count()
 
         self._scheduled_tasks = []
+        # A heap of (next_run, counter, task)
+        self._queue = []
+
+    def _now(self):
+        return datetime.utcnow().replace(tzinfo=tz.tzutc())
+
+    def _enqueue(self, task, next_run=None):
+        if next_run is None:
+            next_run = task.next_run
+        heapq.heappush(self._queue, (next_run, next(self._counter), task))
+        self._wake_up_later()
+
+    def _cancel_call(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _wake_up_later(self):
+        """
+        Sets the call that wakes up the service when the first task of the
+        queue is due.
+        """
+        if self._running_tasks or not self.running:
+            return
+        self._cancel_call()
+        if not self._queue:
+            return
+        delay = (self._queue[0][0] - self._now()).total_seconds()
+        delay = min(max(delay, 0), self.maxSleep)
+        self._call = self._reactor.callLater(delay, self._should_run)
 
     def schedule(self, task):
         self._scheduled_tasks.append(task)
+        self._enqueue(task)
 
     def unschedule(self, task):
         # We first cancel the task so the run lock is deleted
         task.cancel()
         self._scheduled_tasks.remove(task)
+        self._queue = [entry for entry in self._queue if entry[2] is not task]
+        heapq.heapify(self._queue)
+        self._wake_up_later()
 
     def refresh_deck_list(self):
         """
@@ -452,26 +519,43 @@ class SchedulerService(service.MultiService):
         """
         log.debug("Ran {0}".format(task.identifier))
 
+    def _task_done(self, _, task):
+        """
+        Fired when a task is done running, to put it back in the queue.
+        """
+        if task not in self._scheduled_tasks:
+            # The task has been unscheduled while it was running
+            return
+        next_run = task.next_run
+        if next_run <= self._now():
+            # The task failed or could not run, we try again later
+            next_run = self._now() + timedelta(seconds=self.interval)
+        self._enqueue(task, next_run)
+
     def _should_run(self):
         """
-        This function is called every self.interval seconds to check
-        which periodic tasks should be run.
-
-        Note: the task will wait on the lock if there is already a task of
-        that type running. This means that if a task is very long running
-        there can potentially be a pretty large backlog of accumulated
-        periodic tasks waiting to know if they should run.
-        XXX
-        We may want to do something like not wait on the lock if there is
-        already a queue that is larger than a certain amount or something
-        smarter if still starts to become a memory usage concern.
+        This function is called when the first task of the queue is due and
+        runs all the tasks that are due.
+
+        A task is taken off the queue while it's running and put back, with
+        the time at which it should run next, once it's done.
         """
-        for task in self._scheduled_tasks:
-            log.debug("Running task {0}".format(task.identifier))
-            d = task.run()
-            d.addErrback(self._task_did_not_run, task)
-            d.addCallback(self._task_success, task)
-            d.addErrback(self._task_failed, task)
+        self._cancel_call()
+        self._running_tasks = True
+        try:
+            # Running a task may schedule new ones that are due already,
+            # these are run as well.
+            while self._queue and self._queue[0][0] <= self._now():
+                _, _, task = heapq.heappop(self._queue)
+                log.debug("Running task {0}".format(task.identifier))
+                d = task.run()
+                d.addErrback(self._task_did_not_run, task)
+                d.addCallback(self._task_success, task)
+                d.addErrback(self._task_failed, task)
+                d.addCallback(self._task_done, task)
+        finally:
+            self._running_tasks = False
+        self._wake_up_later()
 
     def startService(self):
         service.MultiService.startService(self)
@@ -483,8 +567,8 @@ class SchedulerService(service.MultiService):
         self.schedule(CheckMeasurementQuota())
         self.schedule(RefreshDeckList(self))
 
-        self._looping_call.start(self.interval)
+        self._should_run()
 
     def stopService(self):
         service.MultiService.stopService(self)
-        self._looping_call.stop()
+        self._cancel_call()
@@ -14,15 +14,17 @@ _twisted_14_0_2_version = Version('twisted', 14, 0, 2)
 
 from ooni import errors as e, constants
 from ooni.settings import config
-from ooni.utils import log, onion
+from ooni.utils import log
 from ooni.utils.net import BodyReceiver, StringProducer, Downloader
-from ooni.utils.socks import TrueHeadersSOCKS5Agent
+from ooni.common.txextra import HTTPConnectionPool
 
 
 def guess_backend_type(address):
     if address is None:
         raise e.InvalidAddress
-    if onion.is_onion_address(address):
+    # txtorcon is slow to import and is not needed unless Tor is used.
+    from ooni.utils.onion import is_onion_address
+    if is_onion_address(address):
         return 'onion'
     elif address.startswith('https://'):
         return 'https'
@@ -32,6 +34,14 @@ def guess_backend_type(address):
         raise e.InvalidAddress
 
 class OONIBClient(object):
+    # The connections to the backends are kept open and shared by all the
+    # clients, with a connection pool for every type of backend.
+    # maxPersistentPerHost idle connections are kept open towards every
+    # backend for up to cachedConnectionTimeout seconds.
+    _pools = {}
+    maxPersistentPerHost = 2
+    cachedConnectionTimeout = 60
+
     def __init__(self, address=None, settings={}):
         self.base_headers = {}
         self.backend_type = settings.get('type', None)
@@ -52,7 +62,8 @@ class OONIBClient(object):
     def _setupBaseAddress(self):
         parsed_address = urlparse(self.base_address)
         if self.backend_type == 'onion':
-            if not onion.is_onion_address(self.base_address):
+            from ooni.utils.onion import is_onion_address
+            if not is_onion_address(self.base_address):
                 log.err("Invalid onion address.")
                 raise e.InvalidAddress(self.base_address)
             if parsed_address.scheme in ('http', 'httpo'):
@@ -90,14 +101,60 @@ class OONIBClient(object):
     def isReachable(self):
         raise NotImplemented
 
+    @property
+    def pool(self):
+        try:
+            return OONIBClient._pools[self.backend_type]
+        except KeyError:
+            max_persistent_per_host = self.maxPersistentPerHost
+            if config.advanced.get('backend_connections_per_host',
+                                   None) is not None:
+                max_persistent_per_host = \
+                    config.advanced.backend_connections_per_host
+            cached_connection_timeout = self.cachedConnectionTimeout
+            if config.advanced.get('backend_idle_timeout', None) is not None:
+                cached_connection_timeout = config.advanced.backend_idle_timeout
+            pool = HTTPConnectionPool(
+                reactor, persistent=True,
+                maxPersistentPerHost=max_persistent_per_host,
+                cachedConnectionTimeout=cached_connection_timeout
+            )
+            OONIBClient._pools[self.backend_type] = pool
+            return pool
+
+    @classmethod
+    def getPoolStats(cls):
+        """
+        Returns, for every type of backend, how many requests have been sent
+        over a connection that was already open (hits), how many required
+        a new connection (misses) and how many connections are open.
+        """
+        return dict((backend_type, pool.getStats())
+                    for backend_type, pool in OONIBClient._pools.items())
+
+    @classmethod
+    def closeConnections(cls):
+        """
+        Closes the idle connections to the backends and forgets about the
+        connection pools.
+        """
+        # The pools are shared by all the subclasses, so they are always
+        # looked up on OONIBClient.
+        pools = OONIBClient._pools.values()
+        OONIBClient._pools.clear()
+        return defer.gatherResults([pool.closeCachedConnections()
+                                    for pool in pools])
+
     def _request(self, method, urn, genReceiver, bodyProducer=None, retries=3):
         if self.backend_type == 'onion':
+            from ooni.utils.socks import TrueHeadersSOCKS5Agent
             agent = TrueHeadersSOCKS5Agent(reactor,
                                            proxyEndpoint=TCP4ClientEndpoint(reactor,
                                                                             '127.0.0.1',
-                                                                            config.tor.socks_port))
+                                                                            config.tor.socks_port),
+                                           pool=self.pool)
         else:
-            agent = Agent(reactor)
+            agent = Agent(reactor, pool=self.pool)
 
         attempts = 0
 
@@ -133,12 +190,18 @@ class OONIBClient(object):
 
         return finished
 
-    def queryBackend(self, method, urn, query=None, retries=3):
+    def queryBackend(self, method, urn, query=None, retries=3, body=None):
+        """
+        Sends query, JSON encoded, to the backend. If the request body is
+        already JSON encoded it can be passed as body instead.
+        """
         log.debug("Querying backend {0}{1} with {2}".format(self.base_address,
-                                                         urn, query))
+                                                         urn, query or body))
         bodyProducer = None
         if query:
-            bodyProducer = StringProducer(json.dumps(query))
+            body = json.dumps(query)
+        if body:
+            bodyProducer = StringProducer(body)
 
         def genReceiver(finished, content_length):
             def process_response(s):
@@ -240,6 +303,15 @@ class CollectorClient(OONIBClient):
         return self.queryBackend('POST', '/report', query=request)
 
     def updateReport(self, report_id, serialization_format, entry_content):
+        """
+        The content of a json entry can either be a dict or a string holding
+        its JSON encoding, which is sent as it is.
+        """
+        if serialization_format == 'json' and isinstance(entry_content, str):
+            return self.queryBackend(
+                'POST', '/report/%s' % report_id,
+                body='{"format": "json", "content": %s}' % entry_content
+            )
         request = {
             'format': serialization_format,
             'content': entry_content
@@ -247,11 +319,155 @@ class CollectorClient(OONIBClient):
         return self.queryBackend('POST', '/report/%s' % report_id,
                                  query=request)
 
+    def updateReportBatch(self, report_id, serialization_format,
+                          entries_content):
+        if (serialization_format == 'json' and
+                all(isinstance(c, str) for c in entries_content)):
+            return self.queryBackend(
+                'POST', '/report/%s/batch' % report_id,
+                body='{"format": "json", "content": [%s]}' % (
+                    ', '.join(entries_content))
+            )
+        request = {
+            'format': serialization_format,
+            'content': entries_content
+        }
+        return self.queryBackend('POST', '/report/%s/batch' % report_id,
+                                 query=request)
 
     def closeReport(self, report_id):
         return self.queryBackend('POST', '/report/' + report_id + '/close')
 
+class ControlBatcher(object):
+    """
+    Groups the control requests issued by concurrent measurements towards the
+    same web_connectivity test helper into a single request to /batch.
+
+    A batch is sent once it holds batchSize requests or batchLinger seconds
+    after its first request has been queued, whichever comes first. If the
+    test helper does not advertise supports_batch in its status, every
+    control request is sent on its own.
+
+    Every measurement has at most one control request in flight, so a batch
+    is never larger than the number of concurrent measurements.
+    """
+    batchSize = 20
+    batchLinger = 0.5
+
+    def __init__(self):
+        if config.advanced.get('control_batch_size', None) is not None:
+            self.batchSize = config.advanced.control_batch_size
+        if config.advanced.get('measurement_concurrency', None):
+            self.batchSize = min(self.batchSize,
+                                 config.advanced.measurement_concurrency)
+        if config.advanced.get('control_batch_linger', None) is not None:
+            self.batchLinger = config.advanced.control_batch_linger
+
+        self._supportsBatch = None
+        self._batch = []
+        self._batchTimer = None
+
+    def supportsBatch(self, client):
+        """
+        Returns a deferred firing with True if the test helper accepts
+        batched control requests. The status of the test helper is only
+        looked up once.
+        """
+        if self.batchSize <= 1:
+            return defer.succeed(False)
+        supports_batch_d = self._supportsBatch
+        if supports_batch_d is None:
+            supports_batch_d = client.queryBackend('GET', '/status')
+            self._supportsBatch = supports_batch_d
+
+            @supports_batch_d.addCallback
+            def cb(status):
+                return (status or {}).get('supports_batch', False) is True
+
+            @supports_batch_d.addErrback
+            def eb(failure):
+                log.debug("Failed to lookup the status of the test helper")
+                # The status is looked up again by the next control request,
+                # so that a transient failure does not disable batching.
+                if self._supportsBatch is supports_batch_d:
+                    self._supportsBatch = None
+                return False
+
+        d = defer.Deferred()
+
+        @supports_batch_d.addCallback
+        def fire(supports_batch):
+            d.callback(supports_batch)
+            return supports_batch
+
+        return d
+
+    @defer.inlineCallbacks
+    def control(self, client, request):
+        supports_batch = yield self.supportsBatch(client)
+        if not supports_batch:
+            response = yield client.queryBackend('POST', '/', query=request)
+            defer.returnValue(response)
+
+        d = defer.Deferred()
+        self._batch.append((client, request, d))
+        if len(self._batch) >= self.batchSize:
+            self.flush()
+        elif self._batchTimer is None:
+            self._batchTimer = reactor.callLater(self.batchLinger, self.flush)
+        response = yield d
+        defer.returnValue(response)
+
+    def flush(self):
+        """
+        Sends the queued control requests to the test helper and fires the
+        deferred of every request with its own response.
+        """
+        if self._batchTimer is not None:
+            if self._batchTimer.active():
+                self._batchTimer.cancel()
+            self._batchTimer = None
+
+        batch, self._batch = self._batch, []
+        if not batch:
+            return defer.succeed(None)
+
+        client = batch[0][0]
+        log.debug("Sending %d control requests to %s" % (len(batch),
+                                                         client.base_address))
+        d = client.queryBackend('POST', '/batch', query={
+            'requests': [request for _, request, _ in batch]
+        })
+
+        @d.addCallback
+        def cb(result):
+            responses = result.get('responses', [])
+            if len(responses) != len(batch):
+                raise e.get_error(None)
+            for response, (_, _, request_d) in zip(responses, batch):
+                try:
+                    if 'error' in response:
+                        raise e.get_error(response['error'])
+                except Exception:
+                    request_d.errback()
+                else:
+                    request_d.callback(response)
+
+        @d.addErrback
+        def eb(failure):
+            log.err("Failed to perform a batch of control requests")
+            for _, _, request_d in batch:
+                if not request_d.called:
+                    request_d.errback(failure)
+
+        return d
+
+
 class WebConnectivityClient(OONIBClient):
+    # The control requests of all the clients talking to the same test
+    # helper are batched together.
+    _batchers = {}
+
     def isReachable(self):
         d = self.queryBackend('GET', '/status')
 
@@ -267,6 +483,16 @@ class WebConnectivityClient(OONIBClient):
 
         return d
 
+    @property
+    def batcher(self):
+        key = (self.backend_type, self.base_address, self.front)
+        try:
+            return self._batchers[key]
+        except KeyError:
+            batcher = ControlBatcher()
+            self._batchers[key] = batcher
+            return batcher
+
     def control(self, http_request, tcp_connect,
                 http_request_headers=None,
                 include_http_responses=False):
@@ -278,7 +504,7 @@ class WebConnectivityClient(OONIBClient):
             'http_request_headers': http_request_headers,
             'include_http_responses': include_http_responses
         }
-        return self.queryBackend('POST', '/', query=request)
+        return self.batcher.control(self, request)
 
 
 def get_preferred_bouncer():
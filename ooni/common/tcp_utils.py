@@ -1,5 +1,9 @@
+from twisted.internet import reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.internet.protocol import Factory, Protocol
 
+from ooni.utils.ratelimit import destination_limiter, destination_keys
+
 class TCPConnectProtocol(Protocol):
     def connectionMade(self):
         self.transport.loseConnection()
@@ -8,3 +12,13 @@ class TCPConnectFactory(Factory):
     noisy = False
     def buildProtocol(self, addr):
         return TCPConnectProtocol()
+
+def tcp_connect(address, port, timeout=30):
+    """
+    Connects to address:port and closes the connection as soon as it is
+    established. The connection attempt is subject to the per destination
+    limits of destination_limiter.
+    """
+    point = TCP4ClientEndpoint(reactor, address, port, timeout=timeout)
+    return destination_limiter.run(destination_keys(address),
+                                   point.connect, TCPConnectFactory())
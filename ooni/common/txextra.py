@@ -121,6 +121,19 @@ class HTTPClientParser(_newclient.HTTPClientParser):
             raise
 
 class HTTP11ClientProtocol(_newclient.HTTP11ClientProtocol):
+    # This is set by the HTTPConnectionPool that created us so that it can
+    # keep track of how many sockets are currently open.
+    pool = None
+
+    def connectionMade(self):
+        if self.pool is not None:
+            self.pool.openConnections += 1
+
+    def connectionLost(self, reason):
+        if self.pool is not None:
+            self.pool.openConnections -= 1
+        return _newclient.HTTP11ClientProtocol.connectionLost(self, reason)
+
     def request(self, request):
         if self._state != 'QUIESCENT':
             return fail(RequestNotSent())
@@ -158,18 +171,68 @@ class HTTP11ClientProtocol(_newclient.HTTP11ClientProtocol):
 
 class _HTTP11ClientFactory(client._HTTP11ClientFactory):
     noisy = False
+    pool = None
 
     def buildProtocol(self, addr):
-        return HTTP11ClientProtocol(self._quiescentCallback)
+        protocol = HTTP11ClientProtocol(self._quiescentCallback)
+        protocol.pool = self.pool
+        return protocol
 
 
 class HTTPConnectionPool(client.HTTPConnectionPool):
+    """
+    A HTTPConnectionPool that uses our TrueHeaders aware protocol and keeps
+    track of how effective the connection reuse is.
+
+    Every request that is served by a cached persistent connection counts as
+    a hit, while every request that requires a new connection to be
+    established counts as a miss.
+    """
     _factory = _HTTP11ClientFactory
 
+    def __init__(self, reactor, persistent=True, maxPersistentPerHost=None,
+                 cachedConnectionTimeout=None):
+        client.HTTPConnectionPool.__init__(self, reactor, persistent)
+        if maxPersistentPerHost is not None:
+            self.maxPersistentPerHost = maxPersistentPerHost
+        if cachedConnectionTimeout is not None:
+            self.cachedConnectionTimeout = cachedConnectionTimeout
+
+        self.requests = 0
+        self.misses = 0
+        self.openConnections = 0
+
+    @property
+    def hits(self):
+        return self.requests - self.misses
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return client.HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.misses += 1
+        def quiescentCallback(protocol):
+            self._putConnection(key, protocol)
+        factory = self._factory(quiescentCallback)
+        factory.pool = self
+        return endpoint.connect(factory)
+
+    def getStats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'open': self.openConnections
+        }
+
+
 class TrueHeadersAgent(client.Agent):
     def __init__(self, *args, **kw):
+        pool = kw.pop('pool', None)
         super(TrueHeadersAgent, self).__init__(*args, **kw)
-        self._pool = HTTPConnectionPool(reactor, False)
+        if pool is None:
+            pool = HTTPConnectionPool(reactor, False)
+        self._pool = pool
 
 class FixedRedirectAgent(BrowserLikeRedirectAgent):
     """
@@ -1,8 +1,13 @@
-from twisted.internet import defer
+import os
+import json
+import time
+
+from twisted.internet import defer, reactor
 
 from ooni import errors as e
 from ooni.backend_client import guess_backend_type, WebConnectivityClient, \
     CollectorClient
+from ooni.settings import config
 from ooni.utils import log
 
 
@@ -41,33 +46,98 @@ def sort_addresses_by_priority(priority_address,
     return prioritised_addresses
 
 
+def race_reachable(clients, stagger=None, _reactor=reactor):
+    """
+    Checks the reachability of the backend clients, that are sorted by
+    priority, concurrently and returns a deferred firing with the first one
+    that is reachable or None if none of them is.
+
+    Every client is checked stagger seconds after the previous one, or as
+    soon as the previous one has been found to be unreachable, so that the
+    clients with a higher priority get a head start without an unreachable
+    one delaying the others by a full timeout.
+    """
+    if stagger is None:
+        stagger = config.advanced.get('backend_race_stagger', None)
+        if stagger is None:
+            stagger = 1
+    result = defer.Deferred()
+    state = {'started': 0, 'failed': 0, 'call': None}
+
+    def cancel_call():
+        if state['call'] is not None and state['call'].active():
+            state['call'].cancel()
+        state['call'] = None
+
+    def start_next():
+        cancel_call()
+        if result.called or state['started'] >= len(clients):
+            return
+        client = clients[state['started']]
+        state['started'] += 1
+        d = defer.maybeDeferred(client.isReachable)
+        d.addErrback(lambda failure: False)
+        d.addCallback(checked, client)
+        # When the check fires synchronously the race may already be settled,
+        # or checked may have started the next client itself.
+        if result.called or state['call'] is not None:
+            return
+        if state['started'] < len(clients):
+            state['call'] = _reactor.callLater(stagger, start_next)
+
+    def checked(reachable, client):
+        if result.called:
+            return
+        if reachable:
+            cancel_call()
+            result.callback(client)
+            return
+        log.err("Unreachable %s backend %s" % (client.settings['type'],
+                                               client.settings['address']))
+        state['failed'] += 1
+        if state['failed'] == len(clients):
+            cancel_call()
+            result.callback(None)
+        elif state['failed'] == state['started']:
+            # All the clients that have been started are unreachable, there
+            # is no point in waiting for the next one.
+            start_next()
+
+    if len(clients) == 0:
+        return defer.succeed(None)
+    start_next()
+    return result
+
+
+def _supported_clients(client_class, addresses, description):
+    clients = []
+    for settings in addresses:
+        client = client_class(settings=settings)
+        if not client.isSupported():
+            log.err("Unsupported %s %s %s" % (settings['type'], description,
+                                              settings['address']))
+            continue
+        clients.append(client)
+    return clients
+
+
 @defer.inlineCallbacks
 def get_reachable_test_helper(test_helper_name, test_helper_address,
                               test_helper_alternate, preferred_backend):
     # For the moment we look for alternate addresses only of
     # web_connectivity test helpers.
     if test_helper_name == 'web-connectivity':
-        for web_connectivity_settings in sort_addresses_by_priority(
-                test_helper_address, test_helper_alternate,
-                preferred_backend):
-            web_connectivity_test_helper = WebConnectivityClient(
-                settings=web_connectivity_settings)
-            if not web_connectivity_test_helper.isSupported():
-                log.err("Unsupported %s web_connectivity test_helper "
-                        "%s" % (
-                        web_connectivity_settings['type'],
-                        web_connectivity_settings['address']
-                ))
-                continue
-            reachable = yield web_connectivity_test_helper.isReachable()
-            if not reachable:
-                log.err("Unreachable %s web_connectivity test helper %s" % (
-                    web_connectivity_settings['type'],
-                    web_connectivity_settings['address']
-                ))
-                continue
-            defer.returnValue(web_connectivity_settings)
-        raise e.NoReachableTestHelpers
+        clients = _supported_clients(
+            WebConnectivityClient,
+            sort_addresses_by_priority(test_helper_address,
+                                       test_helper_alternate,
+                                       preferred_backend),
+            "web_connectivity test helper"
+        )
+        web_connectivity_test_helper = yield race_reachable(clients)
+        if web_connectivity_test_helper is None:
+            raise e.NoReachableTestHelpers
+        defer.returnValue(web_connectivity_test_helper.settings)
     else:
         defer.returnValue(test_helper_address.encode('ascii'))
 
@@ -75,52 +145,173 @@ def get_reachable_test_helper(test_helper_name, test_helper_address,
 @defer.inlineCallbacks
 def get_reachable_collector(collector_address, collector_alternate,
                             preferred_backend):
-    for collector_settings in sort_addresses_by_priority(
-            collector_address,
-            collector_alternate,
-            preferred_backend):
-        collector = CollectorClient(settings=collector_settings)
-        if not collector.isSupported():
-            log.err("Unsupported %s collector %s" % (
-                        collector_settings['type'],
-                        collector_settings['address']))
-            continue
-        reachable = yield collector.isReachable()
-        if not reachable:
-            log.err("Unreachable %s collector %s" % (
-                        collector_settings['type'],
-                        collector_settings['address']))
-            continue
-        defer.returnValue(collector)
+    clients = _supported_clients(
+        CollectorClient,
+        sort_addresses_by_priority(collector_address,
+                                   collector_alternate,
+                                   preferred_backend),
+        "collector"
+    )
+    collector = yield race_reachable(clients)
+    if collector is None:
+        raise e.NoReachableCollectors
+    defer.returnValue(collector)
 
-    raise e.NoReachableCollectors
 
-
-@defer.inlineCallbacks
 def get_reachable_test_helpers_and_collectors(net_tests, preferred_backend):
+    """
+    Looks up, concurrently, a reachable collector and reachable test helpers
+    for every net test. The same collector or test helper is looked up only
+    once, even if it's used by more than one net test.
+    """
+    lookups = {}
+
+    def lookup(key, f, *args):
+        if key not in lookups:
+            lookups[key] = f(*args)
+        d = defer.Deferred()
+
+        def fire(result):
+            d.callback(result)
+            return result
+        lookups[key].addBoth(fire)
+        return d
+
+    def set_collector(collector, net_test):
+        net_test['collector'] = collector
+
+    def set_test_helper(test_helper, net_test, test_helper_name):
+        net_test['test-helpers'][test_helper_name] = test_helper
+
+    dl = []
     for net_test in net_tests:
         primary_address = net_test['collector']
         alternate_addresses = net_test.get('collector-alternate', [])
-        net_test['collector'] = yield get_reachable_collector(
-            primary_address, alternate_addresses, preferred_backend)
+        key = json.dumps(['collector', primary_address, alternate_addresses])
+        d = lookup(key, get_reachable_collector, primary_address,
+                   alternate_addresses, preferred_backend)
+        d.addCallback(set_collector, net_test)
+        dl.append(d)
 
         for test_helper_name, test_helper_address in net_test['test-helpers'].items():
-             test_helper_alternate = \
-                 net_test.get('test-helpers-alternate', {}).get(test_helper_name, [])
-             net_test['test-helpers'][test_helper_name] = \
-                        yield get_reachable_test_helper(test_helper_name,
-                                                        test_helper_address,
-                                                        test_helper_alternate,
-                                                        preferred_backend)
+            test_helper_alternate = \
+                net_test.get('test-helpers-alternate', {}).get(test_helper_name, [])
+            key = json.dumps(['test-helper', test_helper_name,
+                              test_helper_address, test_helper_alternate])
+            d = lookup(key, get_reachable_test_helper, test_helper_name,
+                       test_helper_address, test_helper_alternate,
+                       preferred_backend)
+            d.addCallback(set_test_helper, net_test, test_helper_name)
+            dl.append(d)
+
+    # Every failure has been passed on to the net tests waiting for it.
+    for shared in lookups.values():
+        shared.addErrback(lambda failure: None)
+
+    d = defer.gatherResults(dl, consumeErrors=True)
+    d.addErrback(lambda failure: failure.value.subFailure)
+    d.addCallback(lambda _: net_tests)
+    return d
+
+
+class BackendLookupCache(object):
+    """
+    Caches on disk the collectors and test helpers that have been found to
+    be reachable by lookup_collector_and_test_helpers, by bouncer,
+    preferred backend and requested net tests, for ttl seconds.
+
+    If it's not set, ttl is read from the backend_cache_ttl option of
+    ooniprobe.conf.
+    """
+    ttl = 60 * 60
+
+    def __init__(self, path=None, ttl=None, _time=time.time):
+        self._path = path
+        self._ttl = ttl
+        self._time = _time
+
+    @property
+    def path(self):
+        if self._path is not None:
+            return self._path
+        return os.path.join(config.running_path, 'backend_cache.json')
 
-    defer.returnValue(net_tests)
+    def _getTTL(self):
+        if self._ttl is not None:
+            return self._ttl
+        ttl = config.advanced.get('backend_cache_ttl', None)
+        if ttl is not None:
+            return ttl
+        return self.ttl
+
+    @staticmethod
+    def key(bouncer_address, preferred_backend, net_tests):
+        return json.dumps([bouncer_address, preferred_backend, net_tests],
+                          sort_keys=True)
+
+    def _load(self):
+        try:
+            with open(self.path) as in_file:
+                return json.load(in_file)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """
+        Returns the net tests, with their collector and test helpers, that
+        were cached with key or None if they are missing or expired.
+        """
+        entry = self._load().get(key, None)
+        if entry is None:
+            return None
+        if self._time() - entry['time'] > self._getTTL():
+            return None
+        net_tests = []
+        for net_test in entry['net-tests']:
+            net_test = dict(net_test)
+            net_test['collector'] = CollectorClient(
+                settings=net_test['collector'])
+            net_tests.append(net_test)
+        return net_tests
+
+    def set(self, key, net_tests):
+        now = self._time()
+        entries = dict((k, v) for k, v in self._load().items()
+                       if now - v['time'] <= self._getTTL())
+        cached_net_tests = []
+        for net_test in net_tests:
+            net_test = dict(net_test)
+            net_test['collector'] = net_test['collector'].settings
+            cached_net_tests.append(net_test)
+        entries[key] = {'time': now, 'net-tests': cached_net_tests}
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out_file:
+            json.dump(entries, out_file)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+backend_cache = BackendLookupCache()
 
 
 @defer.inlineCallbacks
 def lookup_collector_and_test_helpers(net_test_loaders,
                                       bouncer,
                                       preferred_backend,
-                                      no_collector=False):
+                                      no_collector=False,
+                                      use_cache=False):
+    """
+    Looks up with the bouncer the collector and the test helpers required
+    by the net test loaders and sets them.
+
+    What is found is cached (see BackendLookupCache) and if use_cache is
+    True the bouncer is only queried if there is nothing in the cache.
+    """
     required_nettests = []
 
     requires_test_helpers = False
@@ -146,17 +337,31 @@ def lookup_collector_and_test_helpers(net_test_loaders,
     if not requires_test_helpers and not requires_collector:
         defer.returnValue(None)
 
-    print("Using bouncer %s" % bouncer)
-    response = yield bouncer.lookupTestCollector(required_nettests)
-    try:
-        provided_net_tests = yield get_reachable_test_helpers_and_collectors(
-            response['net-tests'], preferred_backend)
-    except e.NoReachableCollectors:
-        log.err("Could not find any reachable collector")
-        raise
-    except e.NoReachableTestHelpers:
-        log.err("Could not find any reachable test helpers")
-        raise
+    cache_key = backend_cache.key(bouncer.base_address, preferred_backend,
+                                  required_nettests)
+    provided_net_tests = None
+    if use_cache:
+        provided_net_tests = backend_cache.get(cache_key)
+        if provided_net_tests is not None:
+            log.msg("Using the cached collector and test helpers")
+
+    if provided_net_tests is None:
+        print("Using bouncer %s" % bouncer)
+        response = yield bouncer.lookupTestCollector(required_nettests)
+        try:
+            provided_net_tests = yield get_reachable_test_helpers_and_collectors(
+                response['net-tests'], preferred_backend)
+        except e.NoReachableCollectors:
+            log.err("Could not find any reachable collector")
+            raise
+        except e.NoReachableTestHelpers:
+            log.err("Could not find any reachable test helpers")
+            raise
+        try:
+            backend_cache.set(cache_key, provided_net_tests)
+        except (IOError, OSError) as exc:
+            log.err("Failed to cache the collector and test helpers")
+            log.exception(exc)
 
     def find_collector_and_test_helpers(test_name, test_version):
         # input_files = [u""+x['hash'] for x in input_files]
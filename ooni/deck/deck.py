@@ -7,7 +7,10 @@ from copy import deepcopy
 from string import Template
 
 import yaml
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
+from twisted.python import failure
 from twisted.python.filepath import FilePath
 
 from ooni import errors as e
@@ -17,7 +20,7 @@ from ooni.deck.backend import lookup_collector_and_test_helpers
 from ooni.deck.legacy import convert_legacy_deck
 from ooni.geoip import probe_ip
 from ooni.nettest import NetTestLoader, nettest_to_path
-from ooni.measurements import generate_summary
+from ooni.measurements import generate_summary, measurement_catalogue
 from ooni.settings import config
 from ooni.utils import log, generate_filename
 
@@ -71,6 +74,10 @@ class MissingTaskDataKey(Exception):
 
 
 class NGDeck(object):
+    # How many times to try again to create the directory of a measurement
+    # whose id is already taken.
+    idCollisionRetries = 3
+
     def __init__(self,
                  deck_data=None,
                  deck_path=None,
@@ -188,7 +195,12 @@ class NGDeck(object):
         yaml.safe_dump(deck_data, fh, default_flow_style=False)
 
     @defer.inlineCallbacks
-    def query_bouncer(self):
+    def query_bouncer(self, use_cache=False):
+        """
+        Looks up the collector and the test helpers of the tasks of the deck.
+        If use_cache is True, the ones that were looked up recently are used
+        without querying the bouncer.
+        """
         preferred_backend = config.advanced.get(
             "preferred_backend", "onion"
         )
@@ -204,7 +216,8 @@ class NGDeck(object):
             net_test_loaders,
             self.bouncer,
             preferred_backend,
-            self.no_collector
+            self.no_collector,
+            use_cache=use_cache
         )
         defer.returnValue(net_test_loaders)
 
@@ -215,13 +228,23 @@ class NGDeck(object):
             measurement_dir.child("measurements.njson.progress").moveTo(
                 measurement_dir.child("measurements.njson")
             )
-            generate_summary(
-                measurement_dir.child("measurements.njson").path,
-                measurement_dir.child("summary.json").path,
-                measurement_dir.child("anomaly").path,
-                deck_id=self.id
-            )
-            measurement_dir.child("running.pid").remove()
+            # The summary is built by the report as the entries are written,
+            # it's only generated here if that did not happen.
+            d = defer.succeed(None)
+            if not measurement_dir.child("summary.json").exists():
+                d = deferToThread(
+                    generate_summary,
+                    measurement_dir.child("measurements.njson").path,
+                    measurement_dir.child("summary.json").path,
+                    measurement_dir.child("anomaly").path,
+                    deck_id=self.id
+                )
+
+            @d.addCallback
+            def cb(_):
+                measurement_dir.child("running.pid").remove()
+                measurement_catalogue.update(measurement_id)
+            return d
 
     def _measurement_failed(self, failure, task):
         if not task.output_path:
@@ -229,8 +252,10 @@ class NGDeck(object):
             measurement_id = task.id
             measurement_dir = self._measurement_path.child(measurement_id)
             measurement_dir.child("running.pid").remove()
+            measurement_catalogue.update(measurement_id)
         return failure
 
+    @defer.inlineCallbacks
     def _run_ooni_task(self, task, director):
         net_test_loader = task.ooni["net_test_loader"]
         # XXX-REFACTOR we do this so late to avoid the collision between the
@@ -241,21 +266,34 @@ class NGDeck(object):
         measurement_id = None
         report_filename = task.output_path
         if not task.output_path:
+            # Two tasks of the same test started in the same second get the
+            # same id, since its timestamp has a resolution of one second.
+            # The later one waits for the next second and takes a new start
+            # time.
+            retries = self.idCollisionRetries
+            while True:
+                measurement_dir = self._measurement_path.child(task.id)
+                try:
+                    measurement_dir.createDirectory()
+                    break
+                except OSError as ose:
+                    if ose.errno != errno.EEXIST:
+                        raise
+                    if retries == 0:
+                        raise Exception("Directory already exists, there is "
+                                        "a collision")
+                retries -= 1
+                yield deferLater(reactor, 1, lambda: None)
+                test_details = net_test_loader.getTestDetails()
+                task.id = generate_filename(test_details, deck_id=self.id)
             measurement_id = task.id
 
-            measurement_dir = self._measurement_path.child(measurement_id)
-            try:
-                measurement_dir.createDirectory()
-            except OSError as ose:
-                if ose.errno == errno.EEXIST:
-                    raise Exception("Directory already exists, there is a "
-                                    "collision")
-
             report_filename = measurement_dir.child("measurements.njson.progress").path
             pid_file = measurement_dir.child("running.pid")
 
             with pid_file.open('w') as out_file:
                 out_file.write("{0}".format(os.getpid()))
+            measurement_catalogue.update(measurement_id)
 
         d = director.start_net_test_loader(
             net_test_loader,
@@ -266,7 +304,7 @@ class NGDeck(object):
         )
         d.addCallback(self._measurement_completed, task)
         d.addErrback(self._measurement_failed, task)
-        return d
+        yield d
 
     @defer.inlineCallbacks
     def setup(self):
@@ -283,20 +321,75 @@ class NGDeck(object):
                 task.skip = True
         self._is_setup = True
 
+    @property
+    def concurrency(self):
+        """
+        How many tasks of this deck can be run at the same time.
+        """
+        concurrency = self.metadata.get('concurrency', None)
+        if not concurrency:
+            concurrency = config.advanced.deck_concurrency
+        return max(int(concurrency or 1), 1)
+
+    def _task_concurrency(self, task):
+        """
+        How many tasks of this deck, including task itself, can be running
+        while task is.
+        """
+        if task.exclusive:
+            return 1
+        return min(task.concurrency or self.concurrency, self.concurrency)
+
     @defer.inlineCallbacks
     def run(self, director, from_schedule=False):
+        """
+        Runs the tasks of the deck. Up to self.concurrency tasks are run at
+        the same time, in the order in which they are listed. A task that
+        sets its own concurrency is only run alongside fewer tasks than that
+        and the exclusive ones are run only once all the previous tasks are
+        done and before starting the next ones.
+
+        If a task fails no further tasks are started and the failure is
+        raised once the ones that are running are done.
+        """
         assert self._is_setup, "You must call setup() before you can run a " \
                                "deck"
         if self.requires_tor:
             yield director.start_tor()
-        yield self.query_bouncer()
+        # Scheduled runs reuse the collector and test helpers that were
+        # looked up recently.
+        yield self.query_bouncer(use_cache=from_schedule)
         director.deckStarted(self.id, from_schedule)
+
+        running = []
+        failures = []
+
+        def task_done(result, entry):
+            running.remove(entry)
+            if isinstance(result, failure.Failure):
+                failures.append(result)
+
         for task in self._tasks:
             if task.skip is True:
                 log.debug("Skipping running {0}".format(task.id))
                 continue
-            if task.type == "ooni":
-                yield self._run_ooni_task(task, director)
+            if task.type != "ooni":
+                continue
+            while running and len(running) >= min(
+                    [self._task_concurrency(task)] +
+                    [self._task_concurrency(t) for t, _ in running]):
+                yield defer.DeferredList([d for _, d in running],
+                                         fireOnOneCallback=True)
+            if failures:
+                break
+            entry = (task, defer.maybeDeferred(self._run_ooni_task, task,
+                                               director))
+            running.append(entry)
+            entry[1].addBoth(task_done, entry)
+        yield defer.DeferredList([d for _, d in running])
+
+        if failures:
+            failures[0].raiseException()
         director.deckFinished(self.id, from_schedule)
         self._is_setup = False
 
@@ -317,6 +410,12 @@ class DeckTask(object):
         self.data = deepcopy(data)
 
         self.skip = False
+        # Exclusive tasks are never run at the same time as other tasks of
+        # the same deck.
+        self.exclusive = False
+        # If set, the task is only run alongside fewer than concurrency tasks
+        # of the same deck, including itself.
+        self.concurrency = None
 
         self.id = "invalid"
 
@@ -400,6 +499,15 @@ class DeckTask(object):
         except e.MissingTestHelper:
             self.requires_bouncer = True
 
+        # Tests that send raw packets or that are captured to a pcap file
+        # would interfere with one another, and so would tests that start or
+        # reconfigure their own Tor.
+        if (net_test_loader.requiresRoot or
+                net_test_loader.requiresTor or
+                config.privacy.includepcap or
+                self.global_options.get('pcapfile', None)):
+            self.exclusive = True
+
         self.ooni['net_test_loader'] = net_test_loader
 
     @defer.inlineCallbacks
@@ -423,6 +531,12 @@ class DeckTask(object):
             except KeyError:
                 continue
 
+        if data.pop('exclusive', False):
+            self.exclusive = True
+        concurrency = data.pop('concurrency', None)
+        if concurrency:
+            self.concurrency = max(int(concurrency), 1)
+
         task_type, task_data = data.popitem()
         if task_type not in self._supported_tasks:
             raise UnknownTaskKey(task_type)
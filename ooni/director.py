@@ -6,7 +6,7 @@ from twisted.python.failure import Failure
 from ooni.managers import ReportEntryManager, MeasurementManager
 from ooni.reporter import Report
 from ooni.utils import log, generate_filename
-from ooni.nettest import NetTest, getNetTestInformation
+from ooni.nettest import NetTest, nettest_information_cache
 from ooni.settings import config
 from ooni.nettest import normalizeTestName
 from ooni.deck.store import input_store, deck_store
@@ -162,7 +162,15 @@ class Director(object):
         return result
 
     def getNetTests(self):
+        """
+        Returns the information of the installed net tests keyed by their id.
+
+        The information is read from the nettest_information_cache so that
+        the net tests are only imported once they have changed, or when
+        they are actually run.
+        """
         nettests = {}
+        net_test_files = []
 
         def is_nettest(filename):
             return not filename == '__init__.py' and filename.endswith('.py')
@@ -173,8 +181,9 @@ class Director(object):
             for filename in os.listdir(dirname):
                 if is_nettest(filename):
                     net_test_file = os.path.join(dirname, filename)
+                    net_test_files.append(net_test_file)
                     try:
-                        nettest = getNetTestInformation(net_test_file)
+                        nettest = nettest_information_cache.get(net_test_file)
                     except:
                         log.err("Error processing %s" % filename)
                         continue
@@ -189,6 +198,7 @@ class Director(object):
                                                    '')
                         nettests[nettest['id']] = nettest
 
+        nettest_information_cache.sync(net_test_files)
         return nettests
 
     @defer.inlineCallbacks
@@ -361,9 +371,21 @@ class Director(object):
             self.activeNetTests.append(net_test)
             if measurement_id:
                 self.activeMeasurements[measurement_id] = net_test
-            self.measurementManager.schedule(net_test.generateMeasurements())
-
-            yield net_test.done
+            self.measurementManager.schedule(
+                net_test.generateMeasurements(),
+                key=net_test,
+                weight=net_test.schedulingWeight,
+                concurrency=net_test.maxConcurrentMeasurements,
+                size=net_test.totalMeasurements
+            )
+
+            # The resources shared by the measurements, like the connection
+            # pools of the HTTP agents, are released even if the NetTest fails.
+            def finalize(result):
+                d = net_test.finalize()
+                d.addCallback(lambda _: result)
+                return d
+            yield net_test.done.addBoth(finalize)
             yield report.close()
         finally:
             if measurement_id:
@@ -6,6 +6,7 @@ import time
 import random
 
 from hashlib import sha256
+from collections import OrderedDict
 
 from twisted.web import client, http_headers
 
@@ -17,47 +18,129 @@ from ooni.utils import log
 from ooni import errors
 
 try:
-    from pygeoip import GeoIP
+    import pygeoip
+    def GeoIP(database_path, *args, **kwargs):
+        return pygeoip.GeoIP(database_path, pygeoip.MMAP_CACHE)
 except ImportError:
     try:
         import GeoIP as CGeoIP
         def GeoIP(database_path, *args, **kwargs):
-            return CGeoIP.open(database_path, CGeoIP.GEOIP_STANDARD)
+            return CGeoIP.open(database_path, CGeoIP.GEOIP_MMAP_CACHE)
     except ImportError:
         log.err("Unable to import pygeoip. We will not be able to run geo IP related measurements")
 
 class GeoIPDataFilesNotFound(Exception):
     pass
 
-def ip_to_location(ipaddr):
-    from ooni.settings import config
 
-    country_file = config.get_data_file_path(
-        'resources/maxmind-geoip/GeoIP.dat'
-    )
-    asn_file = config.get_data_file_path(
-        'resources/maxmind-geoip/GeoIPASNum.dat'
-    )
-
-    location = {'city': None, 'countrycode': 'ZZ', 'asn': 'AS0'}
-    if not asn_file or not country_file:
-        log.err("Could not find GeoIP data file in data directories."
-                "Try running ooniresources or"
-                " edit your ooniprobe.conf")
-        return location
+class GeoIPDatabases(object):
+    """
+    Keeps the GeoIP country and ASN databases open (memory mapped) and caches
+    the location of the most recently looked up IPs.
 
-    country_dat = GeoIP(country_file)
-    asn_dat = GeoIP(asn_file)
+    The databases are re-opened when the files on disk change, for example
+    after ooniresources has updated them.
+    """
+    _data_files = {
+        'country': 'resources/maxmind-geoip/GeoIP.dat',
+        'asn': 'resources/maxmind-geoip/GeoIPASNum.dat'
+    }
+    # How many IP locations to keep in the LRU cache
+    cache_size = 1024
 
-    country_code = country_dat.country_code_by_addr(ipaddr)
-    if country_code is not None:
-        location['countrycode'] =  country_code
+    def __init__(self):
+        self._databases = {}
+        self._versions = {}
+        self._cache = OrderedDict()
+
+    def _file_version(self, path):
+        try:
+            st = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        return (path, st.st_ino, st.st_size, st.st_mtime)
+
+    def _current_versions(self):
+        from ooni.settings import config
+
+        versions = {}
+        for key, data_file in self._data_files.items():
+            path = config.get_data_file_path(data_file)
+            versions[key] = self._file_version(path)
+        return versions
+
+    def reload(self):
+        """
+        Re-opens the databases if they have changed on disk.
 
-    asn = asn_dat.org_by_addr(ipaddr)
-    if asn is not None:
-        location['asn'] = asn.split(' ')[0]
+        Returns:
+            True if the databases are available.
+        """
+        versions = self._current_versions()
+        if versions == self._versions and self._databases:
+            return True
+
+        self._cache.clear()
+        self._databases = {}
+        self._versions = versions
+        if None in versions.values():
+            log.err("Could not find GeoIP data file in data directories."
+                    "Try running ooniresources or"
+                    " edit your ooniprobe.conf")
+            return False
+
+        for key, version in versions.items():
+            self._databases[key] = GeoIP(version[0])
+        return True
+
+    def _lookup(self, ipaddr):
+        location = {'city': None, 'countrycode': 'ZZ', 'asn': 'AS0'}
+        if not self._databases:
+            return location
+
+        country_code = self._databases['country'].country_code_by_addr(ipaddr)
+        if country_code is not None:
+            location['countrycode'] = country_code
+
+        asn = self._databases['asn'].org_by_addr(ipaddr)
+        if asn is not None:
+            location['asn'] = asn.split(' ')[0]
+        return location
+
+    def ips_to_locations(self, ipaddrs):
+        """
+        Returns a dict keyed on the IP addresses containing their location.
+        """
+        locations = {}
+        checked = False
+        for ipaddr in ipaddrs:
+            try:
+                location = self._cache.pop(ipaddr)
+            except KeyError:
+                # We check if the databases have changed only once per batch
+                if not checked:
+                    self.reload()
+                    checked = True
+                location = self._lookup(ipaddr)
+            # We don't cache the default location we get when the databases
+            # are missing, so that it's looked up again once they are present.
+            if self._databases:
+                self._cache[ipaddr] = location
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            locations[ipaddr] = dict(location)
+        return locations
+
+    def ip_to_location(self, ipaddr):
+        return self.ips_to_locations([ipaddr])[ipaddr]
+
+geoip_databases = GeoIPDatabases()
+
+def ip_to_location(ipaddr):
+    return geoip_databases.ip_to_location(ipaddr)
 
-    return location
+def ips_to_locations(ipaddrs):
+    return geoip_databases.ips_to_locations(ipaddrs)
 
 def database_version():
     from ooni.settings import config
@@ -96,6 +179,9 @@ def database_version():
 
 class HTTPGeoIPLookupper(object):
     url = None
+    # The responses we are interested in are a few hundred bytes long, don't
+    # read more than this from a misbehaving service.
+    max_body_length = 64 * 1024
 
     _agent = client.Agent
 
@@ -105,10 +191,15 @@ class HTTPGeoIPLookupper(object):
     def _response(self, response):
         from ooni.utils.net import BodyReceiver
 
-        content_length = response.headers.getRawHeaders('content-length')
+        try:
+            content_length = int(
+                response.headers.getRawHeaders('content-length')[0])
+        except:
+            content_length = None
 
         finished = defer.Deferred()
-        response.deliverBody(BodyReceiver(finished, content_length))
+        response.deliverBody(BodyReceiver(finished, content_length,
+                                          max_body_length=self.max_body_length))
         finished.addCallback(self.parseResponse)
         return finished
 
@@ -1,5 +1,8 @@
 import itertools
+import collections
+
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from ooni.utils import log
 from ooni.settings import config
@@ -17,36 +20,113 @@ def makeIterable(item):
     return iterable
 
 
+class TaskQueue(object):
+    """
+    The tasks scheduled on a TaskManager under the same key.
+
+    Tasks that have failed and should be retried are run before the other
+    tasks of the queue.
+    """
+    def __init__(self, key, weight=1, concurrency=None, virtual_time=0):
+        self.key = key
+        self.weight = weight
+        self.concurrency = concurrency
+
+        self.tasks = iter(())
+        self.retries = collections.deque()
+        self.active = 0
+        self.dispatched = 0
+        self.exhausted = False
+
+        # How many tasks have been scheduled on the queue and how many of
+        # them have been taken out of it. size is None when the number of
+        # scheduled tasks is not known.
+        self.size = 0
+        self.taken = 0
+
+        # The queue with the lowest virtual time is the next one to run a
+        # task. Every task that is run advances it by 1/weight so that every
+        # queue gets a share of the slots proportional to its weight.
+        self.virtualTime = virtual_time
+
+    def extend(self, iterable, size=None):
+        if self.exhausted:
+            self.size = self.taken
+        if size is None or self.size is None:
+            self.size = None
+        else:
+            self.size += size
+        self.tasks = itertools.chain(self.tasks, iterable)
+        self.exhausted = False
+
+    @property
+    def pending(self):
+        """
+        How many tasks of the queue are waiting to be run, or None if it's not
+        known.
+        """
+        if self.exhausted:
+            return len(self.retries)
+        if self.size is None:
+            return None
+        return max(self.size - self.taken, 0) + len(self.retries)
+
+    @property
+    def runnable(self):
+        if self.concurrency is not None and self.active >= self.concurrency:
+            return False
+        return len(self.retries) > 0 or not self.exhausted
+
+    @property
+    def done(self):
+        return self.exhausted and len(self.retries) == 0 and self.active == 0
+
+    def next(self):
+        if self.retries:
+            return self.retries.popleft()
+        try:
+            task = next(self.tasks)
+        except StopIteration:
+            self.exhausted = True
+            raise
+        self.taken += 1
+        return task
+
+
 class TaskManager(object):
     retries = 2
     concurrency = 10
 
     def __init__(self):
-        self._tasks = iter(())
+        self._queues = []
+        self._task_queues = {}
+        self._virtual_time = 0
         self._active_tasks = []
         self.failures = 0
         self.task_lock = defer.DeferredLock()
 
     def _failed(self, failure, task):
         """
-        The has failed to complete, we append it to the end of the task chain
-        to be re-run once all the currently scheduled tasks have run.
+        The has failed to complete, we put it back at the head of its queue
+        to be re-run before the other tasks of the same queue.
         """
-        log.debug("Task %s has failed %s times" % (task, task.failures))
+        log.debug("Task %s has failed %s times", task, task.failures)
         if config.advanced.debug:
             log.exception(failure)
 
         self._active_tasks.remove(task)
+        queue = self._task_queues.pop(task)
+        queue.active -= 1
         self.failures = self.failures + 1
 
         if task.failures <= self.retries:
             log.debug("Rescheduling...")
-            self._tasks = itertools.chain(makeIterable(task), self._tasks)
-
+            queue.retries.append(task)
         else:
             # This fires the errback when the task is done but has failed.
-            log.debug('Permanent failure for %s' % task)
+            log.debug('Permanent failure for %s', task)
             task.done.errback(failure)
+            self._removeIfDone(queue)
 
         self._fillSlots()
 
@@ -60,21 +140,56 @@ class TaskManager(object):
         d = self.task_lock.acquire()
         d.addCallback(lambda _: self._scheduleNextTask())
 
-    def _scheduleNextTask(self):
-        for _ in range(self.availableSlots):
+    def _removeIfDone(self, queue):
+        if queue.done and queue in self._queues:
+            self._queues.remove(queue)
+
+    def _nextTask(self):
+        """
+        Returns the next task to run and the queue it belongs to or None if
+        there are no tasks that can be run.
+        """
+        while True:
+            runnable = [queue for queue in self._queues if queue.runnable]
+            if not runnable:
+                return None
+            # min returns the first one in case of ties, so the queues with
+            # the same virtual time are served in the order they were added.
+            queue = min(runnable, key=lambda q: q.virtualTime)
             try:
-                task = next(self._tasks)
-                self._run(task)
+                task = queue.next()
             except StopIteration:
-                break
-        self.task_lock.release()
+                self._removeIfDone(queue)
+                continue
+            except Exception:
+                log.err("Failed to generate the next task of %s" % queue.key)
+                log.exception(Failure())
+                queue.exhausted = True
+                self._removeIfDone(queue)
+                continue
+            self._virtual_time = queue.virtualTime
+            queue.virtualTime += 1.0 / queue.weight
+            return task, queue
 
-    def _run(self, task):
+    def _scheduleNextTask(self):
+        try:
+            for _ in range(self.availableSlots):
+                next_task = self._nextTask()
+                if next_task is None:
+                    break
+                self._run(*next_task)
+        finally:
+            self.task_lock.release()
+
+    def _run(self, task, queue):
         """
         This gets called to add a task to the list of currently active and
         running tasks.
         """
         self._active_tasks.append(task)
+        self._task_queues[task] = queue
+        queue.active += 1
+        queue.dispatched += 1
 
         d = task.start()
         d.addCallback(self._succeeded, task)
@@ -85,6 +200,9 @@ class TaskManager(object):
         We have successfully completed a measurement.
         """
         self._active_tasks.remove(task)
+        queue = self._task_queues.pop(task)
+        queue.active -= 1
+        self._removeIfDone(queue)
 
         # Fires the done deferred when the task has completed
         task.done.callback(result)
@@ -104,18 +222,61 @@ class TaskManager(object):
         """
         return self.concurrency - len(self._active_tasks)
 
-    def schedule(self, task_or_task_iterator):
+    def schedule(self, task_or_task_iterator, key=None, weight=1,
+                 concurrency=None, size=None):
         """
         Takes as argument a single task or a task iterable and appends it to
-        the task generator queue.
+        the queue of tasks identified by key.
+
+        The available slots are shared between the queues that have tasks to
+        run in proportion to their weight, with a queue never running more
+        than concurrency tasks at the same time if it is set.
+
+        size is how many tasks the iterable yields, if it's known and it's
+        not a sequence. It's only used to report how many tasks are pending.
         """
-        log.debug("Starting this task %s" % repr(task_or_task_iterator))
+        log.debug("Starting this task %r", task_or_task_iterator)
 
+        if size is None:
+            try:
+                size = len(task_or_task_iterator)
+            except TypeError:
+                if not hasattr(task_or_task_iterator, '__iter__'):
+                    size = 1
         iterable = makeIterable(task_or_task_iterator)
 
-        self._tasks = itertools.chain(self._tasks, iterable)
+        for queue in self._queues:
+            if queue.key == key:
+                break
+        else:
+            # New queues start from the current virtual time, so that they
+            # don't get to run all of their tasks before the other ones.
+            queue = TaskQueue(key, weight, concurrency, self._virtual_time)
+            self._queues.append(queue)
+        if queue.done:
+            queue.virtualTime = max(queue.virtualTime, self._virtual_time)
+        queue.weight = weight
+        queue.concurrency = concurrency
+        queue.extend(iterable, size)
         self._fillSlots()
 
+    def queueStats(self):
+        """
+        Returns a list containing, for every queue of tasks, a dict with how
+        many of its tasks are running, waiting to be run (None if it's not
+        known) and waiting to be retried and how many it has run so far.
+        """
+        return [{
+            'key': queue.key,
+            'weight': queue.weight,
+            'concurrency': queue.concurrency,
+            'active': queue.active,
+            'pending': queue.pending,
+            'retrying': len(queue.retries),
+            'dispatched': queue.dispatched,
+            'exhausted': queue.exhausted
+        } for queue in self._queues]
+
     def start(self):
         """
         This is called to start the task manager.
@@ -189,8 +350,8 @@ class MeasurementManager(LinkedTaskManager):
         super(MeasurementManager, self).__init__()
 
     def succeeded(self, result, measurement):
-        log.debug("Successfully performed measurement %s" % measurement)
-        log.debug("%s" % result)
+        log.debug("Successfully performed measurement %s", measurement)
+        log.debug("%s", result)
 
     def failed(self, failure, measurement):
         pass
@@ -206,8 +367,8 @@ class ReportEntryManager(LinkedTaskManager):
         super(ReportEntryManager, self).__init__()
 
     def succeeded(self, result, task):
-        log.debug("Successfully performed report %s" % task)
-        log.debug(str(result))
+        log.debug("Successfully performed report %s", task)
+        log.debug("%s", result)
 
     def failed(self, failure, task):
         pass
@@ -1,11 +1,16 @@
+import os
 import json
+import struct
 import operator
 
 from twisted.internet import defer
 from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from ooni.utils import log, is_process_running
-from ooni.utils.files import directory_usage
+from ooni.utils.files import directory_usage, truncate_partial_line
+from ooni.utils.files import iter_lines, iter_frames, read_frame
+from ooni.utils.files import GZIP_MAGIC
 from ooni.settings import config
 
 class MeasurementInProgress(Exception):
@@ -141,32 +146,146 @@ class MeasurementTypes():
         return result
 
 
-def generate_summary(input_file, output_file, anomaly_file, deck_id='none'):
-    results = {}
-    anomaly = False
-    with open(input_file) as in_file:
-        for idx, line in enumerate(in_file):
-            entry = json.loads(line.strip())
+def summarize_entry(entry):
+    """
+    Returns the result of the measurement entry that goes in the summary of
+    the measurement.
+    """
+    result = {}
+    if entry['test_name'] in MeasurementTypes.supported_tests:
+        try:
+            result = getattr(MeasurementTypes, entry['test_name'])(entry)
+        except Exception:
+            log.exception("Failed to summarize entry of {0}".format(
+                entry['test_name']))
             result = {}
-            if entry['test_name'] in MeasurementTypes.supported_tests:
-                result = getattr(MeasurementTypes, entry['test_name'])(entry)
-            result['idx'] = idx
-            if result.get('anomaly', None) is True:
-                anomaly = True
-            if not result.get('url', None):
-                result['url'] = entry['input']
-            results['test_name'] = entry['test_name']
-            results['test_start_time'] = entry['test_start_time']
-            results['country_code'] = entry['probe_cc']
-            results['asn'] = entry['probe_asn']
-            results['deck_id'] = deck_id
-            results['results'] = results.get('results', [])
-            results['results'].append(result)
-
-    with open(output_file, "w") as fw:
-        json.dump(results, fw)
-    if anomaly is True:
-        with open(anomaly_file, 'w') as _: pass
+    if not result.get('url', None):
+        result['url'] = entry['input']
+    return result
+
+
+class MeasurementSummary(object):
+    """
+    The summary of a measurement, built one entry at a time as the entries
+    are written.
+
+    The header of the summary (test_name, test_start_time, country_code and
+    asn) is taken from test_details or, if it's not set, from the entries.
+    """
+    def __init__(self, test_details=None, deck_id='none'):
+        self.test_details = test_details
+        self.deck_id = deck_id
+        self.anomaly = False
+        self.entries = 0
+        self.results = {}
+
+    def _setHeader(self, details):
+        self.results['test_name'] = details['test_name']
+        self.results['test_start_time'] = details['test_start_time']
+        self.results['country_code'] = details['probe_cc']
+        self.results['asn'] = details['probe_asn']
+        self.results['deck_id'] = self.deck_id
+        self.results['results'] = self.results.get('results', [])
+
+    def add(self, entry):
+        self.addResult(summarize_entry(entry), entry)
+
+    def addResult(self, result, entry=None):
+        """
+        Adds to the summary the result of the next entry of the measurement,
+        as returned by summarize_entry.
+        """
+        if self.test_details is None:
+            self._setHeader(entry)
+        elif not self.results:
+            self._setHeader(self.test_details)
+        result = dict(result)
+        result['idx'] = self.entries
+        if result.get('anomaly', None) is True:
+            self.anomaly = True
+        self.results['results'].append(result)
+        self.entries += 1
+
+    def write(self, output_file, anomaly_file):
+        tmp_output_file = output_file + ".tmp"
+        with open(tmp_output_file, "w") as fw:
+            json.dump(self.results, fw)
+        os.rename(tmp_output_file, output_file)
+        if self.anomaly is True:
+            with open(anomaly_file, 'w') as _: pass
+        return self.results
+
+    def checkpoint(self, checkpoint_file):
+        tmp_checkpoint_file = checkpoint_file + ".tmp"
+        with open(tmp_checkpoint_file, "w") as fw:
+            json.dump({
+                "entries": self.entries,
+                "anomaly": self.anomaly,
+                "results": self.results
+            }, fw)
+        os.rename(tmp_checkpoint_file, checkpoint_file)
+
+    @classmethod
+    def fromCheckpoint(cls, checkpoint_file, deck_id='none'):
+        summary = cls(deck_id=deck_id)
+        with open(checkpoint_file) as in_file:
+            state = json.load(in_file)
+        summary.entries = state["entries"]
+        summary.anomaly = state["anomaly"]
+        summary.results = state["results"]
+        return summary
+
+
+# When the summary of a measurement is rebuilt from its measurements file,
+# the progress is saved every this many entries so that it can be resumed
+# if the probe is stopped.
+SUMMARY_CHECKPOINT_ENTRIES = 1000
+
+
+def generate_summary(input_file, output_file, anomaly_file, deck_id='none'):
+    """
+    Builds the summary of the measurements file input_file, writing it to
+    output_file and, if any of the entries is anomalous, touching
+    anomaly_file.
+
+    This parses every entry of the measurements file, so it should be called
+    outside of the reactor thread. The summaries of measurements that are
+    written by ooniprobe are built as their entries are written (see
+    ooni.reporter.Report), so this is only used for the measurements that
+    don't have one.
+    """
+    checkpoint_file = output_file + ".partial"
+    summary = None
+    if os.path.exists(checkpoint_file):
+        try:
+            summary = MeasurementSummary.fromCheckpoint(checkpoint_file,
+                                                        deck_id)
+        except (IOError, ValueError, KeyError):
+            log.debug("Ignoring invalid summary checkpoint {0}".format(
+                checkpoint_file))
+    if summary is None:
+        summary = MeasurementSummary(deck_id=deck_id)
+
+    # The entries that were summarized already are skipped without parsing
+    # them.
+    skip = summary.entries
+    for line in iter_lines(input_file):
+        if skip > 0:
+            skip -= 1
+            continue
+        summary.add(json.loads(line.strip()))
+        if summary.entries % SUMMARY_CHECKPOINT_ENTRIES == 0:
+            summary.checkpoint(checkpoint_file)
+
+    if skip > 0:
+        # The checkpoint is not of this measurements file
+        os.remove(checkpoint_file)
+        return generate_summary(input_file, output_file, anomaly_file,
+                                deck_id)
+
+    results = summary.write(output_file, anomaly_file)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
     return results
 
 
@@ -174,6 +293,185 @@ class MeasurementNotFound(Exception):
     pass
 
 
+# measurements.idx contains, for every line of measurements.njson, the byte
+# offset at which it starts encoded as a big endian unsigned 64 bit integer.
+# When measurements.njson is compressed it's the offset of the frame holding
+# the line.
+MEASUREMENT_INDEX = "measurements.idx"
+_index_entry = struct.Struct(">Q")
+
+
+def write_index_entry(index_file, offset):
+    index_file.write(_index_entry.pack(offset))
+
+
+def build_measurement_index(input_file, index_file):
+    """
+    Scan the measurements file input_file and write to index_file the offset
+    of every line in it.
+    """
+    tmp_index_file = index_file + ".tmp"
+    with open(input_file, "rb") as in_file, \
+            open(tmp_index_file, "wb") as out_file:
+        if _is_compressed(in_file):
+            for offset, data in iter_frames(in_file):
+                for _ in data.splitlines():
+                    write_index_entry(out_file, offset)
+        else:
+            offset = 0
+            for line in in_file:
+                write_index_entry(out_file, offset)
+                offset += len(line)
+    os.rename(tmp_index_file, index_file)
+
+
+def _is_compressed(in_file):
+    in_file.seek(0)
+    compressed = in_file.read(2) == GZIP_MAGIC
+    in_file.seek(0)
+    return compressed
+
+
+def _index_is_valid(in_file, index_file):
+    """
+    The index is valid if it's made of whole entries and the last entry
+    points to the last line of the measurements file.
+    """
+    index_file.seek(0, os.SEEK_END)
+    index_size = index_file.tell()
+    in_file.seek(0, os.SEEK_END)
+    input_size = in_file.tell()
+    if index_size % _index_entry.size != 0:
+        return False
+    if index_size == 0:
+        return input_size == 0
+    index_file.seek(index_size - _index_entry.size)
+    last_offset, = _index_entry.unpack(index_file.read(_index_entry.size))
+    if last_offset >= input_size:
+        return False
+    if _is_compressed(in_file):
+        in_file.seek(last_offset)
+        return (read_frame(in_file) is not None and
+                in_file.tell() == input_size)
+    if last_offset > 0:
+        in_file.seek(last_offset - 1)
+        if in_file.read(1) != "\n":
+            return False
+    in_file.seek(last_offset)
+    in_file.readline()
+    return in_file.tell() == input_size
+
+
+def get_measurement_entries(measurement_id, start=0, count=1):
+    """
+    Returns a list of at most count measurement entries of the measurement
+    with the specified id, starting from the entry number start.
+
+    The entries are looked up via the measurements.idx index, which is
+    (re)built if it is missing or does not match the measurements file.
+    """
+    measurement_path = FilePath(config.measurements_directory)
+    measurement = measurement_path.child(measurement_id)
+    measurements = measurement.child("measurements.njson")
+    index = measurement.child(MEASUREMENT_INDEX)
+    if not measurements.exists():
+        raise MeasurementNotFound
+
+    entries = []
+    with measurements.open("r") as in_file:
+        if index.exists():
+            with index.open("r") as index_file:
+                valid = _index_is_valid(in_file, index_file)
+        else:
+            valid = False
+        if not valid:
+            log.debug("Building index for {0}".format(measurement_id))
+            build_measurement_index(measurements.path, index.path)
+
+        with index.open("r") as index_file:
+            index_file.seek(start * _index_entry.size)
+            data = index_file.read(count * _index_entry.size)
+            if data and _is_compressed(in_file):
+                return _read_compressed_entries(in_file, index_file, start,
+                                                data)
+        for idx in range(0, len(data), _index_entry.size):
+            offset, = _index_entry.unpack(data[idx:idx+_index_entry.size])
+            in_file.seek(offset)
+            entries.append(json.loads(in_file.readline()))
+    return entries
+
+
+def _read_compressed_entries(in_file, index_file, start, data):
+    """
+    Reads the entries, starting from the entry number start, of the
+    compressed measurements file whose index entries are data.
+    """
+    count = len(data) / _index_entry.size
+    offset, = _index_entry.unpack(data[:_index_entry.size])
+
+    # Entries are looked up by reading whole frames, so we need to know how
+    # many entries of the first frame come before the one we are after.
+    skip = 0
+    while start - skip > 0:
+        index_file.seek((start - skip - 1) * _index_entry.size)
+        previous, = _index_entry.unpack(index_file.read(_index_entry.size))
+        if previous != offset:
+            break
+        skip += 1
+
+    entries = []
+    in_file.seek(offset)
+    for _, frame in iter_frames(in_file):
+        for line in frame.splitlines():
+            if skip > 0:
+                skip -= 1
+                continue
+            entries.append(json.loads(line))
+            if len(entries) == count:
+                return entries
+    return entries
+
+
+def measurement_deck_id(measurement_id):
+    """
+    Returns the id of the deck the measurement with the specified id was
+    run from or "none".
+    """
+    measurement_metadata = measurement_id.split("-")
+    if len(measurement_metadata) > 4:
+        return '-'.join(measurement_metadata[4:])
+    return "none"
+
+
+def _is_running(measurement):
+    try:
+        pid = measurement.child("running.pid").open("r").read()
+        pid = int(pid)
+    except IOError:
+        return False
+    return is_process_running(pid)
+
+
+def recover_stale_report(report_file):
+    """
+    If report_file is the report of a measurement that did not complete and
+    is no longer running, cuts off the entry that the probe may have been
+    writing when it stopped.
+
+    This changes the report, so it's only done by the code that is about to
+    upload it and never when listing the measurements.
+    """
+    report_path = FilePath(report_file)
+    if report_path.basename() != "measurements.njson.progress":
+        return
+    if _is_running(report_path.parent()):
+        return
+    try:
+        truncate_partial_line(report_path.path)
+    except IOError:
+        pass
+
+
 def get_measurement(measurement_id, compute_size=False):
     size = -1
     measurement_path = FilePath(config.measurements_directory)
@@ -188,14 +486,9 @@ def get_measurement(measurement_id, compute_size=False):
     anomaly = False
     if measurement.child("measurements.njson.progress").exists():
         completed = False
-        try:
-            pid = measurement.child("running.pid").open("r").read()
-            pid = int(pid)
-            if is_process_running(pid):
-                running = True
-            else:
-                stale = True
-        except IOError:
+        if _is_running(measurement):
+            running = True
+        else:
             stale = True
 
     if measurement.child("keep").exists():
@@ -209,9 +502,7 @@ def get_measurement(measurement_id, compute_size=False):
 
     measurement_metadata = measurement_id.split("-")
     test_start_time, country_code, asn, test_name = measurement_metadata[:4]
-    deck_id = "none"
-    if len(measurement_metadata) > 4:
-        deck_id = '-'.join(measurement_metadata[4:])
+    deck_id = measurement_deck_id(measurement_id)
     return {
         "test_name": test_name,
         "country_code": country_code,
@@ -228,11 +519,19 @@ def get_measurement(measurement_id, compute_size=False):
     }
 
 
+# The summaries being generated, by measurement id
+_generating_summaries = {}
+
+
 def get_summary(measurement_id):
     """
     Returns a deferred that will fire with the content of the summary
      or will errback with MeasurementInProgress if the measurement has not
      yet finished running.
+
+    If the measurement has no summary, it's generated in a thread. Requests
+    for the summary of a measurement that is being generated share the same
+    generation.
     """
     measurement_path = FilePath(config.measurements_directory)
     measurement = measurement_path.child(measurement_id)
@@ -243,28 +542,199 @@ def get_summary(measurement_id):
     summary = measurement.child("summary.json")
     anomaly = measurement.child("anomaly")
     if not summary.exists():
-        return deferToThread(
-            generate_summary,
-            measurement.child("measurements.njson").path,
-            summary.path,
-            anomaly.path
-        )
+        if measurement_id not in _generating_summaries:
+            _generating_summaries[measurement_id] = []
+            d = deferToThread(
+                generate_summary,
+                measurement.child("measurements.njson").path,
+                summary.path,
+                anomaly.path,
+                measurement_deck_id(measurement_id)
+            )
+            @d.addCallback
+            def cb(summary):
+                # Generating the summary may have flagged it as anomalous
+                measurement_catalogue.update(measurement_id)
+                return summary
+            @d.addBoth
+            def done(result):
+                for waiting in _generating_summaries.pop(measurement_id):
+                    if isinstance(result, Failure):
+                        waiting.errback(result)
+                    else:
+                        waiting.callback(result)
+
+        d = defer.Deferred()
+        _generating_summaries[measurement_id].append(d)
+        return d
 
     with summary.open("r") as f:
         return defer.succeed(json.load(f))
 
 
-def list_measurements(compute_size=False, order=None):
-    measurements = []
-    measurement_path = FilePath(config.measurements_directory)
-    if not measurement_path.exists():
-        return measurements
-    for measurement_id in measurement_path.listdir():
+class MeasurementCatalogue(object):
+    """
+    A persistent catalogue of the metadata of the measurements found inside
+    of config.measurements_directory.
+
+    The metadata of completed measurements (including their size) is kept in
+    a JSON file next to the measurements directory so that listing the
+    measurements does not require inspecting every measurement directory.
+    The code that changes a measurement directory is responsible for calling
+    update() or remove() afterwards.
+
+    Measurements that have been added or removed by other means are detected
+    when listing, by comparing the catalogue to the content of the
+    measurements directory. When the catalogue is first loaded the
+    measurements whose directory has been modified since they were
+    catalogued are inspected again.
+    """
+    suffix = ".catalogue.json"
+    version = 1
+
+    def __init__(self):
+        self._measurements = {}
+        self._directory = None
+        self._catalogue_mtime = None
+
+    @property
+    def path(self):
+        return os.path.normpath(config.measurements_directory) + self.suffix
+
+    def _directory_mtime(self, measurement_id):
+        return os.stat(os.path.join(config.measurements_directory,
+                                    measurement_id)).st_mtime
+
+    def _scan(self, measurement_id):
+        measurement = get_measurement(measurement_id, compute_size=True)
+        measurement['mtime'] = self._directory_mtime(measurement_id)
+        return measurement
+
+    def _read(self):
         try:
-            measurements.append(get_measurement(measurement_id, compute_size))
-        except Exception as exc:
-            log.err("Failed to get metadata for measurement {0}".format(measurement_id))
-            log.exception(exc)
+            with open(self.path) as in_file:
+                catalogue = json.load(in_file)
+            self._catalogue_mtime = os.fstat(in_file.fileno()).st_mtime
+        except (IOError, OSError, ValueError):
+            return {}
+        if catalogue.get('version') != self.version:
+            return {}
+        return catalogue['measurements']
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as out_file:
+            json.dump({
+                'version': self.version,
+                'measurements': self._measurements
+            }, out_file)
+        os.rename(tmp_path, self.path)
+        self._catalogue_mtime = os.stat(self.path).st_mtime
+
+    def _repair(self):
+        """
+        Inspect again the measurements that have been modified since they
+        were catalogued.
+        """
+        for measurement_id, measurement in self._measurements.items():
+            try:
+                mtime = self._directory_mtime(measurement_id)
+                if mtime != measurement.get('mtime'):
+                    log.debug("Updating catalogue entry of {0}".format(
+                        measurement_id))
+                    self._measurements[measurement_id] = self._scan(
+                        measurement_id)
+            except (OSError, MeasurementNotFound):
+                del self._measurements[measurement_id]
+
+    def load(self):
+        """
+        (Re)load the catalogue if the measurements directory has changed
+        or another process has written to the catalogue.
+        """
+        directory = config.measurements_directory
+        if directory != self._directory:
+            self._directory = directory
+            self._measurements = self._read()
+            self._repair()
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._catalogue_mtime:
+            self._measurements = self._read()
+
+    def _sync(self):
+        """
+        Add to the catalogue the measurements that are not in it and remove
+        from it the ones that no longer exist. Returns True if the catalogue
+        has been modified.
+        """
+        try:
+            measurement_ids = set(os.listdir(config.measurements_directory))
+        except OSError:
+            measurement_ids = set()
+        modified = False
+        for measurement_id in set(self._measurements) - measurement_ids:
+            del self._measurements[measurement_id]
+            modified = True
+        for measurement_id in measurement_ids - set(self._measurements):
+            try:
+                self._measurements[measurement_id] = self._scan(measurement_id)
+                modified = True
+            except Exception as exc:
+                log.err("Failed to get metadata for measurement {0}".format(
+                    measurement_id))
+                log.exception(exc)
+        return modified
+
+    def update(self, measurement_id):
+        """
+        Inspect again the measurement with the specified id, to be called
+        after it has been modified.
+        """
+        self.load()
+        try:
+            self._measurements[measurement_id] = self._scan(measurement_id)
+        except (OSError, MeasurementNotFound):
+            self._measurements.pop(measurement_id, None)
+        self._save()
+
+    def remove(self, measurement_id):
+        self.load()
+        if self._measurements.pop(measurement_id, None) is not None:
+            self._save()
+
+    def list(self, compute_size=False):
+        if not os.path.isdir(config.measurements_directory):
+            return []
+        self.load()
+        if self._sync():
+            self._save()
+
+        measurements = []
+        for measurement_id, measurement in self._measurements.items():
+            if measurement['completed'] is False:
+                # Whether or not it's still running can change at any time
+                # and its size is not yet final.
+                try:
+                    measurement = get_measurement(measurement_id, compute_size)
+                except MeasurementNotFound:
+                    continue
+            else:
+                measurement = measurement.copy()
+                measurement.pop('mtime', None)
+                if compute_size is not True:
+                    measurement['size'] = -1
+            measurements.append(measurement)
+        return measurements
+
+measurement_catalogue = MeasurementCatalogue()
+
+
+def list_measurements(compute_size=False, order=None):
+    measurements = measurement_catalogue.list(compute_size)
 
     if order is None:
         return measurements
@@ -1,5 +1,6 @@
 import os
 import re
+import json
 import sys
 import copy
 import time
@@ -14,6 +15,7 @@ from ooni import otime
 from ooni.tasks import Measurement
 from ooni.utils import log, sanitize_options, randomStr
 from ooni.utils.net import hasRawSocketPermission
+from ooni.utils.files import LineIndex, IndexedInputs
 from ooni.settings import config
 from ooni.geoip import probe_ip
 
@@ -63,7 +65,8 @@ def getOption(opt_parameter, required_options, type='text'):
                 'type': the type of the option ('text' or 'file')
             }
     """
-    option_name, _, default, description = opt_parameter
+    # optParameters may carry a fifth element with the coerce function.
+    option_name, _, default, description = opt_parameter[:4]
     if option_name in required_options:
         required = True
     else:
@@ -135,6 +138,91 @@ def getNetTestInformation(net_test_file):
     return information
 
 
+class NetTestInformationCache(object):
+    """
+    Caches on disk the information returned by getNetTestInformation so that
+    listing the installed net tests does not require importing every one of
+    them.
+
+    Entries are keyed by the path of the net test file and are considered
+    valid for as long as the modification time and size of the file, and the
+    version of ooniprobe, are the ones they were cached with.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def path(self):
+        if self._path is not None:
+            return self._path
+        return os.path.join(config.running_path, 'nettest_cache.json')
+
+    def _load(self):
+        try:
+            with open(self.path) as in_file:
+                return json.load(in_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out_file:
+            json.dump(self._entries, out_file)
+        os.rename(tmp_path, self.path)
+
+    @staticmethod
+    def _stamp(net_test_file):
+        st = os.stat(net_test_file)
+        return [st.st_mtime, st.st_size, ooniprobe_version]
+
+    def get(self, net_test_file):
+        """
+        Returns the information of the net test, importing it only if it's
+        missing from the cache or has changed since it was cached.
+        """
+        if self._entries is None:
+            self._entries = self._load()
+        stamp = self._stamp(net_test_file)
+        entry = self._entries.get(net_test_file, None)
+        if entry is None or entry['stamp'] != stamp:
+            log.debug("Loading the information of %s" % net_test_file)
+            information = getNetTestInformation(net_test_file)
+            try:
+                # Return the same thing whether it was cached or not.
+                information = json.loads(json.dumps(information))
+            except (TypeError, ValueError):
+                log.debug("Not caching the information of %s" % net_test_file)
+                return information
+            entry = {'stamp': stamp, 'information': information}
+            self._entries[net_test_file] = entry
+            self._dirty = True
+        return copy.deepcopy(entry['information'])
+
+    def sync(self, net_test_files):
+        """
+        Forgets the net tests that are not in net_test_files and writes the
+        cache to disk if it has changed.
+        """
+        if self._entries is None:
+            return
+        for net_test_file in self._entries.keys():
+            if net_test_file not in net_test_files:
+                del self._entries[net_test_file]
+                self._dirty = True
+        if not self._dirty:
+            return
+        try:
+            self._save()
+            self._dirty = False
+        except (IOError, OSError) as exc:
+            log.err("Failed to write the net test cache to %s" % self.path)
+            log.exception(exc)
+
+nettest_information_cache = NetTestInformationCache()
+
+
 def usageOptionsFactory(test_name, test_version):
 
     class UsageOptions(usage.Options):
@@ -172,6 +260,7 @@ class NetTestLoader(object):
     collector = None
     yamloo = True
     requiresTor = False
+    requiresRoot = False
 
     def __init__(self, options, test_file=None, test_string=None,
                  annotations=None):
@@ -186,6 +275,7 @@ class NetTestLoader(object):
                                                             config.platform)
 
         self.requiresTor = False
+        self.requiresRoot = False
 
         self.testName = ""
         self.testVersion = ""
@@ -300,8 +390,10 @@ class NetTestLoader(object):
             raise e.OONIUsageError(self), None, tb
 
     def _checkTestClassOptions(self, test_class):
-        if test_class.requiresRoot and not hasRawSocketPermission():
-            raise e.InsufficientPrivileges
+        if test_class.requiresRoot:
+            if not hasRawSocketPermission():
+                raise e.InsufficientPrivileges
+            self.requiresRoot = True
         if test_class.requiresTor:
             self.requiresTor = True
         self._checkRequiredOptions(test_class)
@@ -317,7 +409,7 @@ class NetTestLoader(object):
     def _checkRequiredOptions(self, test_class):
         missing_options = []
         for required_option in test_class.requiredOptions:
-            log.debug("Checking if %s is present" % required_option)
+            log.debug("Checking if %s is present", required_option)
             if required_option not in self.localOptions or \
                     self.localOptions[required_option] is None:
                 missing_options.append(required_option)
@@ -458,8 +550,8 @@ class NetTestState(object):
         self.tasks += 1
 
     def checkAllTasksDone(self):
-        log.debug("Checking all tasks for completion %s == %s" %
-                  (self.doneTasks, self.tasks))
+        log.debug("Checking all tasks for completion %s == %s",
+                  self.doneTasks, self.tasks)
         if self.completedScheduling and \
                 self.doneTasks == self.tasks:
             if self.allTasksDone.called:
@@ -532,6 +624,18 @@ class NetTest(object):
                 classes.append(test_class)
         return classes
 
+    @property
+    def schedulingWeight(self):
+        return max([tc.schedulingWeight for tc in self.uniqueClasses()] or [1])
+
+    @property
+    def maxConcurrentMeasurements(self):
+        caps = [tc.maxConcurrentMeasurements for tc in self.uniqueClasses()
+                if tc.maxConcurrentMeasurements is not None]
+        if not caps:
+            return None
+        return min(caps)
+
     def doneNetTest(self, result):
         if self.summary:
             log.msg("Summary for %s" % self.testDetails['test_name'])
@@ -542,6 +646,14 @@ class NetTest(object):
         if self.testDetails["report_id"]:
             log.msg("Report ID: %s" % self.testDetails["report_id"])
 
+    @property
+    def totalMeasurements(self):
+        """
+        How many measurements this NetTest is expected to perform. Test cases
+        whose number of inputs is not known count as one.
+        """
+        return self._totalInputs
+
     @property
     def completionRate(self):
         return float(self._completedInputs) / (time.time() - self._startTime)
@@ -629,6 +741,15 @@ class NetTest(object):
                 test_class.setUpClass
             )
 
+    @defer.inlineCallbacks
+    def finalize(self):
+        for test_class in self.uniqueClasses():
+            try:
+                yield defer.maybeDeferred(test_class.tearDownClass)
+            except Exception as exc:
+                log.err("Failed to run tearDownClass of %s" % test_class.name)
+                log.exception(exc)
+
     def generateMeasurements(self):
         """
         This is a generator that yields measurements and registers the
@@ -659,7 +780,7 @@ class NetTest(object):
                         log.exception(failure.Failure())
                         log.err('Failed to run %s %s %s' % (test_instance, method, test_input))
                         continue # it's better to skip single measurement...
-                    log.debug("Running %s %s" % (test_instance, method))
+                    log.debug("Running %s %s", test_instance, method)
                     measurements.append(measurement.done)
                     self.state.taskCreated()
                     yield measurement
@@ -742,6 +863,12 @@ class NetTestCase(object):
 
     * requiresRoot: set to True if the test must be run as root.
 
+    * schedulingWeight: the share of the measurement slots this test gets
+      when it is run together with other tests, relative to their weight.
+
+    * maxConcurrentMeasurements: if set, the maximum number of measurements
+      of this test that are run at the same time.
+
     * usageOptions: a subclass of twisted.python.usage.Options for processing
         of command line arguments
 
@@ -771,6 +898,9 @@ class NetTestCase(object):
     requiresRoot = False
     requiresTor = False
 
+    schedulingWeight = 1
+    maxConcurrentMeasurements = None
+
     simpleOptions = {}
 
     localOptions = {}
@@ -787,6 +917,16 @@ class NetTestCase(object):
         """
         pass
 
+    @classmethod
+    def tearDownClass(cls):
+        """
+        You can override this hook with logic that should be run once after
+        all the test methods of the NetTestCase have run.
+        This can be useful to release resources that were shared by all the
+        measurements of the NetTest.
+        """
+        pass
+
     def _setUp(self):
         """
         This is the internal setup method to be overwritten by templates.
@@ -832,7 +972,7 @@ class NetTestCase(object):
         You may replace this with your own custom input processor. It takes as
         input a file name.
 
-        An inputProcessor is an iterator that will yield one item from the file
+        An inputProcessor is an iterable that will yield one item from the file
         and takes as argument a filename.
 
         This can be useful when you have some input data that is in a certain
@@ -849,19 +989,22 @@ class NetTestCase(object):
                 yield x.strip()
             fp.close()
 
+        If the returned iterable also supports len() (as is the case for
+        :class:`ooni.utils.files.IndexedInputs`) the input file is only
+        read once, otherwise it will be read a first time to count the inputs.
+        Line based input processors should therefore build on top of
+        :class:`ooni.utils.files.LineIndex` like so::
+
+            def inputProcessor(self, filename):
+                return IndexedInputs(LineIndex(filename),
+                                     process=lambda line: [line.lower()])
+
         Other fun stuff is also possible.
         """
         log.debug("Running default input processor")
-        with open(filename) as f:
-            for line in f:
-                l = line.strip()
-                # Skip empty lines
-                if not l:
-                    continue
-                # Skip comment lines
-                elif l.startswith('#'):
-                    continue
-                yield l
+        # Empty lines and comment lines are skipped by the default weigh
+        # function of the LineIndex.
+        return IndexedInputs(LineIndex(filename))
 
     @property
     def inputFileSpecified(self):
@@ -900,12 +1043,18 @@ class NetTestCase(object):
             inputProcessor.
         """
         if self.inputFileSpecified:
-            if self._totalInputs is None:
-                self._totalInputs = 0
             self.inputFilename = self.localOptions[self.inputFile[0]]
-            for _ in self.inputProcessor(self.inputFilename):
-                self._totalInputs += 1
-            return self.inputProcessor(self.inputFilename)
+            inputs = self.inputProcessor(self.inputFilename)
+            try:
+                self._totalInputs = len(inputs)
+            except TypeError:
+                # The inputProcessor is a plain generator, so we need to
+                # consume it once to know how many inputs there are.
+                self._totalInputs = 0
+                for _ in inputs:
+                    self._totalInputs += 1
+                inputs = self.inputProcessor(self.inputFilename)
+            return inputs
 
         if isinstance(self.inputs, list):
             self._totalInputs = len(self.inputs)
@@ -22,6 +22,7 @@ from twisted.internet import defer
 from ooni.templates import dnst
 
 from ooni.utils import log
+from ooni.utils.files import LineIndex, IndexedInputs
 
 
 class UsageOptions(usage.Options):
@@ -30,16 +31,43 @@ class UsageOptions(usage.Options):
                      ['testresolvers', 'T', None,
                       'File containing list of DNS resolvers to test against.'],
                      ['testresolver', 't', None,
-                         'Specify a single test resolver to use for testing.']
+                         'Specify a single test resolver to use for testing.'],
+                     ['resolverconcurrency', 'c', 4,
+                      'How many lookups to perform at the same time against '
+                      'the same DNS resolver.', int]
                      ]
 
 
+def parse_test_resolvers(local_options):
+    """
+    Returns the list of test resolvers specified in the options, or the
+    nameservers of the system if none is specified.
+    """
+    if local_options['testresolver']:
+        return [local_options['testresolver']]
+
+    if local_options['testresolvers']:
+        try:
+            with open(local_options['testresolvers']) as f:
+                return [x.split('#')[0].strip() for x in f.readlines()]
+        except IOError as e:
+            log.exception(e)
+            raise usage.UsageError("Invalid test resolvers file")
+
+    test_resolvers = []
+    with open('/etc/resolv.conf') as f:
+        for line in f:
+            if line.startswith('nameserver'):
+                test_resolvers.append(line.split(' ')[1].strip())
+    return test_resolvers
+
+
 class DNSConsistencyTest(dnst.DNSTest):
 
     name = "DNS Consistency"
     description = "Checks to see if the DNS responses from a "\
                   "set of DNS resolvers are consistent."
-    version = "0.7.0"
+    version = "0.7.1"
     authors = "Arturo Filastò, Isis Lovecruft"
 
     inputFile = ['file', 'f', None,
@@ -52,40 +80,82 @@ class DNSConsistencyTest(dnst.DNSTest):
     usageOptions = UsageOptions
     requiredOptions = ['backend', 'file']
 
-    def setUp(self):
-        if (not self.localOptions['testresolvers'] and
-                not self.localOptions['testresolver']):
-            self.test_resolvers = []
-            with open('/etc/resolv.conf') as f:
-                for line in f:
-                    if line.startswith('nameserver'):
-                        self.test_resolvers.append(line.split(' ')[1].strip())
-            self.report['test_resolvers'] = self.test_resolvers
+    # These are shared by all the measurements of a NetTest and are set up
+    # by setUpClass.
+    test_resolvers = None
+    control_dns_server = None
+    resolverLocks = None
 
-        elif self.localOptions['testresolvers']:
-            test_resolvers_file = self.localOptions['testresolvers']
+    @classmethod
+    def setUpClass(cls):
+        cls.test_resolvers = parse_test_resolvers(cls.localOptions)
 
-        elif self.localOptions['testresolver']:
-            self.test_resolvers = [self.localOptions['testresolver']]
+        dns_ip, dns_port = cls.localOptions['backend'].split(':')
+        cls.control_dns_server = (str(dns_ip), int(dns_port))
 
-        try:
-            with open(test_resolvers_file) as f:
-                self.test_resolvers = [
-                    x.split('#')[0].strip() for x in f.readlines()]
-                self.report['test_resolvers'] = self.test_resolvers
-            f.close()
+        cls.resolverLocks = {}
 
-        except IOError as e:
-            log.exception(e)
-            raise usage.UsageError("Invalid test resolvers file")
+    def setUp(self):
+        if self.test_resolvers is None:
+            self.setUpClass()
 
-        except NameError:
-            log.debug("No test resolver file configured")
+        self.report['test_resolvers'] = self.test_resolvers
+        self.report['control_resolver'] = "%s:%d" % self.control_dns_server
 
-        dns_ip, dns_port = self.localOptions['backend'].split(':')
-        self.control_dns_server = (str(dns_ip), int(dns_port))
+    def _lookup(self, lookup, query, dns_server):
+        """
+        Performs the lookup of query against dns_server without exceeding the
+        maximum number of concurrent lookups to the same resolver.
+        """
+        lock = self.resolverLocks.get(dns_server)
+        if lock is None:
+            lock = defer.DeferredSemaphore(
+                max(1, self.localOptions['resolverconcurrency']))
+            self.resolverLocks[dns_server] = lock
+        return lock.run(lookup, query, dns_server)
 
-        self.report['control_resolver'] = "%s:%d" % self.control_dns_server
+    @defer.inlineCallbacks
+    def lookup_control(self, hostname):
+        try:
+            control_answers = yield self._lookup(self.performALookup,
+                                                 hostname,
+                                                 self.control_dns_server)
+
+            if not control_answers:
+                log.err(
+                    "Got no response from control DNS server %s:%d, "
+                    "perhaps the DNS resolver is down?" %
+                    self.control_dns_server)
+                self.report['errors'][
+                    "%s:%d" %
+                    self.control_dns_server] = 'no_answer'
+        except:
+            self.report['errors'][
+                "%s:%d" %
+                self.control_dns_server] = 'error'
+            control_answers = None
+        defer.returnValue(control_answers)
+
+    @defer.inlineCallbacks
+    def lookup_experiment(self, hostname, test_resolver):
+        log.msg("Testing resolver: %s" % test_resolver)
+        try:
+            experiment_answers = yield self._lookup(self.performALookup,
+                                                    hostname,
+                                                    (test_resolver, 53))
+        except Exception:
+            log.err("Problem performing the DNS lookup")
+            self.report['errors'][test_resolver] = 'dns_lookup_error'
+            defer.returnValue(None)
+
+        if not experiment_answers:
+            log.err("Got no response, perhaps the DNS resolver is down?")
+            self.report['errors'][test_resolver] = 'no_answer'
+        else:
+            log.debug(
+                "Got the following A lookup answers %s from %s" %
+                (experiment_answers, test_resolver))
+        defer.returnValue(experiment_answers)
 
     @defer.inlineCallbacks
     def test_a_lookup(self):
@@ -106,6 +176,9 @@ class DNSConsistencyTest(dnst.DNSTest):
 
         If they do not match then censorship is probably going on (tampering:
         true).
+
+        The lookups to the control and to all the test resolvers are performed
+        concurrently.
         """
         log.msg("Doing the test lookups on %s" % self.input)
         hostname = self.input
@@ -116,54 +189,20 @@ class DNSConsistencyTest(dnst.DNSTest):
 
         self.report['errors'] = {}
 
-        try:
-            control_answers = yield self.performALookup(hostname,
-                                                        self.control_dns_server)
-
-            if not control_answers:
-                log.err(
-                    "Got no response from control DNS server %s:%d, "
-                    "perhaps the DNS resolver is down?" %
-                    self.control_dns_server)
-                self.report['errors'][
-                    "%s:%d" %
-                    self.control_dns_server] = 'no_answer'
-        except:
-            self.report['errors'][
-                "%s:%d" %
-                self.control_dns_server] = 'error'
-            control_answers = None
-
-        for test_resolver in self.test_resolvers:
-            log.msg("Testing resolver: %s" % test_resolver)
-            test_dns_server = (test_resolver, 53)
-
-            try:
-                experiment_answers = yield self.performALookup(hostname,
-                                                               test_dns_server)
-            except Exception:
-                log.err("Problem performing the DNS lookup")
-                self.report['errors'][test_resolver] = 'dns_lookup_error'
-                self.report['failures'].append(test_resolver)
-                continue
-
+        control = self.lookup_control(hostname)
+        experiments = defer.gatherResults([
+            self.lookup_experiment(hostname, test_resolver)
+            for test_resolver in self.test_resolvers
+        ])
+        control_answers = yield control
+        all_experiment_answers = yield experiments
+
+        mismatching = []
+        for test_resolver, experiment_answers in zip(self.test_resolvers,
+                                                     all_experiment_answers):
             if not experiment_answers:
-                log.err("Got no response, perhaps the DNS resolver is down?")
-                self.report['errors'][test_resolver] = 'no_answer'
                 self.report['failures'].append(test_resolver)
                 continue
-            else:
-                log.debug(
-                    "Got the following A lookup answers %s from %s" %
-                    (experiment_answers, test_resolver))
-
-            def lookup_details():
-                """
-                A closure useful for printing test details.
-                """
-                log.msg("test resolver: %s" % test_resolver)
-                log.msg("experiment answers: %s" % experiment_answers)
-                log.msg("control answers: %s" % control_answers)
 
             log.debug(
                 "Comparing %s with %s" %
@@ -174,29 +213,60 @@ class DNSConsistencyTest(dnst.DNSTest):
                 self.report['errors'][test_resolver] = None
 
             elif set(experiment_answers) & set(control_answers):
-                lookup_details()
+                self.log_lookup_details(test_resolver, experiment_answers,
+                                        control_answers)
                 log.msg("tampering: false")
                 self.report['errors'][test_resolver] = False
                 self.report['successful'].append(test_resolver)
             else:
-                log.msg("Trying to do reverse lookup")
-                experiment_reverse = yield self.performPTRLookup(experiment_answers[0],
-                                                                 test_dns_server)
-                control_reverse = yield self.performPTRLookup(control_answers[0],
-                                                              self.control_dns_server)
-
-                if experiment_reverse == control_reverse:
-                    log.msg("Further testing has eliminated false positives")
-                    lookup_details()
-                    log.msg("tampering: reverse_match")
-                    self.report['errors'][test_resolver] = 'reverse_match'
-                    self.report['successful'].append(test_resolver)
-                else:
-                    log.msg("Reverse lookups do not match")
-                    lookup_details()
-                    log.msg("tampering: true")
-                    self.report['errors'][test_resolver] = True
-                    self.report['inconsistent'].append(test_resolver)
+                mismatching.append((test_resolver, experiment_answers))
+
+        if mismatching:
+            yield self.reverse_lookups(control_answers, mismatching)
+
+        # The reverse matches are found after the other consistent resolvers,
+        # so they are put back in the order of the resolver list.
+        order = dict((test_resolver, index) for index, test_resolver
+                     in reversed(list(enumerate(self.test_resolvers))))
+        self.report['successful'].sort(key=order.get)
+
+    @defer.inlineCallbacks
+    def reverse_lookups(self, control_answers, mismatching):
+        log.msg("Trying to do reverse lookup")
+        # The reverse lookup of the control answer is the same for every
+        # mismatching test resolver, so it's only done once.
+        dl = [self._lookup(self.performPTRLookup, control_answers[0],
+                           self.control_dns_server)]
+        for test_resolver, experiment_answers in mismatching:
+            dl.append(self._lookup(self.performPTRLookup,
+                                   experiment_answers[0],
+                                   (test_resolver, 53)))
+        results = yield defer.DeferredList(dl, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+
+        control_reverse = results[0][1]
+        for (test_resolver, experiment_answers), (_, experiment_reverse) in \
+                zip(mismatching, results[1:]):
+            self.log_lookup_details(test_resolver, experiment_answers,
+                                    control_answers)
+            if experiment_reverse == control_reverse:
+                log.msg("Further testing has eliminated false positives")
+                log.msg("tampering: reverse_match")
+                self.report['errors'][test_resolver] = 'reverse_match'
+                self.report['successful'].append(test_resolver)
+            else:
+                log.msg("Reverse lookups do not match")
+                log.msg("tampering: true")
+                self.report['errors'][test_resolver] = True
+                self.report['inconsistent'].append(test_resolver)
+
+    def log_lookup_details(self, test_resolver, experiment_answers,
+                           control_answers):
+        log.msg("test resolver: %s" % test_resolver)
+        log.msg("experiment answers: %s" % experiment_answers)
+        log.msg("control answers: %s" % control_answers)
 
     def inputProcessor(self, filename=None):
         """
@@ -204,9 +274,8 @@ class DNSConsistencyTest(dnst.DNSTest):
         """
         log.debug("Running dnsconsistency default processor")
         if filename:
-            fp = open(filename)
-            for x in fp.readlines():
-                yield x.strip().split('//')[-1].split('/')[0]
-            fp.close()
-        else:
-            pass
+            return IndexedInputs(
+                LineIndex(filename),
+                process=lambda x: [x.split('//')[-1].split('/')[0]]
+            )
+        return []
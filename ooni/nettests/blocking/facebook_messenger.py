@@ -1,8 +1,7 @@
 # -*- encoding: utf-8 -*-
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 from twisted.python import usage
-from twisted.internet.endpoints import TCP4ClientEndpoint
 
 try:
     from ooni.geoip import ip_to_location
@@ -11,7 +10,7 @@ except ImportError:
     from ooni.geoip import IPToLocation as ip_to_location
 
 from ooni.utils import log
-from ooni.common.tcp_utils import TCPConnectFactory
+from ooni.common.tcp_utils import tcp_connect
 from ooni.errors import failureToString
 
 from ooni.templates import httpt, dnst
@@ -71,8 +70,7 @@ class FacebookMessengerTest(httpt.HTTPTest, dnst.DNSTest):
                 'failure': None
             }
         }
-        point = TCP4ClientEndpoint(reactor, address, port, timeout=10)
-        d = point.connect(TCPConnectFactory())
+        d = tcp_connect(address, port, timeout=10)
         @d.addCallback
         def cb(p):
             result['status']['success'] = True
@@ -5,6 +5,7 @@ from twisted.internet.endpoints import TCP4ClientEndpoint
 from ooni import nettest
 from ooni.errors import handleAllFailures
 from ooni.utils import log
+from ooni.utils.ratelimit import destination_limiter, destination_keys
 
 
 class TCPFactory(Factory):
@@ -78,7 +79,8 @@ class TCPConnectTest(nettest.NetTestCase):
 
         from twisted.internet import reactor
         point = TCP4ClientEndpoint(reactor, self.host, int(self.port))
-        d = point.connect(TCPFactory())
+        d = destination_limiter.run(destination_keys(self.host),
+                                    point.connect, TCPFactory())
         d.addCallback(connectionSuccess)
         d.addErrback(connectionFailed)
         return d
@@ -1,12 +1,10 @@
 # -*- encoding: utf-8 -*-
 
 import csv
-import random
+import time
 from urlparse import urlparse
 
 from twisted.internet import defer
-from twisted.internet import reactor
-from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.names import client
 from twisted.python import usage
 from twisted.web.client import GzipDecoder
@@ -16,10 +14,11 @@ from ooni.backend_client import WebConnectivityClient
 from ooni.common.http_utils import REQUEST_HEADERS
 from ooni.common.http_utils import extractTitle
 from ooni.common.ip_utils import is_public_ipv4_address
-from ooni.common.tcp_utils import TCPConnectFactory
+from ooni.common.tcp_utils import tcp_connect
 from ooni.errors import failureToString
 from ooni.templates import httpt, dnst
 from ooni.utils import log
+from ooni.utils.files import LineIndex, IndexedInputs
 from ooni.utils.net import COMMON_SERVER_HEADERS
 
 
@@ -40,6 +39,7 @@ class UsageOptions(usage.Options):
     optFlags = [
         ['no-shuffle', '', 'Disable shuffling of URLs'],
         ['no-http', '', 'Disable testing also http for https sites specified in the test list (i.e. if you specify `-u <URL>` _only_ that <URL> will be tested)'],
+        ['no-pipeline', '', 'Wait for the TCP and HTTP experiments to be done before performing the control request'],
     ]
 
 
@@ -53,7 +53,7 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
                    "connect to the resolved IPs and then fetching the page "
                    "and comparing all these results with those of a control.")
     author = "Arturo Filastò"
-    version = "0.3.2"
+    version = "0.3.3"
 
     contentDecoders = [('gzip', GzipDecoder)]
 
@@ -104,44 +104,40 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
         This is a specialised inputProcessor that also supports taking as
         input a csv file.
         """
-        def csv_generator(fh):
-            for row in csv.reader(fh):
-                yield row[0]
-
-        def simple_file_generator(fh):
-            for line in fh:
-                l = line.strip()
-                # Skip empty lines
-                if not l:
-                    continue
-                # Skip comment lines
-                if l.startswith('#'):
-                    continue
-                yield l
-
-        fh = open(filename)
-        try:
-            line = fh.readline()
+        with open(filename) as fh:
             # Detect the line of the citizenlab input file
-            if line.startswith("url,"):
-                generator = csv_generator(fh)
-            else:
-                fh.seek(0)
-                generator = simple_file_generator(fh)
-            if self.localOptions['no-shuffle'] != True:
-                input_list = list(generator)
-                random.shuffle(input_list)
-                generator = input_list
-
-            for i in generator:
-                if (not i.startswith("http://") and
-                        not i.startswith("https://")):
-                    i = "http://{}/".format(i)
-                if i.startswith('https://') and self.localOptions['no-http'] != True:
-                    yield 'http'+i[5:]
-                yield i
-        finally:
-            fh.close()
+            is_csv = fh.readline().startswith("url,")
+        add_http = self.localOptions['no-http'] != True
+
+        def to_url(line):
+            if is_csv:
+                return next(csv.reader([line]))[0]
+            return line
+
+        def weigh(line):
+            if not line:
+                return 0
+            if is_csv:
+                if line.startswith("url,"):
+                    return 0
+            elif line.startswith('#'):
+                return 0
+            if add_http and to_url(line).startswith('https://'):
+                return 2
+            return 1
+
+        def process(line):
+            i = to_url(line)
+            if (not i.startswith("http://") and
+                    not i.startswith("https://")):
+                i = "http://{}/".format(i)
+            if i.startswith('https://') and add_http:
+                return ['http'+i[5:], i]
+            return [i]
+
+        return IndexedInputs(LineIndex(filename, weigh=weigh),
+                             process=process,
+                             shuffle=self.localOptions['no-shuffle'] != True)
 
     def setUp(self):
         """
@@ -175,6 +171,14 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
 
         self.report['tcp_connect'] = []
         self.report['control'] = {}
+        # How many seconds each phase of the test took
+        self.report['timings'] = {
+            'dns_experiment': None,
+            'tcp_connect': None,
+            'http_experiment': None,
+            'control': None,
+            'total': None
+        }
 
         self.hostname = urlparse(self.input).netloc
         if not self.hostname:
@@ -220,8 +224,7 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
                 'blocked': None
             }
         }
-        point = TCP4ClientEndpoint(reactor, ip_address, port)
-        d = point.connect(TCPConnectFactory())
+        d = tcp_connect(ip_address, port)
         @d.addCallback
         def cb(p):
             result['status']['success'] = True
@@ -354,9 +357,10 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
         if len(control_addrs.intersection(experiment_addrs)) > 0:
             return True
 
-        experiment_asns = set(map(lambda x: geoip.ip_to_location(x)['asn'],
+        locations = geoip.ips_to_locations(experiment_addrs | control_addrs)
+        experiment_asns = set(map(lambda x: locations[x]['asn'],
                                   experiment_addrs))
-        control_asns = set(map(lambda x: geoip.ip_to_location(x)['asn'],
+        control_asns = set(map(lambda x: locations[x]['asn'],
                                control_addrs))
 
         # Remove the instance of AS0 when we fail to find the ASN
@@ -447,11 +451,53 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
         return blocking
 
 
+    def _timed(self, phase, d):
+        """
+        Records in the timings of the report how long it took for the
+        deferred d of the specified phase to fire.
+        """
+        start_time = time.time()
+        @d.addBoth
+        def done(result):
+            self.report['timings'][phase] = time.time() - start_time
+            return result
+        return d
+
+    @defer.inlineCallbacks
+    def run_experiments(self, sockets):
+        # STEALTH in here we should make changes to make the test more stealth
+        dl = []
+        for socket in sockets:
+            dl.append(self.experiment_tcp_connect(socket))
+        yield self._timed('tcp_connect', defer.DeferredList(dl))
+
+        experiment_http = self._timed('http_experiment',
+                                      self.experiment_http_get_request())
+        @experiment_http.addErrback
+        def http_experiment_err(failure):
+            failure_string = failureToString(failure)
+            log.msg("Failed to perform HTTP request %s" % failure_string)
+            self.report['http_experiment_failure'] = failure_string
+
+        experiment_http_response = yield experiment_http
+        defer.returnValue(experiment_http_response)
+
+    def run_control(self, sockets):
+        control_request = self._timed('control', self.control_request(sockets))
+        @control_request.addErrback
+        def control_err(failure):
+            failure_string = failureToString(failure)
+            log.err("Failed to perform control lookup: %s" % failure_string)
+            self.report['control_failure'] = failure_string
+        return control_request
+
     @defer.inlineCallbacks
     def test_web_connectivity(self):
         log.msg("")
         log.msg("Starting test for {}".format(self.input))
-        experiment_dns = self.experiment_dns_query()
+        start_time = time.time()
+        experiment_dns = self._timed('dns_experiment',
+                                     self.experiment_dns_query())
 
         @experiment_dns.addErrback
         def dns_experiment_err(failure):
@@ -471,29 +517,16 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
             if is_public_ipv4_address(ip_address) is True:
                 sockets.append("{}:{}".format(ip_address, port))
 
-        # STEALTH in here we should make changes to make the test more stealth
-        dl = []
-        for socket in sockets:
-            dl.append(self.experiment_tcp_connect(socket))
-        results = yield defer.DeferredList(dl)
-
-        experiment_http = self.experiment_http_get_request()
-        @experiment_http.addErrback
-        def http_experiment_err(failure):
-            failure_string = failureToString(failure)
-            log.msg("Failed to perform HTTP request %s" % failure_string)
-            self.report['http_experiment_failure'] = failure_string
-
-        experiment_http_response = yield experiment_http
-
-        control_request = self.control_request(sockets)
-        @control_request.addErrback
-        def control_err(failure):
-            failure_string = failureToString(failure)
-            log.err("Failed to perform control lookup: %s" % failure_string)
-            self.report['control_failure'] = failure_string
-
-        yield control_request
+        if self.localOptions['no-pipeline']:
+            experiment_http_response = yield self.run_experiments(sockets)
+            yield self.run_control(sockets)
+        else:
+            # The control only needs the sockets, so it can be performed
+            # while we run the TCP and HTTP experiments.
+            control = self.run_control(sockets)
+            experiment_http_response = yield self.run_experiments(sockets)
+            yield control
+        self.report['timings']['total'] = time.time() - start_time
 
         if self.report['control_failure'] is None:
             self.report['blocking'] = self.determine_blocking(experiment_http_response, experiment_dns_answers)
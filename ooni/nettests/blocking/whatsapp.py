@@ -4,13 +4,12 @@ import random
 
 import ipaddr
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 from twisted.python import usage
-from twisted.internet.endpoints import TCP4ClientEndpoint
 
 from ooni.utils import log
 from ooni.common.http_utils import extractTitle
-from ooni.common.tcp_utils import TCPConnectFactory
+from ooni.common.tcp_utils import tcp_connect
 from ooni.errors import failureToString
 
 from ooni.templates import httpt, dnst
@@ -330,8 +329,7 @@ class WhatsappTest(httpt.HTTPTest, dnst.DNSTest):
                 'failure': None
             }
         }
-        point = TCP4ClientEndpoint(reactor, address, port, timeout=10)
-        d = point.connect(TCPConnectFactory())
+        d = tcp_connect(address, port, timeout=10)
         @d.addCallback
         def cb(p):
             result['status']['success'] = True
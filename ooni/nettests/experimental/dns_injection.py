@@ -4,6 +4,7 @@ from twisted.internet import defer
 
 from ooni.templates import dnst
 from ooni.utils import log
+from ooni.utils.files import LineIndex, IndexedInputs
 
 class UsageOptions(usage.Options):
     optParameters = [
@@ -37,13 +38,11 @@ class DNSInjectionTest(dnst.DNSTest):
         self.queryTimeout = [self.localOptions['timeout']]
 
     def inputProcessor(self, filename):
-        fp = open(filename)
-        for line in fp:
+        def process(line):
             if line.startswith('http://'):
-                yield line.replace('http://', '').replace('/', '').strip()
-            else:
-                yield line.strip()
-        fp.close()
+                return [line.replace('http://', '').replace('/', '')]
+            return [line]
+        return IndexedInputs(LineIndex(filename), process=process)
 
     def test_injection(self):
         self.report['injected'] = None
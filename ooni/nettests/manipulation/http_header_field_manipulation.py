@@ -59,6 +59,9 @@ class HTTPHeaderFieldManipulation(httpt.HTTPTest):
     requiredOptions = ['backend']
     requiresTor = False
     requiresRoot = False
+    # We want every request to be seen by the middleboxes as a new
+    # connection.
+    persistentConnections = False
 
     def setUp(self):
         super(HTTPHeaderFieldManipulation, self).setUp()
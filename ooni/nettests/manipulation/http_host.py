@@ -14,6 +14,7 @@ from twisted.python import usage
 from ooni.utils import randomStr
 
 from ooni.utils import log
+from ooni.utils.files import LineIndex, IndexedInputs
 from ooni.templates import httpt
 
 
@@ -54,6 +55,10 @@ class HTTPHost(httpt.HTTPTest):
     requiredOptions = ['backend', 'file']
     requiresTor = False
     requiresRoot = False
+    # Every manipulation of the Host header field must reach the backend
+    # over a fresh connection, otherwise a transparent proxy may decide on a
+    # per connection basis.
+    persistentConnections = False
 
     def setUp(self):
         self.report['transparent_http_proxy'] = False
@@ -160,9 +165,8 @@ class HTTPHost(httpt.HTTPTest):
         This inputProcessor extracts domain names from urls
         """
         if filename:
-            fp = open(filename)
-            for x in fp.readlines():
-                yield x.strip().split('//')[-1].split('/')[0]
-            fp.close()
-        else:
-            pass
+            return IndexedInputs(
+                LineIndex(filename),
+                process=lambda x: [x.split('//')[-1].split('/')[0]]
+            )
+        return []
@@ -37,6 +37,8 @@ class PsiphonTest(httpt.HTTPTest,  process.ProcessTest):
     version = "0.2.0"
     timeout = 120
     usageOptions = UsageOptions
+    # The psiphon proxy is started and stopped for every measurement
+    persistentConnections = False
 
     def _setUp(self):
         self.localOptions['socksproxy'] = '127.0.0.1:1080'
@@ -1,7 +1,8 @@
+import os
+import sys
 import uuid
 import yaml
 import json
-import os
 
 from copy import deepcopy
 
@@ -14,28 +15,24 @@ from yaml.resolver import Resolver
 
 from twisted.python.filepath import FilePath
 from twisted.python.util import untilConcludes
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.internet.error import ConnectionRefusedError
 
 from ooni.utils import log, is_process_running
 from ooni.tasks import Measurement
-try:
-    from scapy.packet import Packet
-except ImportError:
-    log.err("Scapy is not installed.")
-
-    class Packet(object):
-        pass
-
 from ooni import errors
 
 from ooni import otime
 from ooni.utils import generate_filename
+from ooni.utils.files import BufferedWriter
 
 from ooni.settings import config
 
 from ooni.tasks import ReportEntry
-from ooni.measurements import list_measurements
+from ooni.measurements import list_measurements, write_index_entry
+from ooni.measurements import MEASUREMENT_INDEX
+from ooni.measurements import MeasurementSummary, summarize_entry
+from ooni.measurements import measurement_deck_id
 
 
 def createPacketReport(packet_list):
@@ -70,7 +67,10 @@ class OSafeRepresenter(SafeRepresenter):
         base of class of a Scapy packet.
         XXX fully debug this problem
         """
-        if isinstance(data, Packet):
+        # Scapy is slow to import and is only needed by the nettests that
+        # create packets, so if it has not been imported there are none.
+        scapy_packet = sys.modules.get('scapy.packet')
+        if scapy_packet is not None and isinstance(data, scapy_packet.Packet):
             data = createPacketReport(data)
         return SafeRepresenter.represent_data(self, data)
 
@@ -122,6 +122,63 @@ def safe_dump(data, stream=None, **kw):
     return yaml.dump_all([data], stream, Dumper=OSafeDumper, **kw)
 
 
+def build_report_entry(entry, test_details):
+    """
+    Returns the JSON report entry for entry, that can either be a
+    Measurement or a dict, with the test details merged in.
+
+    Only the top level of the report is copied, so the report entry must be
+    serialised before the measurement has a chance of changing it.
+    """
+    if isinstance(entry, Measurement):
+        e = dict(entry.testInstance.report)
+    elif isinstance(entry, dict):
+        e = dict(entry)
+    else:
+        raise Exception("Failed to serialise entry")
+    report_entry = {
+        'input': e.pop('input', None),
+        'id': str(uuid.uuid4()),
+        'test_start_time': e.pop('test_start_time', None),
+        'measurement_start_time': e.pop('measurement_start_time', None),
+        'test_runtime': e.pop('test_runtime', None),
+        'test_keys': e
+    }
+    report_entry.update(test_details)
+    return report_entry
+
+
+class SerializedEntry(object):
+    """
+    A report entry that is serialised only once, when it is written, and
+    then shared by all the reporters.
+
+    json:
+        the JSON encoding of the report entry.
+
+    report:
+        a snapshot of the top level of the report, for the reporters that
+        only support YAML.
+
+    summary:
+        if summarize is True, the result of the entry that goes in the
+        summary of the measurement (see ooni.measurements.summarize_entry).
+    """
+    __slots__ = ('id', 'json', 'report', 'summary')
+
+    def __init__(self, entry, test_details, summarize=False):
+        report_entry = build_report_entry(entry, test_details)
+        self.id = report_entry['id']
+        self.json = json.dumps(report_entry)
+        self.summary = None
+        if summarize:
+            self.summary = summarize_entry(report_entry)
+        if isinstance(entry, Measurement):
+            self.report = dict(entry.testInstance.report)
+        else:
+            self.report = dict(entry)
+
+
 class OReporter(object):
 
     def __init__(self, test_details):
@@ -143,35 +200,72 @@ class OReporter(object):
         pass
 
 
-class YAMLReporter(OReporter):
-
+class FileReporter(OReporter):
     """
-    These are useful functions for reporting to YAML format.
-
-    report_destination:
-        the destination directory of the report
+    A reporter writing to a file on disk.
 
+    Entries are written to the file in groups, every flushEntries entries or
+    flushInterval seconds after the first buffered entry, whichever comes
+    first. fsync can be one of "never", "close" or "flush" and controls when
+    the report is also synced to the disk (see
+    ooni.utils.files.BufferedWriter).
     """
+    flushEntries = 10
+    flushInterval = 1
+    fsync = "close"
 
     def __init__(self, test_details, report_filename):
         self.report_path = report_filename
+        self._writer = None
+
+        if config.advanced.get('reporting_flush_entries', None) is not None:
+            self.flushEntries = config.advanced.reporting_flush_entries
+        if config.advanced.get('reporting_flush_interval', None) is not None:
+            self.flushInterval = config.advanced.reporting_flush_interval
+        if config.advanced.get('reporting_fsync', None) is not None:
+            self.fsync = config.advanced.reporting_fsync
         OReporter.__init__(self, test_details)
 
-    def _writeln(self, line):
-        self._write("%s\n" % line)
+    def _openWriter(self, on_flush=None, compress=False):
+        self._writer = BufferedWriter(self.report_path, 'w',
+                                      flush_entries=self.flushEntries,
+                                      flush_interval=self.flushInterval,
+                                      fsync=self.fsync, on_flush=on_flush,
+                                      compress=compress)
 
-    def _write(self, format_string, *args):
-        if not self._stream:
+    def _write(self, data):
+        """
+        Buffers data to be written to the report and returns the offset it
+        will be written at.
+        """
+        if not self._writer:
             raise errors.ReportNotCreated
-        if self._stream.closed:
+        if self._writer.closed:
             raise errors.ReportAlreadyClosed
-        s = str(format_string)
+        s = str(data)
         assert isinstance(s, type(''))
-        if args:
-            self._stream.write(s % args)
-        else:
-            self._stream.write(s)
-        untilConcludes(self._stream.flush)
+        return self._writer.write(s)
+
+    def flush(self):
+        if self._writer and not self._writer.closed:
+            self._writer.flush()
+
+    def finish(self):
+        self._writer.close()
+
+
+class YAMLReporter(FileReporter):
+
+    """
+    These are useful functions for reporting to YAML format.
+
+    report_destination:
+        the destination directory of the report
+
+    """
+
+    def _writeln(self, line):
+        self._write("%s\n" % line)
 
     def writeReportEntry(self, entry):
         log.debug("Writing report with YAML reporter")
@@ -191,7 +285,7 @@ class YAMLReporter(OReporter):
         Writes the report header and fire callbacks on self.created
         """
         log.debug("Creating %s" % self.report_path)
-        self._stream = open(self.report_path, 'w+')
+        self._openWriter()
 
         self._writeln("###########################################")
 
@@ -204,92 +298,112 @@ class YAMLReporter(OReporter):
         self._writeln("###########################################")
 
         self.writeReportEntry(self.testDetails)
+        # The header is written right away, so that the report can be
+        # identified even if we don't get to write any entry.
+        self._writer.flush()
 
-    def finish(self):
-        self._stream.close()
-
-class NJSONReporter(OReporter):
+class NJSONReporter(FileReporter):
 
     """
     report_destination:
         the destination directory of the report
 
+    index_destination:
+        if set, the offset of every entry is appended to this file as it is
+        written (see ooni.measurements.get_measurement_entries).
+
+    compress:
+        if the report should be written as a sequence of gzip members, one
+        for every group of entries written to disk together.
+
+    summary:
+        if set, an instance of :class:ooni.measurements.MeasurementSummary
+        every entry is added to as it is written.
     """
 
-    def __init__(self, test_details, report_filename):
-        self.report_path = report_filename
-        OReporter.__init__(self, test_details)
+    def __init__(self, test_details, report_filename, index_filename=None,
+                 compress=False, summary=None):
+        self.index_path = index_filename
+        self.compress = compress
+        self.summary = summary
+        self._index_stream = None
+        self._index_offsets = []
+        FileReporter.__init__(self, test_details, report_filename)
 
     def _writeln(self, line):
-        self._write(line)
-        self._write("\n")
-
-    def _write(self, data):
-        if not self._stream:
-            raise errors.ReportNotCreated
-        if self._stream.closed:
-            raise errors.ReportAlreadyClosed
-        s = str(data)
-        assert isinstance(s, type(''))
-        self._stream.write(s)
-        untilConcludes(self._stream.flush)
+        offset = self._write("%s\n" % line)
+        if self._index_stream:
+            self._index_offsets.append(offset)
+
+    def _writeIndex(self):
+        # The index is only written once the entries it points to are in the
+        # report file.
+        offsets, self._index_offsets = self._index_offsets, []
+        for offset in offsets:
+            write_index_entry(self._index_stream, offset)
+        untilConcludes(self._index_stream.flush)
 
     def writeReportEntry(self, entry):
-        if isinstance(entry, Measurement):
-            e = deepcopy(entry.testInstance.report)
-        elif isinstance(entry, dict):
-            e = deepcopy(entry)
+        if isinstance(entry, SerializedEntry):
+            self._writeln(entry.json)
+            if self.summary is not None:
+                result = entry.summary
+                if result is None:
+                    result = summarize_entry(json.loads(entry.json))
+                self.summary.addResult(result)
         else:
-            raise Exception("Failed to serialise entry")
-        report_entry = {
-            'input': e.pop('input', None),
-            'id': str(uuid.uuid4()),
-            'test_start_time': e.pop('test_start_time', None),
-            'measurement_start_time': e.pop('measurement_start_time', None),
-            'test_runtime': e.pop('test_runtime', None),
-            'test_keys': e
-        }
-        report_entry.update(self.testDetails)
-        self._writeln(json.dumps(report_entry))
+            report_entry = build_report_entry(entry, self.testDetails)
+            self._writeln(json.dumps(report_entry))
+            if self.summary is not None:
+                self.summary.add(report_entry)
 
     def createReport(self):
-        self._stream = open(self.report_path, 'w+')
+        if self.index_path:
+            self._index_stream = open(self.index_path, 'wb')
+            self._openWriter(on_flush=self._writeIndex,
+                             compress=self.compress)
+        else:
+            self._openWriter(compress=self.compress)
 
     def finish(self):
-        self._stream.close()
+        FileReporter.finish(self)
+        if self._index_stream:
+            self._index_stream.close()
 
 
 class OONIBReporter(OReporter):
+    # When the collector supports it, report entries are buffered and sent in
+    # batches of at most batchSize entries. A batch that is not full is sent
+    # batchLinger seconds after its first entry has been buffered.
+    batchSize = 10
+    batchLinger = 2
 
     def __init__(self, test_details, collector_client):
         self.collector_client = collector_client
 
         self.reportId = None
         self.supportedFormats = ["yaml"]
+        self.supportsBatch = False
+
+        if config.advanced.reporting_batch_size:
+            self.batchSize = config.advanced.reporting_batch_size
+        if config.advanced.reporting_batch_linger is not None:
+            self.batchLinger = config.advanced.reporting_batch_linger
+
+        self._batch = []
+        self._batchTimer = None
         OReporter.__init__(self, test_details)
 
     def serializeEntry(self, entry, serialisation_format="yaml"):
         if serialisation_format == "json":
-            if isinstance(entry, Measurement):
-                e = deepcopy(entry.testInstance.report)
-
-            elif isinstance(entry, dict):
-                e = deepcopy(entry)
-            else:
-                raise Exception("Failed to serialise entry")
-            report_entry = {
-                'input': e.pop('input', None),
-                'id': str(uuid.uuid4()),
-                'test_start_time': e.pop('test_start_time', None),
-                'measurement_start_time': e.pop('measurement_start_time', None),
-                'test_runtime': e.pop('test_runtime', None),
-                'test_keys': e
-            }
-            report_entry.update(self.testDetails)
-            return report_entry
+            if isinstance(entry, SerializedEntry):
+                return entry.json
+            return json.dumps(build_report_entry(entry, self.testDetails))
         else:
             content = '---\n'
-            if isinstance(entry, Measurement):
+            if isinstance(entry, SerializedEntry):
+                report_entry = entry.report
+            elif isinstance(entry, Measurement):
                 report_entry = entry.testInstance.report
             elif isinstance(entry, dict):
                 report_entry = entry
@@ -299,8 +413,69 @@ class OONIBReporter(OReporter):
             content += '...\n'
             return content
 
-    @defer.inlineCallbacks
     def writeReportEntry(self, entry):
+        """
+        Returns a deferred that fires once the entry has been written to the
+        collector.
+
+        If the collector supports batching, the entry is buffered and the
+        deferred fires once the batch it belongs to has been written.
+        """
+        if self.supportsBatch:
+            return self._addToBatch(self.serializeEntry(entry, 'json'))
+        return self._writeReportEntry(entry)
+
+    def _addToBatch(self, entry_content):
+        d = defer.Deferred()
+        self._batch.append((entry_content, d))
+        if len(self._batch) >= self.batchSize:
+            self.flush()
+        elif self._batchTimer is None:
+            self._batchTimer = reactor.callLater(self.batchLinger, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Writes the buffered report entries to the collector.
+
+        The deferreds of every entry in the batch are fired with the outcome
+        of the batch, so that failed entries are retried by the
+        ReportEntryManager like any other report entry.
+        """
+        if self._batchTimer is not None:
+            if self._batchTimer.active():
+                self._batchTimer.cancel()
+            self._batchTimer = None
+
+        batch, self._batch = self._batch, []
+        if not batch:
+            return defer.succeed(None)
+
+        log.debug("Updating report with id %s with %d entries" % (
+            self.reportId, len(batch)))
+        d = self.collector_client.updateReportBatch(
+            self.reportId, 'json', [entry_content for entry_content, _ in batch]
+        )
+
+        @d.addCallback
+        def cb(result):
+            for _, entry_d in batch:
+                # The entry may have already been cancelled by a timeout
+                if not entry_d.called:
+                    entry_d.callback(result)
+
+        @d.addErrback
+        def eb(failure):
+            log.err("Error in writing batch of report entries")
+            log.exception(failure)
+            for _, entry_d in batch:
+                if not entry_d.called:
+                    entry_d.errback(errors.OONIBReportUpdateError())
+
+        return d
+
+    @defer.inlineCallbacks
+    def _writeReportEntry(self, entry):
         if "json" in self.supportedFormats:
             serialization_format = 'json'
         else:
@@ -355,13 +530,29 @@ class OONIBReporter(OReporter):
         self.backendVersion = response['backend_version']
 
         self.supportedFormats = response.get('supported_formats', ["yaml"])
+        self.supportsBatch = (response.get('supports_batch', False) is True and
+                              "json" in self.supportedFormats)
 
         log.debug("Created report with id %s" % response['report_id'])
         defer.returnValue(response['report_id'])
 
+    def resumeReport(self, cursor):
+        """
+        Continues writing to the report, that was created before, of the
+        upload cursor cursor (see UploadProgress) instead of creating a new
+        one.
+        """
+        self.reportId = cursor['report_id'].encode('ascii')
+        self.supportedFormats = cursor['supported_formats']
+        self.supportsBatch = cursor['supports_batch']
+        log.debug("Resuming report with id %s" % self.reportId)
+        return self.reportId
+
+    @defer.inlineCallbacks
     def finish(self):
+        yield self.flush()
         log.debug("Closing report with id %s" % self.reportId)
-        return self.collector_client.closeReport(self.reportId)
+        yield self.collector_client.closeReport(self.reportId)
 
 class NoReportLog(Exception):
     pass
@@ -494,34 +685,124 @@ class OONIBReportLog(object):
                 )
         defer.returnValue(to_upload_reports)
 
-    def _update_status(self, measurement_id, status, collector_settings={}):
+    def _update_status(self, measurement_id, status, collector_settings={},
+                       upload=None):
         value = {
             'pid': os.getpid(),
             'status': status,
             'collector': collector_settings
         }
+        if upload is not None:
+            value['upload'] = upload
         return self.update_log(measurement_id, value)
 
     def not_created(self, measurement_id):
         return self._update_status(measurement_id, 'not-created')
 
-    def created(self, measurement_id, collector_settings):
+    def created(self, measurement_id, collector_settings, upload=None):
         return self._update_status(measurement_id, 'created',
-                                   collector_settings)
+                                   collector_settings, upload)
 
 
     def creation_failed(self, measurement_id, collector_settings):
         return self._update_status(measurement_id, 'creation-failed',
                                    collector_settings)
 
-    def incomplete(self, measurement_id, collector_settings):
+    def incomplete(self, measurement_id, collector_settings, upload=None):
         return self._update_status(measurement_id, 'incomplete',
-                                   collector_settings)
+                                   collector_settings, upload)
 
     def closed(self, measurement_id):
         return self.remove_log(measurement_id)
 
 
+class UploadProgress(object):
+    """
+    Keeps track of how many of the entries of a report, counting from the
+    first one, have been written to the collector and saves it, together
+    with the id of the report on the collector, in the report log of the
+    measurement. This is the upload cursor that is used to resume an upload
+    that was interrupted.
+
+    Entries may be written out of order, the cursor only moves past an
+    entry once all the ones before it have been written. It's saved every
+    time the status of the report changes and after every write acknowledged
+    by the collector. The entries of a batch are all acknowledged at once,
+    so the cursor is saved once for the whole batch.
+    """
+
+    def __init__(self, report_log, measurement_id, collector_settings,
+                 oonib_reporter, entries=0, _reactor=reactor):
+        self.report_log = report_log
+        self.measurement_id = measurement_id
+        self.collector_settings = collector_settings
+        self.oonib_reporter = oonib_reporter
+        self.entries = entries
+        self.status = 'created'
+
+        self._saved = entries
+        self._written = set()
+        self._lock = defer.DeferredLock()
+        self._reactor = _reactor
+        self._saveCall = None
+
+    @property
+    def cursor(self):
+        return {
+            'report_id': self.oonib_reporter.reportId,
+            'supported_formats': self.oonib_reporter.supportedFormats,
+            'supports_batch': self.oonib_reporter.supportsBatch,
+            'entries': self.entries
+        }
+
+    def entryWritten(self, idx):
+        """
+        Called when the entry number idx of the report has been written to
+        the collector.
+        """
+        self._written.add(idx)
+        while self.entries in self._written:
+            self._written.remove(self.entries)
+            self.entries += 1
+        # All the entries acknowledged together, like the ones of a batch,
+        # are written in the same turn of the reactor and saved once after it.
+        if self.entries > self._saved and self._saveCall is None:
+            self._saveCall = self._reactor.callLater(0, self._saveWritten)
+
+    def _saveWritten(self):
+        self._saveCall = None
+        if self.entries > self._saved:
+            self.save()
+
+    def _save(self):
+        self._saved = self.entries
+        if self.status == 'incomplete':
+            return self.report_log.incomplete(self.measurement_id,
+                                              self.collector_settings,
+                                              self.cursor)
+        return self.report_log.created(self.measurement_id,
+                                       self.collector_settings, self.cursor)
+
+    def save(self, status=None):
+        """
+        Saves the upload cursor. Once the status of the report is
+        incomplete it stays so.
+        """
+        if status is not None and self.status != 'incomplete':
+            self.status = status
+        return self._lock.run(self._save)
+
+    def done(self):
+        """
+        Removes the report log once all the entries have been written and
+        the report closed.
+        """
+        if self._saveCall is not None:
+            self._saveCall.cancel()
+            self._saveCall = None
+        return self._lock.run(self.report_log.closed, self.measurement_id)
+
+
 class Report(object):
     reportId = None
 
@@ -563,6 +844,9 @@ class Report(object):
         self.njson_reporter = None
         self.oonib_reporter = None
         self.no_njson = no_njson
+        self.summary = None
+        self.upload_progress = None
+        self._entries = 0
 
         self.done = defer.Deferred()
         self.reportEntryManager = reportEntryManager
@@ -586,8 +870,11 @@ class Report(object):
                 return
             self.test_details['report_id'] = report_id
             if self.measurement_id:
-                return self.report_log.created(self.measurement_id,
-                                               self.collector_client.settings)
+                self.upload_progress = UploadProgress(
+                    self.report_log, self.measurement_id,
+                    self.collector_client.settings, self.oonib_reporter
+                )
+                return self.upload_progress.save()
 
         d = self.oonib_reporter.createReport()
         d.addErrback(creation_failed)
@@ -603,11 +890,32 @@ class Report(object):
         if self.collector_client:
             self.oonib_reporter = OONIBReporter(self.test_details,
                                                 self.collector_client)
+            # Every entry holds a slot of the ReportEntryManager until its
+            # batch has been written, so a batch larger than the slots would
+            # never fill up and always wait for batchLinger.
+            self.oonib_reporter.batchSize = min(
+                self.oonib_reporter.batchSize,
+                self.reportEntryManager.concurrency
+            )
             yield self.open_oonib_reporter()
 
         if not self.no_njson:
+            index_filename = None
+            compress = False
+            if self.measurement_id:
+                index_filename = os.path.join(
+                    os.path.dirname(self.report_filename), MEASUREMENT_INDEX)
+                self.summary = MeasurementSummary(
+                    self.test_details, measurement_deck_id(self.measurement_id)
+                )
+                # Only the measurements we keep are compressed, reports
+                # written to a path given by the user are left as they are.
+                compress = (config.basic.get('measurement_compression', None)
+                            == 'gzip')
             self.njson_reporter = NJSONReporter(self.test_details,
-                                                self.report_filename)
+                                                self.report_filename,
+                                                index_filename, compress,
+                                                self.summary)
             if not self.oonib_reporter and self.measurement_id:
                 yield self.report_log.not_created(self.measurement_id)
             yield defer.maybeDeferred(self.njson_reporter.createReport)
@@ -635,7 +943,14 @@ class Report(object):
         def njson_report_failed(failure):
             d.errback(failure)
 
+        def oonib_report_written(result, idx):
+            if self.upload_progress:
+                self.upload_progress.entryWritten(idx)
+            return result
+
         def oonib_report_failed(failure):
+            if self.upload_progress:
+                return self.upload_progress.save('incomplete')
             if self.measurement_id:
                 return self.report_log.incomplete(self.measurement_id,
                                                   self.collector_client.settings)
@@ -644,16 +959,29 @@ class Report(object):
             if not d.called:
                 d.callback(None)
 
+        # The entry is serialised once and the same bytes are written by all
+        # the reporters.
+        try:
+            entry = SerializedEntry(measurement, self.test_details,
+                                    summarize=self.summary is not None)
+        except Exception:
+            return defer.fail()
+        # The number of the entry in the report, for the upload cursor
+        idx = self._entries
+        self._entries += 1
+
         if self.njson_reporter:
-            write_njson_report = ReportEntry(self.njson_reporter, measurement)
+            write_njson_report = ReportEntry(self.njson_reporter, entry)
             self.reportEntryManager.schedule(write_njson_report)
             write_njson_report.done.addErrback(njson_report_failed)
             deferreds.append(write_njson_report.done)
 
         if self.oonib_reporter:
-            write_oonib_report = ReportEntry(self.oonib_reporter, measurement)
+            write_oonib_report = ReportEntry(self.oonib_reporter, entry)
             self.reportEntryManager.schedule(write_oonib_report)
-            write_oonib_report.done.addErrback(oonib_report_failed)
+            write_oonib_report.done.addCallbacks(oonib_report_written,
+                                                 oonib_report_failed,
+                                                 callbackArgs=(idx,))
             deferreds.append(write_oonib_report.done)
 
         dl = defer.DeferredList(deferreds)
@@ -661,6 +989,15 @@ class Report(object):
 
         return d
 
+    def _writeSummary(self, _):
+        """
+        Writes the summary of the measurement, that was built as its entries
+        were written, next to the measurements file.
+        """
+        measurement_dir = os.path.dirname(self.report_filename)
+        self.summary.write(os.path.join(measurement_dir, "summary.json"),
+                           os.path.join(measurement_dir, "anomaly"))
+
     def close(self):
         """
         Close the report by calling it's finish method.
@@ -677,6 +1014,8 @@ class Report(object):
             d.errback(failure)
 
         def oonib_report_closed(result):
+            if self.upload_progress:
+                return self.upload_progress.done()
             if self.measurement_id:
                 return self.report_log.closed(self.measurement_id)
 
@@ -690,6 +1029,8 @@ class Report(object):
 
         if self.njson_reporter:
             close_njson = defer.maybeDeferred(self.njson_reporter.finish)
+            if self.summary is not None:
+                close_njson.addCallback(self._writeSummary)
             close_njson.addErrback(njson_report_failed)
             deferreds.append(close_njson)
 
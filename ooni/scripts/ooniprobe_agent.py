@@ -11,7 +11,6 @@ from twisted.python import usage
 
 from ooni.utils import log, is_process_running
 from ooni.settings import config
-from ooni.agent.agent import AgentService
 from ooni import __version__
 
 
@@ -19,6 +18,9 @@ class StartOoniprobeAgentPlugin:
     tapname = "ooniprobe"
 
     def makeService(self, so):
+        # The agent pulls in the director, the nettests and the web UI, which
+        # the other subcommands have no use for.
+        from ooni.agent.agent import AgentService
         return AgentService(config.advanced.webui_port)
 
 class OoniprobeTwistdConfig(twistd.ServerOptions):
@@ -9,11 +9,15 @@ from twisted.python import usage
 from twisted.internet import defer, task, reactor
 
 from ooni.constants import CANONICAL_BOUNCER_ONION
-from ooni.reporter import OONIBReporter, OONIBReportLog
+from ooni.reporter import OONIBReporter, OONIBReportLog, UploadProgress
+from ooni.reporter import NoReportLog
+from ooni import errors
 
-from ooni.utils import log
+from ooni.utils import log, is_process_running
+from ooni.utils.files import iter_lines
 from ooni.settings import config
 from ooni.backend_client import BouncerClient, CollectorClient
+from ooni.measurements import recover_stale_report
 from ooni import __version__
 
 @defer.inlineCallbacks
@@ -43,6 +47,94 @@ def report_path_to_id(report_file):
         raise NoIDFound
     return measurement_id
 
+@defer.inlineCallbacks
+def write_entries(oonib_reporter, report, window=None, written=None):
+    """
+    Writes all the entries of the report keeping up to window of them in
+    flight at the same time, so that the OONIBReporter can either batch them
+    or pipeline the requests to the collector.
+
+    If set, written is called with the number of every entry, counting from
+    the first entry iterated, once it has been written.
+
+    Fails with the first error encountered once all the entries that are in
+    flight have been written.
+    """
+    if window is None:
+        window = config.advanced.reporting_window or 1
+    in_flight = defer.DeferredSemaphore(window)
+    failures = []
+
+    def entry_written(result, idx):
+        log.msg("Written entry")
+        if written is not None:
+            written(idx)
+        return result
+
+    for idx, entry in enumerate(report):
+        if failures:
+            break
+        yield in_flight.acquire()
+        d = oonib_reporter.writeReportEntry(entry)
+        d.addCallback(entry_written, idx)
+        d.addErrback(failures.append)
+        d.addBoth(lambda _: in_flight.release())
+
+    # Send what is left in the buffer without waiting for it to linger and
+    # wait for all the entries in flight to be written.
+    oonib_reporter.flush()
+    for _ in range(window):
+        yield in_flight.acquire()
+
+    if failures:
+        failures[0].raiseException()
+
+
+def load_report(report_file):
+    # The report of a measurement that was interrupted may end with a
+    # partially written entry.
+    recover_stale_report(report_file)
+    if report_file.endswith((".njson", ".njson.progress")):
+        return NJSONReportLoader(report_file)
+    log.warn("Uploading of YAML formatted reports will be dropped in "
+             "future versions")
+    return YAMLReportLoader(report_file)
+
+
+def get_upload_cursor(report_log):
+    """
+    Returns the upload cursor (see ooni.reporter.UploadProgress) of the
+    report log report_log if the upload of the report can be resumed.
+    """
+    if report_log is None or report_log.get('upload', None) is None:
+        return None
+    if report_log['status'] not in ('created', 'incomplete'):
+        return None
+    if (report_log['status'] == 'created' and
+            report_log['pid'] != os.getpid() and
+            is_process_running(report_log['pid'])):
+        # The report is still being written by someone else
+        return None
+    return report_log['upload']
+
+
+@defer.inlineCallbacks
+def upload_entries(oonib_reporter, report, progress=None, start=0):
+    """
+    Writes the entries of the report, starting from the entry number start,
+    keeping track of the upload progress with progress.
+    """
+    written = None
+    if progress is not None:
+        written = lambda idx: progress.entryWritten(start + idx)
+    try:
+        yield write_entries(oonib_reporter, report, written=written)
+    except Exception:
+        if progress is not None:
+            yield progress.save('incomplete')
+        raise
+
+
 @defer.inlineCallbacks
 def upload(report_file, collector=None, bouncer=None, measurement_id=None):
     oonib_report_log = OONIBReportLog()
@@ -56,14 +148,16 @@ def upload(report_file, collector=None, bouncer=None, measurement_id=None):
     except NoIDFound:
         pass
 
+    report_log = None
+    if measurement_id:
+        try:
+            report_log = yield oonib_report_log.get_report_log(measurement_id)
+        except NoReportLog:
+            pass
+
     log.msg("Attempting to upload %s" % report_file)
 
-    if report_file.endswith(".njson"):
-        report = NJSONReportLoader(report_file)
-    else:
-        log.warn("Uploading of YAML formatted reports will be dropped in "
-                 "future versions")
-        report = YAMLReportLoader(report_file)
+    report = load_report(report_file)
 
     if bouncer and collector_client is None:
         collector_client = yield lookup_collector_client(report.header,
@@ -71,7 +165,8 @@ def upload(report_file, collector=None, bouncer=None, measurement_id=None):
 
     if collector_client is None:
         if measurement_id:
-            report_log = yield oonib_report_log.get_report_log(measurement_id)
+            if report_log is None:
+                raise NoReportLog
             collector_settings = report_log['collector']
             print(collector_settings)
             if collector_settings is None or len(collector_settings) == 0:
@@ -89,45 +184,84 @@ def upload(report_file, collector=None, bouncer=None, measurement_id=None):
                                                              CANONICAL_BOUNCER_ONION)
 
     oonib_reporter = OONIBReporter(report.header, collector_client)
-    log.msg("Creating report for %s with %s" % (report_file,
-                                                collector_client.settings))
-    report_id = yield oonib_reporter.createReport()
-    report.header['report_id'] = report_id
-    if measurement_id:
-        log.debug("Marking it as created")
-        yield oonib_report_log.created(measurement_id,
-                                       collector_client.settings)
-    log.msg("Writing report entries")
-    for entry in report:
-        yield oonib_reporter.writeReportEntry(entry)
-        log.msg("Written entry")
+    progress = None
+
+    # A report can only be resumed on the collector it was created on.
+    cursor = None
+    if not collector and not bouncer:
+        cursor = get_upload_cursor(report_log)
+    if cursor is not None:
+        report_id = oonib_reporter.resumeReport(cursor)
+        report.header['report_id'] = report_id
+        report.skip(cursor['entries'])
+        log.msg("Resuming report %s for %s from entry %d" % (
+            report_id, report_file, cursor['entries']))
+        progress = UploadProgress(oonib_report_log, measurement_id,
+                                  collector_client.settings, oonib_reporter,
+                                  cursor['entries'])
+        try:
+            yield upload_entries(oonib_reporter, report, progress,
+                                 cursor['entries'])
+        except errors.OONIBReportUpdateError:
+            if progress.entries > cursor['entries']:
+                raise
+            # Not a single entry could be written, the report may have been
+            # closed by the collector in the meantime so we start over with
+            # a new one.
+            log.msg("Failed to resume report %s, creating a new one" %
+                    report_id)
+            report.close()
+            report = load_report(report_file)
+            oonib_reporter = OONIBReporter(report.header, collector_client)
+            cursor = None
+
+    if cursor is None:
+        log.msg("Creating report for %s with %s" % (report_file,
+                                                    collector_client.settings))
+        report_id = yield oonib_reporter.createReport()
+        report.header['report_id'] = report_id
+        if measurement_id:
+            log.debug("Marking it as created")
+            progress = UploadProgress(oonib_report_log, measurement_id,
+                                      collector_client.settings,
+                                      oonib_reporter)
+            yield progress.save('created')
+        log.msg("Writing report entries")
+        yield upload_entries(oonib_reporter, report, progress)
+
     log.msg("Closing report")
     yield oonib_reporter.finish()
-    if measurement_id:
+    if progress is not None:
         log.debug("Closing log")
-        yield oonib_report_log.closed(measurement_id)
+        yield progress.done()
 
 
 @defer.inlineCallbacks
-def upload_all(collector=None, bouncer=None, upload_incomplete=False):
+def upload_all(collector=None, bouncer=None, upload_incomplete=False,
+               max_parallel=None):
+    """
+    Uploads all the reports that have not been uploaded yet and, if
+    upload_incomplete is True, resumes the uploads that were interrupted.
+
+    Up to max_parallel reports are uploaded at the same time.
+    """
+    if max_parallel is None:
+        max_parallel = config.advanced.get('upload_max_parallel', None) or 1
     oonib_report_log = OONIBReportLog()
 
     reports_to_upload = yield oonib_report_log.get_to_upload()
-    for report_file, value in reports_to_upload:
-        try:
-            yield upload(report_file, collector, bouncer,
-                         value['measurement_id'])
-        except Exception as exc:
-            log.exception(exc)
-
     if upload_incomplete:
-        reports_to_upload = yield oonib_report_log.get_incomplete()
-        for report_file, value in reports_to_upload:
-            try:
-                yield upload(report_file, collector, bouncer,
-                             value['measurement_id'])
-            except Exception as exc:
-                log.exception(exc)
+        reports_incomplete = yield oonib_report_log.get_incomplete()
+        reports_to_upload = list(reports_to_upload) + list(reports_incomplete)
+
+    uploading = defer.DeferredSemaphore(max_parallel)
+    dl = []
+    for report_file, value in reports_to_upload:
+        d = uploading.run(upload, report_file, collector, bouncer,
+                          value['measurement_id'])
+        d.addErrback(log.exception)
+        dl.append(d)
+    yield defer.DeferredList(dl)
 
 def print_report(report_file, value):
     print("* %s" % report_file)
@@ -179,6 +313,16 @@ class ReportLoader(object):
     def __iter__(self):
         return self
 
+    def skip(self, count):
+        """
+        Skips the next count entries of the report.
+        """
+        for _ in range(count):
+            try:
+                self.next()
+            except StopIteration:
+                break
+
     def close(self):
         self._fp.close()
 
@@ -198,17 +342,28 @@ class YAMLReportLoader(ReportLoader):
 
 class NJSONReportLoader(ReportLoader):
     def __init__(self, report_filename):
-        self._fp = open(report_filename)
+        # The report may be compressed, so it's read through iter_lines
+        self._report_filename = report_filename
         self.header = self._peek_header()
+        self._fp = iter_lines(report_filename)
 
     def _peek_header(self):
         header = {}
-        first_entry = json.loads(next(self._fp))
+        lines = iter_lines(self._report_filename)
+        first_entry = json.loads(next(lines))
+        lines.close()
         for key in self._header_keys:
             header[key] = first_entry.get(key, None)
-        self._fp.seek(0)
         return header
 
+    def skip(self, count):
+        # The entries that are skipped are not parsed
+        for _ in range(count):
+            try:
+                next(self._fp)
+            except StopIteration:
+                break
+
     def next(self):
         try:
             entry = json.loads(next(self._fp))
@@ -238,7 +393,9 @@ class Options(usage.Options):
         ["collector", "c", None,
          "Specify the collector to upload the result to."],
         ["bouncer", "b", None,
-         "Specify the bouncer to query for a collector."]
+         "Specify the bouncer to query for a collector."],
+        ["max-parallel", "p", None,
+         "How many reports to upload at the same time.", int]
     ]
 
     def opt_version(self):
@@ -295,7 +452,8 @@ def oonireport(_reactor=reactor, _args=sys.argv[1:]):
         log.start()
         tor_check()
         return upload_all(options['collector'],
-                          options['bouncer'])
+                          options['bouncer'],
+                          max_parallel=options['max-parallel'])
     elif options['command'] == "status":
         return status()
     else:
@@ -32,6 +32,8 @@ basic:
     # The maximum amount of data to store on disk. Once the quota is reached,
     # we will start deleting older reports.
     # measurement_quota: 1G
+    # Set to gzip to store the measurements compressed on disk.
+    # measurement_compression: null
 privacy:
     # Should we include the IP address of the probe in the report?
     includeip: {include_ip}
@@ -67,12 +69,54 @@ advanced:
     #measurement_retries: 2
     # How many measurements to perform concurrently
     #measurement_concurrency: 4
+    # How many connections or queries to have in flight at the same time to
+    # the same host or IP address, how many of them to start per second and
+    # how many of them to allow in a burst. Both limits are disabled (null)
+    # unless they are set here.
+    #destination_concurrency: null
+    #destination_rate: null
+    #destination_burst: 4
+    # How many tasks of a deck to run concurrently. Decks, and the tasks of a
+    # deck, can override this by setting concurrency.
+    #deck_concurrency: 1
     # After how may seconds we should give up reporting
     #reporting_timeout: 360
     # After how many retries to give up on reporting
     #reporting_retries: 5
     # How many reports to perform concurrently
     #reporting_concurrency: 7
+    # When the collector supports it, how many report entries to send in a
+    # single request and after how many seconds to send an incomplete batch.
+    # While measuring, batches are never larger than reporting_concurrency.
+    #reporting_batch_size: 10
+    #reporting_batch_linger: 2
+    # How many report entries oonireport should keep in flight when uploading
+    #reporting_window: 20
+    # How many reports oonireport should upload at the same time
+    #upload_max_parallel: 2
+    # Measurements are written to disk every reporting_flush_entries entries
+    # or reporting_flush_interval seconds, whichever comes first.
+    # reporting_fsync can be never, close (sync the report once it's done) or
+    # flush (sync every time entries are written).
+    #reporting_flush_entries: 10
+    #reporting_flush_interval: 1
+    #reporting_fsync: close
+    # When the web_connectivity test helper supports it, how many control
+    # requests to send in a single request and after how many seconds to send
+    # an incomplete batch. Set control_batch_size to 1 to disable batching.
+    # Batches are never larger than measurement_concurrency.
+    #control_batch_size: 20
+    #control_batch_linger: 0.5
+    # How many idle connections to keep open towards every backend (bouncer,
+    # collector and test helpers) and for how many seconds.
+    #backend_connections_per_host: 2
+    #backend_idle_timeout: 60
+    # When looking for a reachable collector or test helper, how many seconds
+    # to wait before also trying the next one in order of preference.
+    #backend_race_stagger: 1
+    # For how many seconds scheduled decks reuse the collector and test
+    # helpers that were looked up with the bouncer.
+    #backend_cache_ttl: 3600
     # If we should support communicating to plaintext backends (via HTTP)
     # insecure_backend: false
     # The preferred backend type, can be one of onion, https or cloudfront
@@ -117,7 +161,8 @@ defaults = {
         "rotate": "daily",
         "rotate_length": "1M",
         "max_rotated_files": None,
-        "measurement_quota": "1G"
+        "measurement_quota": "1G",
+        "measurement_compression": None
     },
     "privacy": {
         "includeip": False,
@@ -140,9 +185,26 @@ defaults = {
         "measurement_timeout": 120,
         "measurement_retries": 2,
         "measurement_concurrency": 4,
+        "deck_concurrency": 1,
+        "destination_concurrency": None,
+        "destination_rate": None,
+        "destination_burst": 4,
         "reporting_timeout": 360,
         "reporting_retries": 5,
         "reporting_concurrency": 7,
+        "reporting_batch_size": 10,
+        "reporting_batch_linger": 2,
+        "reporting_window": 20,
+        "upload_max_parallel": 2,
+        "reporting_flush_entries": 10,
+        "reporting_flush_interval": 1,
+        "reporting_fsync": "close",
+        "control_batch_size": 20,
+        "control_batch_linger": 0.5,
+        "backend_connections_per_host": 2,
+        "backend_idle_timeout": 60,
+        "backend_race_stagger": 1,
+        "backend_cache_ttl": 3600,
         "insecure_backend": False,
         "preferred_backend": "onion",
         "webui_port": 8842,
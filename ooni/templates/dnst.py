@@ -3,12 +3,15 @@
 # :authors: Arturo Filastò
 # :licence: see LICENSE
 
-from twisted.internet import udp, error, base
+from twisted.internet import udp, error, base, defer
+from twisted.internet.abstract import isIPv6Address
 from twisted.internet.defer import TimeoutError
 from twisted.names import client, dns
 from twisted.names.client import Resolver
+from twisted.python import failure
 
 from ooni.utils import log
+from ooni.utils.ratelimit import destination_limiter, destination_keys
 from ooni.nettest import NetTestCase
 from ooni.errors import failureToString
 
@@ -85,6 +88,96 @@ def representAnswer(answer):
         represented_answer['ipv4'] = answer.payload.dottedQuad()
     return represented_answer
 
+class SingleSocketResolver(Resolver):
+    """
+    A Resolver that sends all of its UDP queries from the same socket, instead
+    of binding a new one for every query. Outstanding queries are told apart
+    by their message id.
+    """
+    _protocol = None
+
+    def _query(self, *args):
+        if self._protocol is None or self._protocol.transport is None:
+            if isIPv6Address(args[0][0]):
+                self._protocol = self._connectedProtocol(interface='::')
+            else:
+                self._protocol = self._connectedProtocol()
+        return self._protocol.query(*args)
+
+    def close(self):
+        """
+        Closes the socket of the resolver, any outstanding query will fail.
+        """
+        protocol, self._protocol = self._protocol, None
+        if protocol is None or protocol.transport is None:
+            return defer.succeed(None)
+        return defer.maybeDeferred(protocol.transport.stopListening)
+
+class DNSResolverRegistry(object):
+    """
+    Keeps a single SingleSocketResolver for every DNS server, so that the
+    UDP socket to it is reused by all the queries, and coalesces the
+    identical queries that are in flight at the same time.
+    """
+    def __init__(self):
+        self._resolvers = {}
+        self._inFlight = {}
+        self._stats = {
+            'queries': 0,
+            'coalesced': 0
+        }
+
+    def getResolver(self, dns_server):
+        dns_server = tuple(dns_server)
+        try:
+            return self._resolvers[dns_server]
+        except KeyError:
+            resolver = SingleSocketResolver(servers=[dns_server])
+            self._resolvers[dns_server] = resolver
+            return resolver
+
+    def query(self, key, f, *args, **kw):
+        """
+        Calls f, which performs the query identified by key, and returns a
+        deferred firing with its result. If the same query is already in
+        flight the returned deferred fires with the outcome of that one
+        instead.
+        """
+        self._stats['queries'] += 1
+        waiting = self._inFlight.get(key)
+        if waiting is not None:
+            self._stats['coalesced'] += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        waiting = []
+        self._inFlight[key] = waiting
+        d = defer.maybeDeferred(f, *args, **kw)
+
+        @d.addBoth
+        def done(result):
+            del self._inFlight[key]
+            for waiting_d in waiting:
+                if isinstance(result, failure.Failure):
+                    waiting_d.errback(result)
+                else:
+                    waiting_d.callback(result)
+            return result
+
+        return d
+
+    def getStats(self):
+        stats = dict(self._stats)
+        stats['resolvers'] = len(self._resolvers)
+        return stats
+
+    def close(self):
+        resolvers, self._resolvers = self._resolvers, {}
+        return defer.DeferredList([resolver.close()
+                                   for resolver in resolvers.values()])
+
+
 class DNSTest(NetTestCase):
     name = "Base DNS Test"
     version = "0.2.0"
@@ -92,12 +185,33 @@ class DNSTest(NetTestCase):
     requiresRoot = False
     queryTimeout = [1]
 
+    @classmethod
+    def tearDownClass(cls):
+        d = defer.maybeDeferred(super(DNSTest, cls).tearDownClass)
+        resolver_registry = cls.__dict__.get('resolverRegistry')
+        if resolver_registry is None:
+            return d
+        del cls.resolverRegistry
+        log.debug("DNS resolver stats: %s", resolver_registry.getStats())
+        return defer.gatherResults([d, resolver_registry.close()])
+
+    @classmethod
+    def _getResolverRegistry(cls):
+        # Like for the agent factory of HTTPTest every NetTest gets its own
+        # registry.
+        resolver_registry = cls.__dict__.get('resolverRegistry')
+        if resolver_registry is None:
+            resolver_registry = DNSResolverRegistry()
+            cls.resolverRegistry = resolver_registry
+        return resolver_registry
+
     def _setUp(self):
         super(DNSTest, self)._setUp()
 
         self.report['queries'] = []
+        self.resolverRegistry = self._getResolverRegistry()
 
-    def performPTRLookup(self, address, dns_server = None):
+    def performPTRLookup(self, address, dns_server = None, resolver = None):
         """
         Does a reverse DNS lookup on the input ip address
 
@@ -107,11 +221,13 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :resolver: the Resolver to send the query to dns_server with
         """
         ptr = '.'.join(address.split('.')[::-1]) + '.in-addr.arpa'
-        return self.dnsLookup(ptr, 'PTR', dns_server)
+        return self.dnsLookup(ptr, 'PTR', dns_server, resolver)
 
-    def performALookup(self, hostname, dns_server = None):
+    def performALookup(self, hostname, dns_server = None, resolver = None):
         """
         Performs an A lookup and returns an array containg all the dotted quad
         IP addresses in the response.
@@ -122,10 +238,12 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :resolver: the Resolver to send the query to dns_server with
         """
-        return self.dnsLookup(hostname, 'A', dns_server)
+        return self.dnsLookup(hostname, 'A', dns_server, resolver)
 
-    def performNSLookup(self, hostname, dns_server = None):
+    def performNSLookup(self, hostname, dns_server = None, resolver = None):
         """
         Performs a NS lookup and returns an array containg all nameservers in
         the response.
@@ -136,10 +254,12 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :resolver: the Resolver to send the query to dns_server with
         """
-        return self.dnsLookup(hostname, 'NS', dns_server)
+        return self.dnsLookup(hostname, 'NS', dns_server, resolver)
 
-    def performSOALookup(self, hostname, dns_server = None):
+    def performSOALookup(self, hostname, dns_server = None, resolver = None):
         """
         Performs a SOA lookup and returns the response (name,serial).
 
@@ -148,10 +268,13 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :resolver: the Resolver to send the query to dns_server with
         """
-        return self.dnsLookup(hostname,'SOA',dns_server)
+        return self.dnsLookup(hostname, 'SOA', dns_server, resolver)
 
-    def dnsLookup(self, hostname, dns_type, dns_server = None):
+    def dnsLookup(self, hostname, dns_type, dns_server = None,
+                  resolver = None):
         """
         Performs a DNS lookup and returns the response.
 
@@ -159,6 +282,12 @@ class DNSTest(NetTestCase):
         :dns_type: type of lookup 'NS'/'A'/'SOA'
         :dns_server: is the dns_server that should be used for the lookup as a
                      tuple of ip port (ex. ("127.0.0.1", 53))
+        :resolver: is the twisted.names.client.Resolver to send the query to
+                   dns_server with, if None the one of the NetTest for
+                   dns_server will be used
+
+        Identical queries that are in flight at the same time are only sent
+        once, but every one of them is added to the report.
         """
         types = {
             'NS': dns.NS,
@@ -169,8 +298,8 @@ class DNSTest(NetTestCase):
         dnsType = types[dns_type]
         query = [dns.Query(hostname, dnsType, dns.IN)]
         def gotResponse(message):
-            log.debug(dns_type + " Lookup successful")
-            log.debug(str(message))
+            log.debug("%s Lookup successful", dns_type)
+            log.debug("%s", message)
 
             if dns_server:
                 msg = message.answers
@@ -188,7 +317,7 @@ class DNSTest(NetTestCase):
                 elif answer.type is dns.A:
                     addr = answer.payload.dottedQuad()
                 else:
-                    log.debug("Unidentified answer %s" % answer)
+                    log.debug("Unidentified answer %s", answer)
                 addrs.append(addr)
                 answers.append(representAnswer(answer))
 
@@ -207,8 +336,13 @@ class DNSTest(NetTestCase):
             return failure
 
         if dns_server:
-            resolver = Resolver(servers=[dns_server])
-            d = resolver.queryUDP(query, timeout=self.queryTimeout)
+            if resolver is None:
+                resolver = self.resolverRegistry.getResolver(dns_server)
+            d = self.resolverRegistry.query(
+                (hostname, dns_type, tuple(dns_server)),
+                destination_limiter.run, destination_keys(dns_server[0]),
+                resolver.queryUDP, query, timeout=self.queryTimeout
+            )
         else:
             lookupFunction = {
                 'NS': client.lookupNameservers,
@@ -216,7 +350,9 @@ class DNSTest(NetTestCase):
                 'A': client.lookupAddress,
                 'PTR': client.lookupPointer
             }
-            d = lookupFunction[dns_type](hostname)
+            d = self.resolverRegistry.query((hostname, dns_type, None),
+                                            lookupFunction[dns_type],
+                                            hostname)
 
         d.addCallback(gotResponse)
         d.addErrback(gotError)
@@ -224,7 +360,7 @@ class DNSTest(NetTestCase):
 
     def addToReport(self, query, resolver=None, query_type=None,
                     answers=None, failure=None):
-        log.debug("Adding %s to report)" % query)
+        log.debug("Adding %s to report)", query)
         result = {
             'resolver_hostname': None,
             'resolver_port': None
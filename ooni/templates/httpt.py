@@ -1,11 +1,13 @@
 import random
+from urlparse import urlparse
 
 from txtorcon.interface import StreamListenerMixin
 
 from twisted.web.client import readBody, PartialDownloadError
-from twisted.web.client import ContentDecoderAgent
+from twisted.web.client import ContentDecoderAgent, ResponseDone
+from twisted.web.http import PotentialDataLoss
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.internet.endpoints import TCP4ClientEndpoint
 
 from ooni.utils.socks import TrueHeadersSOCKS5Agent
@@ -14,9 +16,11 @@ from ooni.nettest import NetTestCase
 from ooni.utils import log
 from ooni.settings import config
 
-from ooni.utils.net import StringProducer, userAgents
+from ooni.utils.net import StringProducer, BodyReceiver, userAgents
+from ooni.utils.ratelimit import destination_limiter, destination_keys
 from ooni.common.txextra import TrueHeaders
 from ooni.common.txextra import FixedRedirectAgent, TrueHeadersAgent
+from ooni.common.txextra import HTTPConnectionPool
 from ooni.common.http_utils import representBody
 from ooni.errors import handleAllFailures
 from ooni.geoip import probe_ip
@@ -24,6 +28,28 @@ from ooni.geoip import probe_ip
 class InvalidSocksProxyOption(Exception):
     pass
 
+class _ResponseBodyReceiver(BodyReceiver):
+    """
+    A BodyReceiver that fails like readBody when the body is not received
+    completely, unless it has been truncated on purpose.
+    """
+    def __init__(self, finished, response, **kw):
+        BodyReceiver.__init__(self, finished, **kw)
+        self.response = response
+
+    def connectionLost(self, reason):
+        if self.finished.called or self.truncated:
+            return BodyReceiver.connectionLost(self, reason)
+        if reason.check(PotentialDataLoss):
+            self.finished.errback(PartialDownloadError(
+                self.response.code, self.response.phrase,
+                "".join(self.chunks)))
+        elif not reason.check(ResponseDone):
+            self.finished.errback(reason)
+        else:
+            BodyReceiver.connectionLost(self, reason)
+
+
 class StreamListener(StreamListenerMixin):
 
     def __init__(self, request):
@@ -40,6 +66,111 @@ class StreamListener(StreamListenerMixin):
             log.err("Tor Exit ip detection failed")
 
 
+class HTTPAgentFactory(object):
+    """
+    Builds the agents used by a HTTPTest and owns the connection pools backing
+    them.
+
+    One HTTPAgentFactory is shared by all the measurements of a NetTest,
+    so that connections to the same host can be reused across inputs.
+    """
+    def __init__(self, socksproxy=None, persistent=True,
+                 maxPersistentPerHost=None, cachedConnectionTimeout=None,
+                 followRedirects=False, ignorePrivateRedirects=False,
+                 contentDecoders=None):
+        """
+        Args:
+            socksproxy (tuple): the (host, port) of the socks proxy to use for
+                the non Tor requests or None to connect directly.
+
+            persistent (bool): if connections should be kept open after a
+                request has completed so that they can be reused.
+
+            maxPersistentPerHost (int): the maximum number of idle
+                connections to keep open towards the same host.
+
+            cachedConnectionTimeout (int): the number of seconds after which
+                an idle connection is closed.
+        """
+        self.socksproxy = socksproxy
+        self.followRedirects = followRedirects
+        self.ignorePrivateRedirects = ignorePrivateRedirects
+        self.contentDecoders = contentDecoders or []
+
+        self.pools = {}
+        for name in ('direct', 'tor'):
+            self.pools[name] = HTTPConnectionPool(
+                reactor, persistent,
+                maxPersistentPerHost=maxPersistentPerHost,
+                cachedConnectionTimeout=cachedConnectionTimeout
+            )
+
+        self._agent = None
+        self._control_agent = None
+
+    def _wrapAgent(self, agent, ignorePrivateRedirects=False):
+        if self.followRedirects:
+            agent = FixedRedirectAgent(
+                agent,
+                ignorePrivateRedirects=ignorePrivateRedirects
+            )
+        if len(self.contentDecoders) > 0:
+            agent = ContentDecoderAgent(agent, self.contentDecoders)
+        return agent
+
+    @property
+    def agent(self):
+        if self._agent is not None:
+            return self._agent
+
+        if self.socksproxy:
+            sockshost, socksport = self.socksproxy
+            agent = TrueHeadersSOCKS5Agent(reactor,
+                proxyEndpoint=TCP4ClientEndpoint(reactor, sockshost,
+                    socksport),
+                pool=self.pools['direct'])
+        else:
+            agent = TrueHeadersAgent(reactor, pool=self.pools['direct'])
+        self._agent = self._wrapAgent(
+            agent,
+            ignorePrivateRedirects=self.ignorePrivateRedirects
+        )
+        return self._agent
+
+    @property
+    def control_agent(self):
+        if self._control_agent is not None:
+            return self._control_agent
+
+        agent = TrueHeadersSOCKS5Agent(reactor,
+                proxyEndpoint=TCP4ClientEndpoint(reactor, '127.0.0.1',
+                    config.tor.socks_port),
+                pool=self.pools['tor'])
+        self._control_agent = self._wrapAgent(agent)
+        return self._control_agent
+
+    def getStats(self):
+        """
+        Returns a dict keyed on the pool name ('direct' or 'tor') containing
+        the number of connection hits, misses and open sockets of each pool.
+        """
+        stats = {}
+        for name, pool in self.pools.items():
+            stats[name] = pool.getStats()
+        return stats
+
+    def close(self):
+        """
+        Closes all the idle persistent connections.
+
+        Returns:
+            a deferred that fires once all the connections have been closed.
+        """
+        return defer.DeferredList([
+            pool.closeCachedConnections() for pool in self.pools.values()
+        ])
+
+
 def _representHeaders(headers):
     represented_headers = {}
     for name, value in headers.getAllRawHeaders():
@@ -76,9 +207,52 @@ class HTTPTest(NetTestCase):
     # contentDecoders = [('gzip', GzipDecoder)]
     contentDecoders = []
 
+    # Set this to False in tests whose methodology requires every request to
+    # be done over a fresh connection.
+    persistentConnections = True
+    # The maximum number of idle connections to keep open towards the same
+    # host and the number of seconds after which they are closed.
+    maxPersistentPerHost = 2
+    cachedConnectionTimeout = 60
+
+    # If set, only this many bytes of every response body are read and the
+    # rest is dropped.
+    maxBodyLength = None
+
     baseParameters = [['socksproxy', 's', None,
         'Specify a socks proxy to use for requests (ip:port)']]
 
+    @classmethod
+    def tearDownClass(cls):
+        # Tests such as web_connectivity are also a DNSTest, which has its
+        # own resources to release.
+        d = defer.maybeDeferred(super(HTTPTest, cls).tearDownClass)
+        agent_factory = cls.__dict__.get('agentFactory')
+        if agent_factory is None:
+            return d
+        del cls.agentFactory
+        log.debug("HTTP connection pool stats: %s", agent_factory.getStats())
+        return defer.gatherResults([d, agent_factory.close()])
+
+    @classmethod
+    def _getAgentFactory(cls, socksproxy):
+        # We look into the class __dict__ so that every NetTest (that
+        # specialises the test class via netTestCaseFactory) gets its own
+        # agent factory.
+        agent_factory = cls.__dict__.get('agentFactory')
+        if agent_factory is None or agent_factory.socksproxy != socksproxy:
+            agent_factory = HTTPAgentFactory(
+                socksproxy=socksproxy,
+                persistent=cls.persistentConnections,
+                maxPersistentPerHost=cls.maxPersistentPerHost,
+                cachedConnectionTimeout=cls.cachedConnectionTimeout,
+                followRedirects=cls.followRedirects,
+                ignorePrivateRedirects=cls.ignorePrivateRedirects,
+                contentDecoders=cls.contentDecoders
+            )
+            cls.agentFactory = agent_factory
+        return agent_factory
+
     def _setUp(self):
         super(HTTPTest, self)._setUp()
 
@@ -88,44 +262,24 @@ class HTTPTest(NetTestCase):
             log.err("Warning! pyOpenSSL is not installed. https websites will "
                      "not work")
 
-        self.control_agent = TrueHeadersSOCKS5Agent(reactor,
-                proxyEndpoint=TCP4ClientEndpoint(reactor, '127.0.0.1',
-                    config.tor.socks_port))
-
         self.report['socksproxy'] = None
+        socksproxy = None
         if self.localOptions['socksproxy']:
             try:
                 sockshost, socksport = self.localOptions['socksproxy'].split(':')
                 self.report['socksproxy'] = self.localOptions['socksproxy']
             except ValueError:
                 raise InvalidSocksProxyOption
-            socksport = int(socksport)
-            self.agent = TrueHeadersSOCKS5Agent(reactor,
-                proxyEndpoint=TCP4ClientEndpoint(reactor, sockshost,
-                    socksport))
-        else:
-            self.agent = TrueHeadersAgent(reactor)
+            socksproxy = (sockshost, int(socksport))
 
-        self.report['agent'] = 'agent'
+        self.agentFactory = self._getAgentFactory(socksproxy)
+        self.agent = self.agentFactory.agent
+        self.control_agent = self.agentFactory.control_agent
 
+        self.report['agent'] = 'agent'
         if self.followRedirects:
-            try:
-                self.control_agent = FixedRedirectAgent(self.control_agent)
-                self.agent = FixedRedirectAgent(
-                    self.agent,
-                    ignorePrivateRedirects=self.ignorePrivateRedirects
-                )
-                self.report['agent'] = 'redirect'
-            except:
-                log.err("Warning! You are running an old version of twisted "
-                        "(<= 10.1). I will not be able to follow redirects."
-                        "This may make the testing less precise.")
+            self.report['agent'] = 'redirect'
 
-        if len(self.contentDecoders) > 0:
-            self.control_agent = ContentDecoderAgent(self.control_agent,
-                                                     self.contentDecoders)
-            self.agent = ContentDecoderAgent(self.agent,
-                                             self.contentDecoders)
         self.processInputs()
         log.debug("Finished test setup")
 
@@ -150,7 +304,7 @@ class HTTPTest(NetTestCase):
 
             failure (instance): An instance of :class:twisted.internet.failure.Failure
         """
-        log.debug("Adding %s to report" % request)
+        log.debug("Adding %s to report", request)
         request_headers = TrueHeaders(request['headers'])
         session = {
             'request': {
@@ -264,7 +418,7 @@ class HTTPTest(NetTestCase):
         pass
 
     def _cbResponse(self, response, request,
-            headers_processor, body_processor):
+            headers_processor, body_processor, chunk_processor=None):
         """
         This callback is fired once we have gotten a response for our request.
         If we are using a RedirectAgent then this will fire once we have
@@ -284,6 +438,9 @@ class HTTPTest(NetTestCase):
                 body of the response. This will lead self.bodyProcessor to not
                 be called.
 
+            chunk_processor (func): a function to be called with every chunk
+                of the body of the response as it is received.
+
         """
         if not response:
             log.err("Got no response for request %s" % request)
@@ -291,8 +448,10 @@ class HTTPTest(NetTestCase):
             return
         else:
             log.debug("Got response")
-            log.debug("code: %d" % response.code)
-            log.debug("headers: %s" % response.headers.getAllRawHeaders())
+            log.debug("code: %d", response.code)
+            if log.isEnabledFor(log.levels['DEBUG']):
+                log.debug("headers: %s",
+                          list(response.headers.getAllRawHeaders()))
 
         if str(response.code).startswith('3'):
             self.processRedirect(response.headers.getRawHeaders('Location')[0])
@@ -305,7 +464,23 @@ class HTTPTest(NetTestCase):
         else:
             self.processResponseHeaders(response_headers_dict)
 
-        finished = readBody(response)
+        if self.maxBodyLength is None and chunk_processor is None:
+            finished = readBody(response)
+        else:
+            finished = defer.Deferred()
+            receiver = _ResponseBodyReceiver(
+                finished, response,
+                max_body_length=self.maxBodyLength,
+                chunk_processor=chunk_processor
+            )
+            response.deliverBody(receiver)
+
+            @finished.addCallback
+            def check_truncated(body):
+                if receiver.truncated:
+                    log.msg("Truncated the response body of %s to %d bytes" %
+                            (request['url'], self.maxBodyLength))
+                return body
         finished.addErrback(self._processResponseBodyFail, request,
                             response)
         finished.addCallback(self._processResponseBody, request,
@@ -314,7 +489,7 @@ class HTTPTest(NetTestCase):
 
     def doRequest(self, url, method="GET",
                   headers={}, body=None, headers_processor=None,
-                  body_processor=None, use_tor=False):
+                  body_processor=None, use_tor=False, chunk_processor=None):
         """
         Perform an HTTP request with the specified method and headers.
 
@@ -342,20 +517,26 @@ class HTTPTest(NetTestCase):
             use_tor (bool): specify if the HTTP request should be done over Tor
                 or not.
 
+            chunk_processor: a function to be called with every chunk of the
+                response body as it is received, to process the body
+                incrementally. The complete body is still passed to
+                body_processor.
+
         """
 
         # We prefix the URL with 's' to make the connection go over the
         # configured socks proxy
         if use_tor:
-            log.debug("Using Tor for the request to %s" % url)
+            log.debug("Using Tor for the request to %s", url)
             agent = self.control_agent
         else:
             agent = self.agent
 
         if self.localOptions['socksproxy']:
-            log.debug("Using SOCKS proxy %s for request" % (self.localOptions['socksproxy']))
+            log.debug("Using SOCKS proxy %s for request",
+                      self.localOptions['socksproxy'])
 
-        log.debug("Performing request %s %s %s" % (url, method, headers))
+        log.debug("Performing request %s %s %s", url, method, headers)
 
         request = {}
         request['method'] = method
@@ -407,9 +588,16 @@ class HTTPTest(NetTestCase):
             if state:
                 state.add_stream_listener(StreamListener(request))
 
-        d = agent.request(request['method'], request['url'], headers,
-                body_producer)
-        d.addErrback(errback, request)
-        d.addCallback(self._cbResponse, request, headers_processor,
-                body_processor)
-        return d
+        def perform_request():
+            d = agent.request(request['method'], request['url'], headers,
+                    body_producer)
+            d.addErrback(errback, request)
+            d.addCallback(self._cbResponse, request, headers_processor,
+                    body_processor, chunk_processor)
+            return d
+
+        # The destination is held until the response body has been read.
+        return destination_limiter.run(
+            destination_keys(urlparse(request['url']).hostname),
+            perform_request
+        )
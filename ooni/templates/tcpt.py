@@ -4,6 +4,7 @@ from twisted.internet.endpoints import TCP4ClientEndpoint
 from ooni.nettest import NetTestCase
 from ooni.errors import failureToString
 from ooni.utils import log
+from ooni.utils.ratelimit import destination_limiter, destination_keys
 
 class TCPSender(protocol.Protocol):
     def __init__(self):
@@ -90,9 +91,13 @@ class TCPTest(NetTestCase):
                 # XXX-Twisted this logic should probably go inside of the protocol
                 reactor.callLater(self.timeout, closeConnection, proto)
 
-        point = TCP4ClientEndpoint(reactor, self.address, self.port)
-        log.debug("Connecting to %s:%s" % (self.address, self.port))
-        d2 = point.connect(TCPSenderFactory())
-        d2.addCallback(connected)
-        d2.addErrback(errback)
-        return d1
+        def connect():
+            point = TCP4ClientEndpoint(reactor, self.address, self.port)
+            log.debug("Connecting to %s:%s" % (self.address, self.port))
+            d2 = point.connect(TCPSenderFactory())
+            d2.addCallback(connected)
+            d2.addErrback(errback)
+            return d1
+
+        return destination_limiter.run(destination_keys(self.address),
+                                       connect)
@@ -1,5 +1,8 @@
+import json
+
 from twisted.python import failure
 from twisted.internet import defer
+from twisted.web.resource import Resource
 
 from ooni.tasks import BaseTask, TaskWithTimeout
 from ooni.managers import TaskManager
@@ -192,6 +195,7 @@ class MockTaskManager(TaskManager):
 class MockBouncerClient(object):
     def __init__(self, *args, **kw):
         self.backend_type = "onion"
+        self.base_address = "http://thirteenchars321.onion"
 
     def lookupTestHelpers(self, required_test_helpers):
         ret = {
@@ -242,3 +246,42 @@ class MockCollectorClient(CollectorClient):
 
     def isReachable(self):
         return defer.succeed(True)
+
+
+class MockWebConnectivityHelper(Resource):
+    """
+    A stand-in for the web_connectivity test helper that answers every
+    control request with the sockets it was asked to connect to.
+    """
+    isLeaf = True
+
+    def __init__(self, supports_batch=True):
+        Resource.__init__(self)
+        self.supports_batch = supports_batch
+        self.requests = []
+
+    def control(self, request):
+        return {
+            'tcp_connect': dict((socket, {'status': True, 'failure': None})
+                                for socket in request['tcp_connect']),
+            'http_request': {'failure': None,
+                             'url': request['http_request']},
+            'dns': {'failure': None, 'addrs': []}
+        }
+
+    def render_GET(self, request):
+        self.requests.append(request.path)
+        return json.dumps({'status': 'ok',
+                           'supports_batch': self.supports_batch})
+
+    def render_POST(self, request):
+        self.requests.append(request.path)
+        query = json.loads(request.content.read())
+        if request.path == '/batch' and self.supports_batch:
+            return json.dumps({
+                'responses': [self.control(q) for q in query['requests']]
+            })
+        elif request.path == '/':
+            return json.dumps(self.control(query))
+        request.setResponseCode(404)
+        return json.dumps({'error': 404})
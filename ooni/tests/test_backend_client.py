@@ -2,14 +2,16 @@ import os
 import shutil
 import socket
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.web import error
+from twisted.web.server import Site
 
 from ooni import errors as e
 from ooni.settings import config
-from ooni.backend_client import CollectorClient, BouncerClient
-from ooni.backend_client import WebConnectivityClient
+from ooni.backend_client import CollectorClient, BouncerClient, OONIBClient
+from ooni.backend_client import WebConnectivityClient, ControlBatcher
 from ooni.tests.bases import ConfigTestCase
+from ooni.tests.mocks import MockWebConnectivityHelper
 
 from mock import MagicMock
 
@@ -201,3 +203,88 @@ class TestBackendClient(ConfigTestCase):
             raised = True
             self.assertIsInstance(exc, e.InvalidAddress)
         self.assertTrue(raised)
+
+
+class TestControlBatcher(ConfigTestCase):
+    def start_helper(self, supports_batch):
+        self.helper = MockWebConnectivityHelper(supports_batch)
+        self.port = reactor.listenTCP(0, Site(self.helper),
+                                      interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        address = 'http://127.0.0.1:%d' % self.port.getHost().port
+        self.addCleanup(WebConnectivityClient._batchers.clear)
+        self.addCleanup(WebConnectivityClient.closeConnections)
+        return address
+
+    def control_requests(self, address, count):
+        dl = []
+        for idx in range(count):
+            # Every measurement uses its own client
+            wcc = WebConnectivityClient(address)
+            dl.append(wcc.control("http://example.com/%d" % idx,
+                                  ["127.0.0.1:%d" % idx]))
+        return defer.gatherResults(dl)
+
+    @defer.inlineCallbacks
+    def test_batched_control(self):
+        self.addCleanup(setattr, self.config.advanced, 'control_batch_size',
+                        self.config.advanced.control_batch_size)
+        self.config.advanced.control_batch_size = 3
+        address = self.start_helper(supports_batch=True)
+        responses = yield self.control_requests(address, 5)
+
+        self.assertEqual(self.helper.requests,
+                         ['/status', '/batch', '/batch'])
+        for idx, response in enumerate(responses):
+            self.assertEqual(response['http_request']['url'],
+                             "http://example.com/%d" % idx)
+            self.assertEqual(response['tcp_connect'].keys(),
+                             ["127.0.0.1:%d" % idx])
+
+    @defer.inlineCallbacks
+    def test_control_without_batch_support(self):
+        address = self.start_helper(supports_batch=False)
+        responses = yield self.control_requests(address, 3)
+
+        self.assertEqual(self.helper.requests, ['/status', '/', '/', '/'])
+        self.assertEqual([r['http_request']['url'] for r in responses],
+                         ["http://example.com/%d" % idx for idx in range(3)])
+
+    @defer.inlineCallbacks
+    def test_status_failure_is_not_cached(self):
+        statuses = [defer.fail(Exception("timeout")),
+                    defer.succeed({'status': 'ok', 'supports_batch': True})]
+        client = MagicMock()
+        client.queryBackend.side_effect = lambda *args, **kw: statuses.pop(0)
+        batcher = ControlBatcher()
+        supports_batch = yield batcher.supportsBatch(client)
+        self.assertFalse(supports_batch)
+        supports_batch = yield batcher.supportsBatch(client)
+        self.assertTrue(supports_batch)
+
+    @defer.inlineCallbacks
+    def test_connections_are_reused(self):
+        address = self.start_helper(supports_batch=False)
+        for _ in range(3):
+            # Every request uses its own client
+            reachable = yield WebConnectivityClient(address).isReachable()
+            self.assertTrue(reachable)
+
+        stats = WebConnectivityClient.getPoolStats()['http']
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['open'], 1)
+
+    @defer.inlineCallbacks
+    def test_close_connections_from_a_subclass(self):
+        address = self.start_helper(supports_batch=False)
+        reachable = yield WebConnectivityClient(address).isReachable()
+        self.assertTrue(reachable)
+        pool = WebConnectivityClient(address).pool
+
+        yield WebConnectivityClient.closeConnections()
+        self.assertEqual(OONIBClient.getPoolStats(), {})
+        # The pools are still shared by all the clients
+        new_pool = CollectorClient(address).pool
+        self.assertIsNot(new_pool, pool)
+        self.assertIs(WebConnectivityClient(address).pool, new_pool)
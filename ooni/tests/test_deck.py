@@ -5,15 +5,17 @@ from copy import deepcopy
 
 import yaml
 
-from mock import patch
+from mock import patch, MagicMock
 
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python.filepath import FilePath
 from twisted.trial import unittest
 
 from hashlib import sha256
 from ooni import errors
 from ooni.deck.store import input_store
 from ooni.deck.backend import lookup_collector_and_test_helpers
+from ooni.deck.backend import race_reachable, BackendLookupCache
 from ooni.deck.deck import nettest_to_path, NGDeck, options_to_args
 from ooni.deck.legacy import convert_legacy_deck
 from ooni.tests.bases import ConfigTestCase
@@ -244,6 +246,95 @@ class TestDeck(BaseTestCase, ConfigTestCase):
             '127.0.0.1'
         )
 
+class MockReachabilityClient(object):
+    def __init__(self, address):
+        self.settings = {'type': 'https', 'address': address}
+        self.checked = defer.Deferred()
+        self.started = False
+
+    def isReachable(self):
+        self.started = True
+        return self.checked
+
+
+class TestBackendLookup(ConfigTestCase):
+    def test_race_reachable(self):
+        clock = task.Clock()
+        clients = [MockReachabilityClient("https://%d.example.com" % idx)
+                   for idx in range(3)]
+        d = race_reachable(clients, stagger=1, _reactor=clock)
+        self.assertEqual([c.started for c in clients], [True, False, False])
+
+        # The next client is tried once the previous one had a head start...
+        clock.advance(1)
+        self.assertEqual([c.started for c in clients], [True, True, False])
+        # ...or as soon as all the ones before it are unreachable
+        clients[0].checked.callback(False)
+        clients[1].checked.errback(Exception("unreachable"))
+        self.assertTrue(clients[2].started)
+
+        clients[2].checked.callback(True)
+        self.assertEqual(self.successResultOf(d), clients[2])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_race_reachable_prefers_the_first_that_answers(self):
+        clock = task.Clock()
+        clients = [MockReachabilityClient("https://%d.example.com" % idx)
+                   for idx in range(2)]
+        d = race_reachable(clients, stagger=1, _reactor=clock)
+        clock.advance(1)
+        clients[1].checked.callback(True)
+        self.assertEqual(self.successResultOf(d), clients[1])
+        clients[0].checked.callback(True)
+
+    def test_race_reachable_synchronous(self):
+        clock = task.Clock()
+        clients = [MockReachabilityClient("https://%d.example.com" % idx)
+                   for idx in range(3)]
+        clients[0].checked.callback(False)
+        clients[1].checked.callback(True)
+        d = race_reachable(clients, stagger=1, _reactor=clock)
+        self.assertEqual(self.successResultOf(d), clients[1])
+        self.assertFalse(clients[2].started)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_race_reachable_none(self):
+        clients = [MockReachabilityClient("https://example.com")]
+        d = race_reachable(clients, stagger=1, _reactor=task.Clock())
+        clients[0].checked.callback(False)
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_backend_cache(self):
+        now = [1000]
+        cache_path = os.path.join(self.config.running_path,
+                                  'test_backend_cache.json')
+        self.addCleanup(lambda: os.path.exists(cache_path) and
+                        os.remove(cache_path))
+        cache = BackendLookupCache(cache_path, ttl=60, _time=lambda: now[0])
+        key = cache.key(FAKE_BOUNCER_ADDRESS, 'onion',
+                        [{'name': 'spam', 'version': '0.1'}])
+        self.assertEqual(cache.get(key), None)
+
+        cache.set(key, [{
+            'name': 'spam',
+            'version': '0.1',
+            'collector': MockCollectorClient(FAKE_BOUNCER_ADDRESS),
+            'test-helpers': {'web-connectivity': {
+                'type': 'https', 'address': 'https://wc.example.com'}}
+        }])
+        now[0] += 60
+        net_tests = cache.get(key)
+        self.assertEqual(net_tests[0]['collector'].base_address,
+                         "http://thirteenchars123.onion")
+        self.assertEqual(
+            net_tests[0]['test-helpers']['web-connectivity']['address'],
+            'https://wc.example.com'
+        )
+
+        now[0] += 1
+        self.assertEqual(cache.get(key), None)
+
+
 class TestInputStore(ConfigTestCase):
     @defer.inlineCallbacks
     def test_update_input_store(self):
@@ -340,3 +431,97 @@ class TestNGDeck(ConfigTestCase):
                                 "disabled-flag": False, "enabled-flag": True})
         self.assertEqual(set(args), set(['-f', 'foobar.txt',
                                          '--enabled-flag']))
+
+    def _deck_with_tasks(self, exclusive, concurrency,
+                         task_concurrency=None):
+        deck = NGDeck()
+        deck.metadata['concurrency'] = concurrency
+        deck._is_setup = True
+        deck.query_bouncer = lambda use_cache=False: defer.succeed(None)
+        deck._tasks = []
+        if task_concurrency is None:
+            task_concurrency = [None] * len(exclusive)
+        for idx, is_exclusive in enumerate(exclusive):
+            task = MagicMock()
+            task.id = idx
+            task.skip = False
+            task.type = "ooni"
+            task.exclusive = is_exclusive
+            task.concurrency = task_concurrency[idx]
+            deck._tasks.append(task)
+
+        self.started = []
+        self.running = {}
+        def run_ooni_task(task, director):
+            self.started.append(task.id)
+            self.running[task.id] = defer.Deferred()
+            return self.running[task.id]
+        deck._run_ooni_task = run_ooni_task
+        return deck
+
+    def test_run_concurrent_tasks(self):
+        deck = self._deck_with_tasks([False, False, False, True, False], 2)
+        d = deck.run(MagicMock())
+        self.assertEqual(self.started, [0, 1])
+        self.running[1].callback(None)
+        self.assertEqual(self.started, [0, 1, 2])
+        self.running[2].callback(None)
+        # The exclusive task waits for all the previous ones to be done
+        self.assertEqual(self.started, [0, 1, 2])
+        self.running[0].callback(None)
+        self.assertEqual(self.started, [0, 1, 2, 3])
+        self.running[3].callback(None)
+        self.assertEqual(self.started, [0, 1, 2, 3, 4])
+        self.assertNoResult(d)
+        self.running[4].callback(None)
+        self.successResultOf(d)
+
+    def test_run_concurrent_tasks_task_concurrency(self):
+        deck = self._deck_with_tasks([False, False, False, False], 3,
+                                     [None, 2, None, None])
+        d = deck.run(MagicMock())
+        # The second task only runs alongside one other task
+        self.assertEqual(self.started, [0, 1])
+        self.running[0].callback(None)
+        self.assertEqual(self.started, [0, 1, 2])
+        self.running[1].callback(None)
+        self.assertEqual(self.started, [0, 1, 2, 3])
+        self.running[2].callback(None)
+        self.running[3].callback(None)
+        self.successResultOf(d)
+
+    def test_run_ooni_task_id_collision(self):
+        deck = NGDeck()
+        deck.id = "deck"
+        deck._measurement_path = FilePath(self.mktemp())
+        deck._measurement_path.createDirectory()
+        start_times = ["2016-01-01 12:00:00", "2016-01-01 12:00:00",
+                       "2016-01-01 12:00:01"]
+        deck_task = MagicMock()
+        deck_task.output_path = None
+        deck_task.ooni["net_test_loader"].getTestDetails.side_effect = [
+            {'test_name': 'spam', 'test_start_time': start_time}
+            for start_time in start_times
+        ]
+        director = MagicMock()
+        director.start_net_test_loader.return_value = defer.Deferred()
+        clock = task.Clock()
+        with patch('ooni.deck.deck.reactor', clock), \
+                patch('ooni.deck.deck.measurement_catalogue'):
+            deck._run_ooni_task(deck_task, director)
+            first_id = deck_task.id
+            deck._run_ooni_task(deck_task, director)
+            self.assertEqual(deck_task.id, first_id)
+            clock.advance(1)
+        self.assertNotEqual(deck_task.id, first_id)
+        self.assertTrue(deck._measurement_path.child(deck_task.id).isdir())
+
+    def test_run_concurrent_tasks_failure(self):
+        deck = self._deck_with_tasks([False, False, False], 2)
+        d = deck.run(MagicMock())
+        self.running[0].errback(ValueError())
+        # No tasks are started after one has failed
+        self.assertEqual(self.started, [0, 1])
+        self.assertNoResult(d)
+        self.running[1].callback(None)
+        self.failureResultOf(d, ValueError)
@@ -1,5 +1,6 @@
 import os
 import shutil
+from mock import patch, MagicMock
 from twisted.internet import defer
 
 from ooni.tests import is_internet_connected, bases
@@ -45,3 +46,54 @@ class TestGeoIP(bases.ConfigTestCase):
         assert isinstance(version['GeoIPASNum']['timestamp'], float)
 
         shutil.rmtree(maxmind_dir)
+
+    def _write_databases(self, content="XXX"):
+        maxmind_dir = os.path.join(self.config.resources_directory,
+                                   'maxmind-geoip')
+        try:
+            os.mkdir(maxmind_dir)
+        except OSError:
+            pass
+        for filename in ('GeoIP.dat', 'GeoIPASNum.dat'):
+            with open(os.path.join(maxmind_dir, filename), 'w+') as f:
+                f.write(content)
+        return maxmind_dir
+
+    def test_geoip_databases_cache(self):
+        maxmind_dir = self._write_databases()
+        mock_geoip = MagicMock()
+        mock_geoip.return_value.country_code_by_addr.return_value = 'IT'
+        mock_geoip.return_value.org_by_addr.return_value = 'AS1234 Spam'
+        with patch('ooni.geoip.GeoIP', mock_geoip, create=True):
+            databases = geoip.GeoIPDatabases()
+            locations = databases.ips_to_locations(['1.1.1.1', '2.2.2.2'])
+            self.assertEqual(locations['1.1.1.1']['countrycode'], 'IT')
+            self.assertEqual(locations['2.2.2.2']['asn'], 'AS1234')
+            # The databases are opened only once
+            self.assertEqual(mock_geoip.call_count, 2)
+
+            databases.ip_to_location('1.1.1.1')
+            self.assertEqual(
+                mock_geoip.return_value.org_by_addr.call_count, 2)
+
+            # Changing the files on disk leads to them being re-opened
+            self._write_databases("XXXX")
+            databases.ip_to_location('3.3.3.3')
+            self.assertEqual(mock_geoip.call_count, 4)
+        shutil.rmtree(maxmind_dir)
+
+    def test_geoip_databases_lru(self):
+        maxmind_dir = self._write_databases()
+        mock_geoip = MagicMock()
+        mock_geoip.return_value.country_code_by_addr.return_value = None
+        mock_geoip.return_value.org_by_addr.return_value = None
+        with patch('ooni.geoip.GeoIP', mock_geoip, create=True):
+            databases = geoip.GeoIPDatabases()
+            databases.cache_size = 2
+            databases.ips_to_locations(['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+            self.assertEqual(list(databases._cache.keys()),
+                             ['2.2.2.2', '3.3.3.3'])
+            location = databases.ip_to_location('1.1.1.1')
+            self.assertEqual(location['countrycode'], 'ZZ')
+            self.assertEqual(location['asn'], 'AS0')
+        shutil.rmtree(maxmind_dir)
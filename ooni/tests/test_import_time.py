@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import subprocess
+
+from twisted.trial import unittest
+
+from ooni.settings import OONIPROBE_ROOT
+
+measure_import = """
+import sys
+import time
+import json
+
+start_time = time.time()
+__import__(sys.argv[1])
+print(json.dumps({
+    'runtime': time.time() - start_time,
+    'modules': [name for name, module in sys.modules.items()
+                if module is not None]
+}))
+"""
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Checks that the command line entry points start quickly, by not importing
+    the modules that only some of their subcommands need.
+    """
+    # How many seconds importing an entry point may take on a cold start
+    budget = 1.5
+    # The best of this many runs is compared to the budget
+    runs = 3
+
+    # parsley is used by the SOCKS client of txsocksx to compile its grammar
+    heavy_modules = ['scapy', 'txtorcon', 'parsley', 'GeoIP', 'pygeoip',
+                     'klein']
+
+    def measure(self, module_name):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(OONIPROBE_ROOT)] + sys.path
+        )
+        results = []
+        for _ in range(self.runs):
+            output = subprocess.check_output(
+                [sys.executable, '-W', 'ignore', '-c', measure_import,
+                 module_name],
+                env=env
+            )
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        return min(results, key=lambda result: result['runtime'])
+
+    def assertImportBudget(self, module_name):
+        result = self.measure(module_name)
+        imported = set(name.split('.')[0] for name in result['modules'])
+        self.assertEqual(imported.intersection(self.heavy_modules), set())
+        self.assertTrue(result['runtime'] < self.budget,
+                        "Importing %s took %.2fs (budget %.2fs)" % (
+                            module_name, result['runtime'], self.budget))
+
+    def test_ooniprobe(self):
+        # ooni.scripts.ooniprobe only imports the CLI once the reactor is
+        # running, so importing it alone would not tell us anything.
+        self.assertImportBudget('ooni.ui.cli')
+
+    def test_oonireport(self):
+        self.assertImportBudget('ooni.scripts.oonireport')
+
+    def test_ooniprobe_agent(self):
+        self.assertImportBudget('ooni.scripts.ooniprobe_agent')
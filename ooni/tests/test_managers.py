@@ -4,6 +4,7 @@ from twisted.trial import unittest
 from twisted.internet import defer, task
 
 from ooni.managers import MeasurementManager
+from ooni.tasks import BaseTask
 
 from ooni.tests.mocks import MockSuccessTask, MockFailTask, MockFailOnceTask, MockFailure
 from ooni.tests.mocks import MockSuccessTaskWithTimeout, MockFailTaskThatTimesOut
@@ -197,6 +198,83 @@ class TestTaskManager(unittest.TestCase):
         return d
 
 
+    def _pending_tasks(self, name, number):
+        class PendingTask(BaseTask):
+            def run(self):
+                started.append((name, self))
+                return self.result
+
+        started = self.started
+        tasks = []
+        for _ in range(number):
+            pending_task = PendingTask()
+            pending_task.result = defer.Deferred()
+            tasks.append(pending_task)
+        return iter(tasks)
+
+    def _finish(self, number):
+        running = [t for _, t in self.started if not t.result.called]
+        for pending_task in running[:number]:
+            pending_task.result.callback(42)
+
+    def test_schedule_fair_sharing(self):
+        self.started = []
+        self.measurementManager.concurrency = 2
+        self.measurementManager.schedule(self._pending_tasks('a', 10), key='a')
+        self.measurementManager.schedule(self._pending_tasks('b', 10), key='b')
+        self.assertEqual([name for name, _ in self.started], ['a', 'a'])
+        for _ in range(4):
+            self._finish(2)
+        # Once slots free up they are shared between the two queues
+        self.assertEqual([name for name, _ in self.started[2:]],
+                         ['b', 'a', 'b', 'a', 'b', 'a', 'b', 'a'])
+
+    def test_schedule_weight_and_concurrency(self):
+        self.started = []
+        self.measurementManager.concurrency = 3
+        self.measurementManager.schedule(self._pending_tasks('a', 10),
+                                         key='a', weight=2)
+        self.measurementManager.schedule(self._pending_tasks('b', 10),
+                                         key='b', concurrency=1)
+        stats = dict((q['key'], q) for q in
+                     self.measurementManager.queueStats())
+        self.assertEqual(stats['a']['active'], 3)
+        self.assertEqual(stats['a']['pending'], None)
+        self.assertEqual(stats['b']['active'], 0)
+
+        self._finish(3)
+        self.assertEqual([name for name, _ in self.started[3:]],
+                         ['b', 'a', 'a'])
+        self._finish(3)
+        # b never runs more than one task at once
+        self.assertEqual([name for name, _ in self.started[6:]],
+                         ['b', 'a', 'a'])
+        stats = dict((q['key'], q) for q in
+                     self.measurementManager.queueStats())
+        self.assertEqual(stats['a']['dispatched'], 7)
+        self.assertEqual(stats['b']['dispatched'], 2)
+
+    def test_schedule_pending(self):
+        self.started = []
+        self.measurementManager.concurrency = 2
+        self.measurementManager.schedule(self._pending_tasks('a', 5),
+                                         key='a', size=5)
+        self.measurementManager.schedule(list(self._pending_tasks('b', 3)),
+                                         key='b')
+        # a takes both slots before b is scheduled
+        stats = dict((q['key'], q) for q in
+                     self.measurementManager.queueStats())
+        self.assertEqual(stats['a']['pending'], 3)
+        self.assertEqual(stats['b']['pending'], 3)
+
+        # The freed slots are shared between the two queues
+        self._finish(2)
+        stats = dict((q['key'], q) for q in
+                     self.measurementManager.queueStats())
+        self.assertEqual(stats['a']['pending'], 2)
+        self.assertEqual(stats['b']['pending'], 2)
+
+
 class TestMeasurementManager(unittest.TestCase):
     def setUp(self):
         mock_director = MockDirector()
@@ -0,0 +1,188 @@
+import os
+import json
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from ooni.tests.bases import ConfigTestCase
+from ooni.measurements import MeasurementCatalogue, list_measurements
+from ooni.measurements import MeasurementSummary, generate_summary
+from ooni.measurements import recover_stale_report
+
+
+class TestMeasurementCatalogue(ConfigTestCase):
+    def setUp(self):
+        super(TestMeasurementCatalogue, self).setUp()
+        self.config.measurements_directory = tempfile.mkdtemp()
+        self.catalogue = MeasurementCatalogue()
+
+    def tearDown(self):
+        shutil.rmtree(self.config.measurements_directory)
+        if os.path.exists(self.catalogue.path):
+            os.remove(self.catalogue.path)
+        super(TestMeasurementCatalogue, self).tearDown()
+
+    def create_measurement(self, measurement_id, size=10):
+        measurement_dir = os.path.join(self.config.measurements_directory,
+                                       measurement_id)
+        os.mkdir(measurement_dir)
+        with open(os.path.join(measurement_dir, "measurements.njson"),
+                  "w") as out_file:
+            out_file.write("X" * size)
+        return measurement_dir
+
+    def test_list(self):
+        self.create_measurement("20160101T000000Z-ZZ-AS0-dummy", 10)
+        self.create_measurement("20160102T000000Z-ZZ-AS0-dummy-deck", 20)
+
+        measurements = self.catalogue.list(compute_size=True)
+        self.assertEqual(sorted(m['size'] for m in measurements), [10, 20])
+        self.assertTrue(os.path.exists(self.catalogue.path))
+
+        measurements = list_measurements(order='desc')
+        self.assertEqual([m['id'] for m in measurements],
+                         ["20160102T000000Z-ZZ-AS0-dummy-deck",
+                          "20160101T000000Z-ZZ-AS0-dummy"])
+        self.assertEqual(measurements[0]['deck_id'], 'deck')
+        self.assertEqual(measurements[0]['size'], -1)
+
+    def test_list_uses_catalogue(self):
+        measurement_dir = self.create_measurement(
+            "20160101T000000Z-ZZ-AS0-dummy")
+        self.catalogue.list()
+
+        # Changes not reported to the catalogue are not picked up...
+        with open(os.path.join(measurement_dir, "keep"), "w"):
+            pass
+        self.assertFalse(self.catalogue.list()[0]['keep'])
+
+        # ...until the catalogue is updated
+        self.catalogue.update("20160101T000000Z-ZZ-AS0-dummy")
+        self.assertTrue(self.catalogue.list()[0]['keep'])
+
+        self.catalogue.remove("20160101T000000Z-ZZ-AS0-dummy")
+        with open(self.catalogue.path) as in_file:
+            self.assertEqual(json.load(in_file)['measurements'], {})
+
+    def test_sync(self):
+        measurement_dir = self.create_measurement(
+            "20160101T000000Z-ZZ-AS0-dummy")
+        self.assertEqual(len(self.catalogue.list()), 1)
+
+        self.create_measurement("20160102T000000Z-ZZ-AS0-dummy")
+        self.assertEqual(len(self.catalogue.list()), 2)
+
+        shutil.rmtree(measurement_dir)
+        measurements = self.catalogue.list()
+        self.assertEqual([m['id'] for m in measurements],
+                         ["20160102T000000Z-ZZ-AS0-dummy"])
+
+    def test_repair_on_load(self):
+        measurement_dir = self.create_measurement(
+            "20160101T000000Z-ZZ-AS0-dummy")
+        self.catalogue.list()
+
+        with open(os.path.join(measurement_dir, "anomaly"), "w"):
+            pass
+        os.utime(measurement_dir, (0, 0))
+
+        catalogue = MeasurementCatalogue()
+        self.assertTrue(catalogue.list()[0]['anomaly'])
+
+    def test_in_progress(self):
+        measurement_dir = self.create_measurement(
+            "20160101T000000Z-ZZ-AS0-dummy")
+        with open(os.path.join(measurement_dir,
+                               "measurements.njson.progress"), "w"):
+            pass
+        with open(os.path.join(measurement_dir, "running.pid"), "w") as f:
+            f.write(str(os.getpid()))
+        self.assertTrue(self.catalogue.list()[0]['running'])
+
+        os.remove(os.path.join(measurement_dir, "running.pid"))
+        progress_path = os.path.join(measurement_dir,
+                                     "measurements.njson.progress")
+        with open(progress_path, "w") as out_file:
+            out_file.write('{"input": "spam"}\n{"inp')
+        measurement = self.catalogue.list()[0]
+        self.assertFalse(measurement['running'])
+        self.assertTrue(measurement['stale'])
+
+        # Listing the measurements does not touch the report
+        with open(progress_path) as in_file:
+            self.assertEqual(in_file.read(), '{"input": "spam"}\n{"inp')
+
+    def test_recover_stale_report(self):
+        measurement_dir = self.create_measurement(
+            "20160101T000000Z-ZZ-AS0-dummy")
+        progress_path = os.path.join(measurement_dir,
+                                     "measurements.njson.progress")
+        with open(progress_path, "w") as out_file:
+            out_file.write('{"input": "spam"}\n{"inp')
+        with open(os.path.join(measurement_dir, "running.pid"), "w") as f:
+            f.write(str(os.getpid()))
+
+        # The report of a running measurement is still being written
+        recover_stale_report(progress_path)
+        with open(progress_path) as in_file:
+            self.assertEqual(in_file.read(), '{"input": "spam"}\n{"inp')
+
+        # The entry that was being written when the probe stopped is removed
+        os.remove(os.path.join(measurement_dir, "running.pid"))
+        recover_stale_report(progress_path)
+        with open(progress_path) as in_file:
+            self.assertEqual(in_file.read(), '{"input": "spam"}\n')
+
+
+class TestGenerateSummary(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.directory, "measurements.njson")
+        self.output_file = os.path.join(self.directory, "summary.json")
+        self.anomaly_file = os.path.join(self.directory, "anomaly")
+        self.entries = [{
+            "test_name": "tcp_connect",
+            "test_start_time": "2016-01-01 00:00:00",
+            "probe_cc": "ZZ",
+            "probe_asn": "AS0",
+            "input": "10.0.0.%d:80" % idx,
+            "test_keys": {"connection": connection}
+        } for idx, connection in enumerate(["success", "success", "failed"])]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume(self):
+        summary = MeasurementSummary()
+        for entry in self.entries[:2]:
+            summary.add(entry)
+        summary.checkpoint(self.output_file + ".partial")
+
+        with open(self.input_file, "w") as out_file:
+            # The entries that were summarized already are not parsed again
+            out_file.write("{garbage\n{garbage\n")
+            out_file.write(json.dumps(self.entries[2]) + "\n")
+        results = generate_summary(self.input_file, self.output_file,
+                                   self.anomaly_file)
+
+        self.assertEqual([r['url'] for r in results['results']],
+                         [e['input'] for e in self.entries])
+        self.assertEqual([r['idx'] for r in results['results']], [0, 1, 2])
+        self.assertTrue(os.path.exists(self.anomaly_file))
+        self.assertFalse(os.path.exists(self.output_file + ".partial"))
+        with open(self.output_file) as in_file:
+            self.assertEqual(json.load(in_file), results)
+
+    def test_stale_checkpoint(self):
+        summary = MeasurementSummary()
+        for entry in self.entries:
+            summary.add(entry)
+        summary.checkpoint(self.output_file + ".partial")
+
+        with open(self.input_file, "w") as out_file:
+            out_file.write(json.dumps(self.entries[0]) + "\n")
+        results = generate_summary(self.input_file, self.output_file,
+                                   self.anomaly_file)
+        self.assertEqual(len(results['results']), 1)
+        self.assertFalse(os.path.exists(self.anomaly_file))
@@ -1,7 +1,10 @@
 import os
 import yaml
 import json
-from tempfile import mkstemp
+import shutil
+from tempfile import mkstemp, mkdtemp
+
+from mock import patch
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
@@ -10,6 +13,7 @@ from twisted.python.usage import UsageError
 from ooni.settings import config
 from ooni.errors import MissingRequiredOption, OONIUsageError, IncoherentOptions
 from ooni.nettest import NetTest, NetTestLoader
+from ooni.nettest import NetTestInformationCache, getNetTestInformation
 
 from ooni.director import Director
 
@@ -474,3 +478,40 @@ class TestNettestTimeout(ConfigTestCase):
             assert director.failedMeasurements == 1
 
         return d
+
+
+class TestNetTestInformationCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.net_test_file = os.path.join(self.directory, "dummy.py")
+        with open(self.net_test_file, "w") as out_file:
+            out_file.write(net_test_string)
+        self.cache_path = os.path.join(self.directory, "nettest_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch('ooni.nettest.getNetTestInformation', wraps=getNetTestInformation)
+    def test_cached(self, mock_get_information):
+        cache = NetTestInformationCache(self.cache_path)
+        information = cache.get(self.net_test_file)
+        self.assertEqual(information['id'], 'dummy')
+        self.assertIn('spam', information['arguments'])
+        self.assertEqual(cache.get(self.net_test_file), information)
+        cache.sync([self.net_test_file])
+        self.assertEqual(mock_get_information.call_count, 1)
+
+        # The net test is not imported again by other processes...
+        cache = NetTestInformationCache(self.cache_path)
+        self.assertEqual(cache.get(self.net_test_file), information)
+        self.assertEqual(mock_get_information.call_count, 1)
+
+        # ...until it changes
+        with open(self.net_test_file, "a") as out_file:
+            out_file.write("# changed\n")
+        cache.get(self.net_test_file)
+        self.assertEqual(mock_get_information.call_count, 2)
+
+        cache.sync([])
+        with open(self.cache_path) as in_file:
+            self.assertEqual(json.load(in_file), {})
@@ -91,3 +91,108 @@ class TestOONIReport(ConfigTestCase):
                 {"spam": "ham"}
             )
         return d
+
+    @defer.inlineCallbacks
+    def test_write_entries_window(self):
+        from ooni.scripts import oonireport
+        pending = []
+        mock_oonib_reporter = MagicMock()
+
+        def write_report_entry(entry):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+        mock_oonib_reporter.writeReportEntry.side_effect = write_report_entry
+
+        d = oonireport.write_entries(mock_oonib_reporter, iter(range(5)),
+                                     window=2)
+        self.assertEqual(len(pending), 2)
+        pending[0].callback(None)
+        self.assertEqual(len(pending), 3)
+        for p in pending[1:]:
+            p.callback(None)
+        pending[3].callback(None)
+        pending[4].callback(None)
+        yield d
+        self.assertEqual(mock_oonib_reporter.writeReportEntry.call_count, 5)
+
+    @patch('ooni.scripts.oonireport.CollectorClient')
+    @patch('ooni.scripts.oonireport.OONIBReportLog')
+    @patch('ooni.scripts.oonireport.OONIBReporter')
+    def test_tool_upload_resume(self, mock_oonib_reporter,
+                                mock_oonib_report_log, mock_collector_client):
+        import os
+        import shutil
+        import tempfile
+        from ooni.reporter import NJSONReporter
+        from .test_reporter import test_details
+
+        self.addCleanup(setattr, self.config, 'measurements_directory',
+                        self.config.measurements_directory)
+        self.config.measurements_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config.measurements_directory)
+        measurement_dir = os.path.join(self.config.measurements_directory,
+                                       '20160101T223311Z-ZZ-AS0-spam')
+        os.mkdir(measurement_dir)
+        report_path = os.path.join(measurement_dir, 'measurements.njson')
+        reporter = NJSONReporter(test_details, report_path)
+        reporter.createReport()
+        for idx in range(5):
+            reporter.writeReportEntry({'input': idx})
+        reporter.finish()
+
+        mock_oonib_reporter_i = mock_oonib_reporter.return_value
+        mock_oonib_reporter_i.resumeReport.return_value = "fake_id"
+        mock_oonib_reporter_i.writeReportEntry.return_value = defer.succeed(True)
+        mock_oonib_reporter_i.finish.return_value = defer.succeed(True)
+
+        mock_oonib_report_log_i = mock_oonib_report_log.return_value
+        mock_oonib_report_log_i.get_report_log.return_value = defer.succeed({
+            'status': 'incomplete',
+            'pid': 0,
+            'collector': {'address': 'httpo://thirteenchars123.onion'},
+            'upload': {
+                'report_id': 'fake_id',
+                'supported_formats': ['json'],
+                'supports_batch': False,
+                'entries': 3
+            }
+        })
+        mock_oonib_report_log_i.closed.return_value = defer.succeed(True)
+
+        from ooni.scripts import oonireport
+        d = oonireport.upload(report_path)
+        @d.addCallback
+        def cb(result):
+            self.assertFalse(mock_oonib_reporter_i.createReport.called)
+            self.assertEqual(
+                [c[0][0]['input'] for c in
+                 mock_oonib_reporter_i.writeReportEntry.call_args_list],
+                [3, 4]
+            )
+            self.assertTrue(mock_oonib_report_log_i.closed.called)
+        return d
+
+    @patch('ooni.scripts.oonireport.OONIBReportLog')
+    def test_upload_all_max_parallel(self, mock_oonib_report_log):
+        mock_oonib_report_log_i = mock_oonib_report_log.return_value
+        mock_oonib_report_log_i.get_to_upload.return_value = defer.succeed([
+            ("report-%d.njson" % idx, {'measurement_id': str(idx)})
+            for idx in range(3)
+        ])
+
+        pending = []
+        def upload(report_file, collector, bouncer, measurement_id):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        from ooni.scripts import oonireport
+        with patch('ooni.scripts.oonireport.upload', upload):
+            d = oonireport.upload_all(max_parallel=2)
+            self.assertEqual(len(pending), 2)
+            pending[0].callback(None)
+            self.assertEqual(len(pending), 3)
+            pending[1].callback(None)
+            pending[2].callback(None)
+        return d
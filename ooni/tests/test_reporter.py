@@ -5,13 +5,19 @@ import time
 import shutil
 import tempfile
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
+from mock import MagicMock
 
 from ooni.tests.bases import ConfigTestCase
 from ooni import errors as e
 from ooni.tests.mocks import MockCollectorClient
 from ooni.reporter import YAMLReporter, OONIBReporter, OONIBReportLog
+from ooni.reporter import NJSONReporter, SerializedEntry, UploadProgress
+from ooni.measurements import get_measurement_entries, MEASUREMENT_INDEX
+from ooni.measurements import measurement_catalogue, generate_summary
+from ooni.measurements import MeasurementSummary
+from ooni.utils.files import is_compressed, iter_lines
 
 
 
@@ -46,6 +52,14 @@ oonib_new_report_yaml_message = {
 }
 
 
+oonib_new_report_batch_message = {
+    'report_id': "20140129T202038Z_AS0_" + "A" * 50,
+    'backend_version': "1.0",
+    'supported_formats': ["yaml", "json"],
+    'supports_batch': True
+}
+
+
 oonib_generic_error_message = {
     'error': 'generic-error'
 }
@@ -71,12 +85,135 @@ class TestYAMLReporter(unittest.TestCase):
             assert all(x in entry for x in ['test_name', 'test_version'])
 
 
+class TestNJSONReporter(ConfigTestCase):
+    def setUp(self):
+        super(TestNJSONReporter, self).setUp()
+        self.measurement_id = '20160727T182604Z-ZZ-AS0-dummy'
+        self.config.measurements_directory = tempfile.mkdtemp()
+        self.measurement_dir = os.path.join(
+            self.config.measurements_directory,
+            self.measurement_id
+        )
+        os.mkdir(self.measurement_dir)
+        self.report_path = os.path.join(self.measurement_dir,
+                                        'measurements.njson')
+        self.index_path = os.path.join(self.measurement_dir,
+                                       MEASUREMENT_INDEX)
+
+    def tearDown(self):
+        shutil.rmtree(self.config.measurements_directory)
+        super(TestNJSONReporter, self).tearDown()
+
+    def _write_report(self, inputs, index_path=None, compress=False):
+        reporter = NJSONReporter(test_details, self.report_path, index_path,
+                                 compress)
+        reporter.createReport()
+        for idx in inputs:
+            reporter.writeReportEntry({'input': idx})
+        reporter.finish()
+
+    def test_get_measurement_entries(self):
+        self._write_report(range(5), self.index_path)
+        self.assertEqual(os.path.getsize(self.index_path), 5 * 8)
+
+        entries = get_measurement_entries(self.measurement_id, 3)
+        self.assertEqual([entry['input'] for entry in entries], [3])
+        entries = get_measurement_entries(self.measurement_id, 1, 3)
+        self.assertEqual([entry['input'] for entry in entries], [1, 2, 3])
+        entries = get_measurement_entries(self.measurement_id, 4, 10)
+        self.assertEqual([entry['input'] for entry in entries], [4])
+        self.assertEqual(get_measurement_entries(self.measurement_id, 5), [])
+
+    def test_get_compressed_measurement_entries(self):
+        self.addCleanup(setattr, self.config.advanced,
+                        'reporting_flush_entries',
+                        self.config.advanced.reporting_flush_entries)
+        self.config.advanced.reporting_flush_entries = 2
+        self._write_report(range(5), self.index_path, compress=True)
+        self.assertTrue(is_compressed(self.report_path))
+        self.assertEqual([json.loads(line)['input']
+                          for line in iter_lines(self.report_path)],
+                         range(5))
+
+        for _ in range(2):
+            entries = get_measurement_entries(self.measurement_id, 3)
+            self.assertEqual([entry['input'] for entry in entries], [3])
+            entries = get_measurement_entries(self.measurement_id, 1, 3)
+            self.assertEqual([entry['input'] for entry in entries],
+                             [1, 2, 3])
+            entries = get_measurement_entries(self.measurement_id, 4, 10)
+            self.assertEqual([entry['input'] for entry in entries], [4])
+            self.assertEqual(get_measurement_entries(self.measurement_id, 5),
+                             [])
+            # The index of a compressed file can also be rebuilt
+            os.remove(self.index_path)
+
+    def test_write_serialized_entry(self):
+        entry = SerializedEntry({'input': 'spam'}, test_details)
+        reporter = NJSONReporter(test_details, self.report_path)
+        reporter.createReport()
+        reporter.writeReportEntry(entry)
+        reporter.finish()
+
+        with open(self.report_path) as in_file:
+            self.assertEqual(in_file.read(), entry.json + "\n")
+        self.assertEqual(json.loads(entry.json)['id'], entry.id)
+
+    def test_summary_is_built_incrementally(self):
+        details = dict(test_details, test_name='tcp_connect')
+        summary = MeasurementSummary(details, 'deck')
+        reporter = NJSONReporter(details, self.report_path, summary=summary)
+        reporter.createReport()
+        for idx, connection in enumerate(['success', 'generic_timeout_error']):
+            reporter.writeReportEntry(SerializedEntry(
+                {'input': '10.0.0.%d:80' % idx, 'connection': connection},
+                details, summarize=True
+            ))
+        reporter.writeReportEntry({'input': '10.0.0.2:80',
+                                   'connection': 'success'})
+        reporter.finish()
+
+        summary_path = os.path.join(self.measurement_dir, 'summary.json')
+        anomaly_path = os.path.join(self.measurement_dir, 'anomaly')
+        results = summary.write(summary_path, anomaly_path)
+        self.assertEqual([r['idx'] for r in results['results']], [0, 1, 2])
+        self.assertEqual([r['anomaly'] for r in results['results']],
+                         [False, True, False])
+        self.assertTrue(os.path.exists(anomaly_path))
+
+        # It's the same summary that is generated from the measurements
+        os.remove(anomaly_path)
+        self.assertEqual(generate_summary(self.report_path, summary_path,
+                                          anomaly_path, 'deck'), results)
+        self.assertTrue(os.path.exists(anomaly_path))
+
+    def test_get_measurement_entries_builds_index(self):
+        self._write_report(range(3))
+        self.assertFalse(os.path.exists(self.index_path))
+
+        entries = get_measurement_entries(self.measurement_id, 2)
+        self.assertEqual([entry['input'] for entry in entries], [2])
+        self.assertEqual(os.path.getsize(self.index_path), 3 * 8)
+
+        # An index that does not match the measurements is rebuilt
+        self._write_report(range(4))
+        entries = get_measurement_entries(self.measurement_id, 3)
+        self.assertEqual([entry['input'] for entry in entries], [3])
+        self.assertEqual(os.path.getsize(self.index_path), 4 * 8)
+
+
 class TestOONIBReporter(unittest.TestCase):
 
     def setUp(self):
         self.mock_response = {}
-
-        def mockRequest(method, urn, genReceiver, *args, **kw):
+        self.requested_urns = []
+        self.request_bodies = []
+
+        def mockRequest(method, urn, genReceiver, bodyProducer=None, *args,
+                        **kw):
+            self.requested_urns.append(urn)
+            if bodyProducer is not None:
+                self.request_bodies.append(json.loads(bodyProducer.body))
             receiver = genReceiver(None, None)
             return defer.maybeDeferred(receiver.body_processor,
                                        json.dumps(self.mock_response))
@@ -109,6 +246,20 @@ class TestOONIBReporter(unittest.TestCase):
         req = {'content': 'something'}
         yield self.oonib_reporter.writeReportEntry(req)
 
+    @defer.inlineCallbacks
+    def test_write_serialized_entry(self):
+        self.mock_response = oonib_new_report_message
+        yield self.oonib_reporter.createReport()
+        entry = SerializedEntry({'input': 'spam', 'body': 'ham'},
+                                test_details)
+        yield self.oonib_reporter.writeReportEntry(entry)
+
+        content = self.request_bodies[-1]['content']
+        self.assertEqual(content['id'], entry.id)
+        self.assertEqual(content['input'], 'spam')
+        self.assertEqual(content['test_keys'], {'body': 'ham'})
+        self.assertEqual(content['test_name'], test_details['test_name'])
+
     @defer.inlineCallbacks
     def test_write_report_entry_in_yaml(self):
         self.mock_response = oonib_new_report_yaml_message
@@ -116,6 +267,69 @@ class TestOONIBReporter(unittest.TestCase):
         req = {'content': 'something'}
         yield self.oonib_reporter.writeReportEntry(req)
 
+    @defer.inlineCallbacks
+    def test_write_report_entries_in_batch(self):
+        self.mock_response = oonib_new_report_batch_message
+        yield self.oonib_reporter.createReport()
+        self.assertTrue(self.oonib_reporter.supportsBatch)
+        self.oonib_reporter.batchSize = 2
+
+        report_id = oonib_new_report_batch_message['report_id']
+        yield defer.DeferredList([
+            self.oonib_reporter.writeReportEntry({'content': 'spam'}),
+            self.oonib_reporter.writeReportEntry({'content': 'ham'})
+        ])
+        self.assertEqual(self.requested_urns[-1],
+                         '/report/%s/batch' % report_id)
+
+        d = self.oonib_reporter.writeReportEntry({'content': 'eggs'})
+        self.assertFalse(d.called)
+        yield self.oonib_reporter.finish()
+        self.assertTrue(d.called)
+        self.assertEqual(self.requested_urns[-2:], [
+            '/report/%s/batch' % report_id,
+            '/report/%s/close' % report_id
+        ])
+
+    @defer.inlineCallbacks
+    def test_write_report_entries_in_batch_failure(self):
+        self.mock_response = oonib_new_report_batch_message
+        yield self.oonib_reporter.createReport()
+
+        self.mock_response = oonib_generic_error_message
+        d = self.oonib_reporter.writeReportEntry({'content': 'spam'})
+        self.oonib_reporter.flush()
+        yield self.assertFailure(d, e.OONIBReportUpdateError)
+        self.flushLoggedErrors(e.OONIBError)
+
+class TestUploadProgress(unittest.TestCase):
+    def test_entries_written_out_of_order(self):
+        report_log = MagicMock()
+        report_log.created.return_value = defer.succeed(None)
+        report_log.incomplete.return_value = defer.succeed(None)
+        oonib_reporter = MagicMock()
+        oonib_reporter.reportId = 'fake_id'
+
+        clock = task.Clock()
+        progress = UploadProgress(report_log, 'dummy', {}, oonib_reporter,
+                                  _reactor=clock)
+        progress.entryWritten(1)
+        self.assertEqual(progress.entries, 0)
+        progress.entryWritten(0)
+        self.assertEqual(progress.entries, 2)
+        # The entries written together are saved once
+        clock.advance(0)
+        self.assertEqual(report_log.created.call_count, 1)
+        self.assertEqual(report_log.created.call_args[0][2]['entries'], 2)
+
+        progress.entryWritten(3)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        progress.save('incomplete')
+        progress.save('created')
+        self.assertEqual(report_log.incomplete.call_count, 2)
+        self.assertEqual(report_log.incomplete.call_args[0][2]['entries'], 2)
+
+
 class TestOONIBReportLog(ConfigTestCase):
 
     def setUp(self):
@@ -133,6 +347,8 @@ class TestOONIBReportLog(ConfigTestCase):
 
     def tearDown(self):
         shutil.rmtree(self.measurement_dir)
+        if os.path.exists(measurement_catalogue.path):
+            os.remove(measurement_catalogue.path)
         super(TestOONIBReportLog, self).tearDown()
 
     @defer.inlineCallbacks
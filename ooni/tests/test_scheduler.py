@@ -19,6 +19,7 @@ from ooni.deck.store import DeckStore, DEFAULT_DECKS
 from ooni.agent.scheduler import ScheduledTask, DidNotRun
 from ooni.agent.scheduler import FileSystemlockAndMutex
 from ooni.agent.scheduler import SchedulerService
+from ooni.measurements import measurement_catalogue
 
 class TestScheduler(unittest.TestCase):
     def test_scheduled_task(self):
@@ -124,6 +125,50 @@ class TestScheduler(unittest.TestCase):
 
         shutil.rmtree(lock_dir)
 
+    def test_scheduler_sleeps_until_due(self):
+        scheduler_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scheduler_directory)
+        dummy_clock = task.Clock()
+        class FakeDatetime(datetime):
+            @staticmethod
+            def utcnow():
+                return datetime(2000, 1, 1, 7, 0, 0) + \
+                       timedelta(seconds=dummy_clock.seconds())
+
+        runs = []
+        class DummyST(ScheduledTask):
+            def task(subself):
+                runs.append((subself.identifier, FakeDatetime.utcnow()))
+
+        with mock.patch('ooni.agent.scheduler.datetime', FakeDatetime):
+            scheduler_service = SchedulerService(director=None,
+                                                 _reactor=dummy_clock)
+            scheduler_service.running = 1
+            for identifier, schedule in [('hourly', '@hourly'),
+                                         ('daily', '@daily')]:
+                scheduled_task = DummyST(schedule, identifier,
+                                         scheduler_directory)
+                scheduled_task._smear_coef = 0
+                scheduler_service.schedule(scheduled_task)
+            scheduler_service._should_run()
+            self.assertEqual(len(runs), 2)
+
+            # The service sleeps until the hourly task is due
+            calls = dummy_clock.getDelayedCalls()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(calls[0].getTime(), 60 * 60)
+
+            with mock.patch.object(DummyST, 'last_run') as last_run:
+                dummy_clock.advance(60 * 60 - 1)
+                self.assertFalse(last_run.called)
+            dummy_clock.advance(1)
+            self.assertEqual(runs[-1], ('hourly', datetime(2000, 1, 1, 8)))
+            self.assertEqual(len(runs), 3)
+
+            scheduler_service.stopService()
+            self.assertEqual(dummy_clock.getDelayedCalls(), [])
+
+
 def random_measurement_name(start_date=None, end_date=None):
     # By default we use as start date something in the past 6 days and end
     # date today.
@@ -250,6 +295,8 @@ class TestSchedulerService(ConfigTestCase):
         super(TestSchedulerService, self).tearDown()
 
         shutil.rmtree(self.measurements_directory)
+        if os.path.exists(measurement_catalogue.path):
+            os.remove(measurement_catalogue.path)
         shutil.rmtree(self.scheduler_directory)
         shutil.rmtree(self.running_path)
 
@@ -317,9 +364,10 @@ class TestSchedulerService(ConfigTestCase):
                         self.assertEqual(in_file.read(), '2000-01-02T07:00:45Z')
                     elif t.schedule == '@hourly':
                         hourly += 1
-                        # `:[03]0Z` is caused by scheduler resolution & ticking one second a time
+                        # the tasks run at the smeared time, rounded up to
+                        # the next second as the clock ticks a second a time
                         last_run = in_file.read()
-                        self.assertRegexpMatches(last_run, '^2000-01-02T08:0.:[03]0Z$')
+                        self.assertRegexpMatches(last_run, '^2000-01-02T08:0.:..Z$')
                         if last_run == '2000-01-02T08:00:00Z':
                             zero += 1
             self.assertGreater(hourly, 0)
@@ -345,7 +393,6 @@ class TestSchedulerService(ConfigTestCase):
             dummy_clock.pump([random.uniform(0, 120) for i in xrange(6*60)])
             for t in scheduler_service._scheduled_tasks:
                 with open(os.path.join(self.scheduler_directory, t.identifier)) as in_file:
-                    # randomized clock kills 30s resolution of the scheduler
                     self.assertRegexpMatches(in_file.read(), '^2000-01-03T0[012]:..:..Z$')
             self.assertGreater(FakeDatetime.utcnow(), datetime(2000,1,3, 5,0,0)) # should be ~6:00
 
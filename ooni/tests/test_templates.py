@@ -24,8 +24,10 @@ class TestHTTPT(unittest.TestCase):
         factory = Site(r)
         self.port = reactor.listenTCP(8880, factory)
 
+    @defer.inlineCallbacks
     def tearDown(self):
-        self.port.stopListening()
+        yield httpt.HTTPTest.tearDownClass()
+        yield self.port.stopListening()
 
     @defer.inlineCallbacks
     def test_do_request(self):
@@ -38,6 +40,42 @@ class TestHTTPT(unittest.TestCase):
         assert 'request' in http_test.report['requests'][0]
         assert 'response' in http_test.report['requests'][0]
 
+    @defer.inlineCallbacks
+    def test_do_request_with_chunk_processor(self):
+        http_test = httpt.HTTPTest()
+        http_test.localOptions['socksproxy'] = None
+        http_test._setUp()
+        chunks = []
+        response = yield http_test.doRequest('http://localhost:8880/',
+                                             chunk_processor=chunks.append)
+        self.assertEqual(response.body, "GET")
+        self.assertEqual("".join(chunks), "GET")
+
+    @defer.inlineCallbacks
+    def test_do_request_with_max_body_length(self):
+        http_test = httpt.HTTPTest()
+        http_test.localOptions['socksproxy'] = None
+        http_test.maxBodyLength = 2
+        http_test._setUp()
+        response = yield http_test.doRequest('http://localhost:8880/')
+        self.assertEqual(response.body, "GE")
+
+    @defer.inlineCallbacks
+    def test_connections_are_reused(self):
+        http_test = httpt.HTTPTest()
+        http_test.localOptions['socksproxy'] = None
+        http_test._setUp()
+        yield http_test.doRequest('http://localhost:8880/')
+
+        http_test = httpt.HTTPTest()
+        http_test._setUp()
+        yield http_test.doRequest('http://localhost:8880/')
+
+        stats = http_test.agentFactory.getStats()
+        self.assertEqual(stats['direct']['misses'], 1)
+        self.assertEqual(stats['direct']['hits'], 1)
+        self.assertEqual(stats['direct']['open'], 1)
+
     @defer.inlineCallbacks
     def test_do_failing_request(self):
         http_test = httpt.HTTPTest()
@@ -88,3 +126,62 @@ class TestDNST(unittest.TestCase):
         dns_test._setUp()
         result = yield dns_test.performALookup('example.com', dns_server=('8.8.8.8', 53))
         self.assertEqual(result, ['93.184.216.34'])
+
+
+class TestDNSResolverRegistry(unittest.TestCase):
+    def setUp(self):
+        from twisted.names import server
+        from twisted.names.common import ResolverBase
+
+        queried = self.queried = []
+
+        class StaticResolver(ResolverBase):
+            def _lookup(self, name, cls, type, timeout):
+                queried.append(name)
+                answer = dns.RRHeader(name=name, type=dns.A,
+                                      payload=dns.Record_A(address='10.0.0.1'))
+                return defer.succeed(([answer], [], []))
+
+        factory = server.DNSServerFactory(clients=[StaticResolver()])
+        self.port = reactor.listenUDP(0, dns.DNSDatagramProtocol(factory),
+                                      interface='127.0.0.1')
+        self.dns_server = ('127.0.0.1', self.port.getHost().port)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield dnst.DNSTest.tearDownClass()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_queries_are_coalesced(self):
+        dns_tests = []
+        for _ in range(2):
+            dns_test = dnst.DNSTest()
+            dns_test._setUp()
+            dns_tests.append(dns_test)
+
+        results = yield defer.gatherResults([
+            dns_test.performALookup('example.com', self.dns_server)
+            for dns_test in dns_tests
+        ])
+        self.assertEqual(results, [['10.0.0.1'], ['10.0.0.1']])
+        self.assertEqual(self.queried, ['example.com'])
+        for dns_test in dns_tests:
+            self.assertEqual(len(dns_test.report['queries']), 1)
+
+        registry = dnst.DNSTest.resolverRegistry
+        self.assertEqual(registry.getStats(),
+                         {'queries': 2, 'coalesced': 1, 'resolvers': 1})
+
+    @defer.inlineCallbacks
+    def test_resolver_socket_is_reused(self):
+        dns_test = dnst.DNSTest()
+        dns_test._setUp()
+        yield dns_test.performALookup('a.example.com', self.dns_server)
+        resolver = dns_test.resolverRegistry.getResolver(self.dns_server)
+        protocol = resolver._protocol
+
+        yield dns_test.performALookup('b.example.com', self.dns_server)
+        self.assertIdentical(resolver._protocol, protocol)
+        self.assertNotEqual(protocol.transport, None)
+        self.assertEqual(self.queried, ['a.example.com', 'b.example.com'])
@@ -3,9 +3,14 @@ import tempfile
 from mock import patch
 
 from twisted.trial import unittest
+from twisted.internet import defer, task
 
 from ooni.utils import log, generate_filename, net
 from ooni.utils.files import human_size_to_bytes, directory_usage
+from ooni.utils.files import LineIndex, IndexedInputs
+from ooni.utils.files import BufferedWriter, truncate_partial_line
+from ooni.utils.files import compress_frame, iter_lines
+from ooni.utils.ratelimit import DestinationLimiter, destination_keys
 
 
 class TestUtils(unittest.TestCase):
@@ -79,6 +84,193 @@ class TestUtils(unittest.TestCase):
             out_file.write("A"*1000)
         self.assertEqual(directory_usage(tmp_dir), 1000*2)
 
+    def test_line_index(self):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as out_file:
+            out_file.write("# A comment\nspam\n\nham \n  eggs")
+        index = LineIndex(filename)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index[1], "ham")
+        self.assertEqual(index[2], "eggs")
+        index.close()
+
+        inputs = IndexedInputs(index)
+        self.assertEqual(len(inputs), 3)
+        self.assertEqual(list(inputs), ["spam", "ham", "eggs"])
+
+        inputs = IndexedInputs(index, shuffle=True)
+        self.assertEqual(sorted(inputs), ["eggs", "ham", "spam"])
+        os.remove(filename)
+
+    def test_line_index_weigh(self):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as out_file:
+            out_file.write("spam\nham\n")
+        index = LineIndex(filename, weigh=lambda line: 2)
+        inputs = IndexedInputs(index, process=lambda line: [line, line])
+        self.assertEqual(len(inputs), 4)
+        self.assertEqual(list(inputs), ["spam", "spam", "ham", "ham"])
+        os.remove(filename)
+
+    def test_line_index_empty_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        inputs = IndexedInputs(LineIndex(filename))
+        self.assertEqual(len(inputs), 0)
+        self.assertEqual(list(inputs), [])
+        os.remove(filename)
+
+    def test_buffered_writer(self):
+        clock = task.Clock()
+        clock.addSystemEventTrigger = lambda *args: None
+        clock.removeSystemEventTrigger = lambda *args: None
+        flushed = []
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        writer = BufferedWriter(filename, flush_entries=3, flush_interval=1,
+                                on_flush=lambda: flushed.append(True),
+                                _reactor=clock)
+        self.assertEqual(writer.write("spam\n"), 0)
+        self.assertEqual(writer.write("ham\n"), 5)
+        self.assertEqual(os.path.getsize(filename), 0)
+
+        # Flushed once the interval has passed...
+        clock.advance(1)
+        self.assertEqual(os.path.getsize(filename), 9)
+        self.assertEqual(len(flushed), 1)
+
+        # ...or once enough entries are buffered
+        for _ in range(3):
+            writer.write("eggs\n")
+        self.assertEqual(os.path.getsize(filename), 24)
+        self.assertEqual(len(flushed), 2)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+        writer.write("bacon\n")
+        writer.close()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        with open(filename) as in_file:
+            self.assertEqual(in_file.read(),
+                             "spam\nham\neggs\neggs\neggs\nbacon\n")
+        os.remove(filename)
+
+    def test_truncate_partial_line(self):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as out_file:
+            out_file.write("spam\nham\n{\"eg")
+        self.assertEqual(truncate_partial_line(filename), 4)
+        self.assertEqual(truncate_partial_line(filename), 0)
+        with open(filename) as in_file:
+            self.assertEqual(in_file.read(), "spam\nham\n")
+
+        with open(filename, "w") as out_file:
+            out_file.write("x" * 5000)
+        self.assertEqual(truncate_partial_line(filename), 5000)
+        self.assertEqual(os.path.getsize(filename), 0)
+        os.remove(filename)
+
+    def test_compressed_frames(self):
+        fd, filename = tempfile.mkstemp()
+        frames = [compress_frame("spam\nham\n"), compress_frame("eggs\n")]
+        with os.fdopen(fd, "w") as out_file:
+            out_file.write(''.join(frames))
+            # A frame the probe did not finish writing
+            out_file.write(compress_frame("bacon\n")[:-4])
+        self.assertEqual(list(iter_lines(filename)),
+                         ["spam\n", "ham\n", "eggs\n"])
+        self.assertEqual(truncate_partial_line(filename),
+                         len(compress_frame("bacon\n")) - 4)
+        self.assertEqual(os.path.getsize(filename), len(''.join(frames)))
+        os.remove(filename)
+
+    def test_body_receiver(self):
+        finished = defer.Deferred()
+        chunks = []
+        receiver = net.BodyReceiver(finished, content_length=9,
+                                    body_processor=lambda body: body.upper(),
+                                    chunk_processor=chunks.append)
+        for chunk in ("spa", "mha", "m"):
+            receiver.dataReceived(chunk)
+        receiver.connectionLost(None)
+        self.assertEqual(self.successResultOf(finished), "SPAMHAM")
+        self.assertEqual(chunks, ["spa", "mha", "m"])
+        self.assertEqual(receiver.bytes_remaining, 2)
+        self.assertFalse(receiver.truncated)
+
+    def test_body_receiver_max_body_length(self):
+        class FakeTransport(object):
+            stopped = False
+            def stopProducing(self):
+                self.stopped = True
+
+        finished = defer.Deferred()
+        receiver = net.BodyReceiver(finished, max_body_length=5)
+        receiver.makeConnection(FakeTransport())
+        receiver.dataReceived("spam")
+        receiver.dataReceived("ham")
+        receiver.dataReceived("eggs")
+        receiver.connectionLost(None)
+        receiver.connectionLost(None)
+        self.assertEqual(self.successResultOf(finished), "spamh")
+        self.assertTrue(receiver.truncated)
+        self.assertTrue(receiver.transport.stopped)
+
+class TestDestinationLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pending = []
+
+    def operation(self, name):
+        d = defer.Deferred()
+        self.pending.append((name, d))
+        return d
+
+    def test_destination_keys(self):
+        self.assertEqual(destination_keys("Example.com", "127.0.0.1", None),
+                         ["host:example.com", "ip:127.0.0.1"])
+
+    def test_max_in_flight(self):
+        limiter = DestinationLimiter(max_in_flight=2, rate=0,
+                                     _reactor=self.clock,
+                                     _time=self.clock.seconds)
+        results = [limiter.run(["ip:127.0.0.1"], self.operation, idx)
+                   for idx in range(3)]
+        results.append(limiter.run(["ip:127.0.0.2"], self.operation, 3))
+        self.assertEqual([name for name, _ in self.pending], [0, 1, 3])
+
+        self.pending[0][1].callback("spam")
+        self.assertEqual(self.successResultOf(results[0]), "spam")
+        self.assertEqual([name for name, _ in self.pending], [0, 1, 3, 2])
+        self.assertEqual(limiter.stats()["ip:127.0.0.1"],
+                         {"in_flight": 2, "waiting": 0})
+
+        for _, d in self.pending[1:]:
+            d.errback(ValueError())
+        for result in results[1:]:
+            self.failureResultOf(result, ValueError)
+        self.assertEqual(limiter.stats(), {})
+
+    def test_rate(self):
+        limiter = DestinationLimiter(max_in_flight=0, rate=2, burst=2,
+                                     _reactor=self.clock,
+                                     _time=self.clock.seconds)
+        for idx in range(5):
+            limiter.run(["host:example.com"], self.operation, idx)
+        self.assertEqual(len(self.pending), 2)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.pending), 3)
+        self.clock.advance(1)
+        self.assertEqual(len(self.pending), 5)
+
+    def test_disabled(self):
+        limiter = DestinationLimiter(max_in_flight=0, rate=0)
+        for idx in range(5):
+            limiter.run(["host:example.com"], self.operation, idx)
+        self.assertEqual(len(self.pending), 5)
+        self.assertEqual(limiter.stats(), {})
+
+
 class LoggingTests(unittest.TestCase):
     def setUp(self):
         self.dir = self.mktemp()
@@ -124,3 +316,30 @@ class LoggingTests(unittest.TestCase):
                 len(in_file.readlines()),
                 2
             )
+
+    @patch('ooni.settings.config')
+    def test_disabled_levels_are_not_formatted(self, mock_config):
+        mock_config.basic.loglevel = 'INFO'
+        mock_config.advanced.debug = False
+        mock_config.basic.rotate = None
+
+        formatted = []
+        class Spam(object):
+            def __str__(self):
+                formatted.append(self)
+                return "spam"
+
+        ooni_logger = log.OONILogger()
+        ooni_logger.debug("%s", Spam())
+        self.assertEqual(len(formatted), 1)
+
+        ooni_logger.start(logfile=self.path)
+        self.assertFalse(ooni_logger.isEnabledFor(log.levels['DEBUG']))
+        with patch('ooni.utils.log.tw_log') as mock_tw_log:
+            ooni_logger.debug("%s", Spam())
+            self.assertFalse(mock_tw_log.msg.called)
+            ooni_logger.msg("%s and %d%%", Spam(), 100)
+        ooni_logger.stop()
+        self.assertEqual(len(formatted), 2)
+        mock_tw_log.msg.assert_called_once_with(
+            "spam and 100%", log_level=log.levels['INFO'], source="ooni")
@@ -25,6 +25,7 @@ from ooni.settings import config
 from ooni.utils import log
 from ooni.director import DirectorEvent
 from ooni.measurements import get_summary, get_measurement, list_measurements
+from ooni.measurements import get_measurement_entries, measurement_catalogue
 from ooni.measurements import MeasurementNotFound, MeasurementInProgress
 from ooni.geoip import probe_ip
 
@@ -150,6 +151,8 @@ class WebUIAPI(object):
     _long_polling_timeout = 30
     _reactor = reactor
     _enable_xsrf_protection = True
+    # Maximum number of measurement entries returned in a single page.
+    _page_size = 100
 
     def __init__(self, config, director, scheduler, _reactor=reactor):
         self._reactor = reactor
@@ -578,6 +581,8 @@ class WebUIAPI(object):
             measurement_dir.remove()
         except:
             raise WebUIError(400, "Failed to delete report")
+        finally:
+            measurement_catalogue.update(measurement_id)
 
         return self.render_json({"result": "ok"}, request)
 
@@ -593,6 +598,7 @@ class WebUIAPI(object):
         summary = measurement_dir.child("keep")
         with summary.open("w+") as f:
             pass
+        measurement_catalogue.update(measurement_id)
 
         return self.render_json({"status": "ok"}, request)
 
@@ -602,23 +608,41 @@ class WebUIAPI(object):
     @requires_true(attrs=['_is_initialized'])
     def api_measurement_view(self, request, measurement_id, idx):
         try:
-            measurement_dir = self.measurement_path.child(measurement_id)
+            entries = get_measurement_entries(measurement_id, idx)
+        except InsecurePath:
+            raise WebUIError(500, "Invalid measurement id")
+        except MeasurementNotFound:
+            raise WebUIError(404, "measurement not found")
+
+        if not entries:
+            raise WebUIError(404, "Could not find measurement with this idx")
+        return self.render_json(entries[0], request)
+
+    @app.route('/api/measurement/<string:measurement_id>/entries',
+               methods=["GET"])
+    @xsrf_protect(check=False)
+    @requires_true(attrs=['_is_initialized'])
+    def api_measurement_entries(self, request, measurement_id):
+        try:
+            start = int(request.args.get('start', [0])[0])
+            count = int(request.args.get('count', [self._page_size])[0])
+        except ValueError:
+            raise WebUIError(400, "start and count must be integers")
+        if start < 0 or count < 0:
+            raise WebUIError(400, "start and count must be positive")
+        count = min(count, self._page_size)
+
+        try:
+            entries = get_measurement_entries(measurement_id, start, count)
         except InsecurePath:
             raise WebUIError(500, "Invalid measurement id")
+        except MeasurementNotFound:
+            raise WebUIError(404, "measurement not found")
 
-        measurements = measurement_dir.child("measurements.njson")
-
-        # This gets the line idx of the measurement file.
-        # XXX maybe implement some caching here
-        with measurements.open("r") as f:
-            r = None
-            for f_idx, line in enumerate(f):
-                if f_idx == idx:
-                    r = json.loads(line)
-                    break
-            if r is None:
-                raise WebUIError(404, "Could not find measurement with this idx")
-        return self.render_json(r, request)
+        return self.render_json({
+            "start": start,
+            "entries": entries
+        }, request)
 
     @app.route('/api/logs',
                methods=["GET"])
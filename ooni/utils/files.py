@@ -1,5 +1,13 @@
 import os
 import re
+import mmap
+import zlib
+import random
+
+from array import array
+
+from twisted.internet import reactor
+from twisted.python.util import untilConcludes
 
 HUMAN_SIZE = re.compile("(\d+\.?\d*G)|(\d+\.?\d*M)|(\d+\.?\d*K)|(\d+\.?\d*)")
 
@@ -32,3 +40,317 @@ def directory_usage(path):
             fp = os.path.join(root, filename)
             total_usage += os.path.getsize(fp)
     return total_usage
+
+
+def default_line_weight(line):
+    """
+    The default weigh function of a LineIndex. It skips empty lines and
+    comment lines and counts every other line as one input.
+    """
+    if not line or line.startswith('#'):
+        return 0
+    return 1
+
+
+class LineIndex(object):
+    """
+    A compact index of the offsets of the lines of a file.
+
+    The index is built with a single pass over the file. Lines are then read
+    lazily through a memory map of the file, so that we never have to keep
+    the content of large input files in memory.
+
+    Every line is passed (stripped) to the weigh function that returns how
+    many inputs the line will produce. Lines weighing 0 are not indexed.
+    """
+    def __init__(self, filename, weigh=default_line_weight):
+        self.filename = filename
+        self.total = 0
+
+        self._offsets = array('L')
+        self._fh = None
+        self._mmap = None
+
+        offset = 0
+        with open(filename, 'rb') as fh:
+            for line in fh:
+                weight = weigh(line.strip())
+                if weight > 0:
+                    self._offsets.append(offset)
+                    self.total += weight
+                offset += len(line)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, idx):
+        return self.readLine(self._offsets[idx])
+
+    def _open(self):
+        if self._mmap is not None:
+            return
+        self._fh = open(self.filename, 'rb')
+        self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def readLine(self, offset):
+        self._open()
+        end = self._mmap.find('\n', offset)
+        if end == -1:
+            end = self._mmap.size()
+        return self._mmap[offset:end].strip()
+
+    def offsets(self, shuffle=False):
+        """
+        Returns the offsets of the indexed lines. When shuffle is True they
+        are returned in a random order.
+        """
+        if not shuffle:
+            return self._offsets
+        offsets = array('L', self._offsets)
+        random.shuffle(offsets)
+        return offsets
+
+
+class IndexedInputs(object):
+    """
+    Lazily iterates over the lines of a LineIndex, optionally in a random
+    order.
+
+    When a process function is given, it is called with every line and must
+    return a list of the inputs the line produces. The number of inputs it
+    returns must match the weight given to the line when indexing it.
+    """
+    def __init__(self, index, process=None, shuffle=False):
+        self.index = index
+        self.process = process
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return self.index.total
+
+    def __iter__(self):
+        # An empty file cannot be memory mapped
+        if len(self.index) == 0:
+            return
+        try:
+            for offset in self.index.offsets(self.shuffle):
+                line = self.index.readLine(offset)
+                if self.process is None:
+                    yield line
+                    continue
+                for item in self.process(line):
+                    yield item
+        finally:
+            self.index.close()
+
+
+# Compressed files are made of a sequence of independent gzip members
+# (frames), each one holding a group of whole lines. This means they can be
+# appended to cheaply and are still valid gzip files.
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def compress_frame(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_frame(in_file):
+    """
+    Reads the frame starting at the current position of in_file and returns
+    its uncompressed data, leaving in_file at the start of the next frame.
+
+    Returns None if there are no more frames or the frame is truncated.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = []
+    while True:
+        chunk = in_file.read(8192)
+        if not chunk:
+            # Once the end of a frame is reached anything else that is fed
+            # to the decompressor ends up in unused_data.
+            decompressor.decompress('\0')
+            if decompressor.unused_data != '\0':
+                return None
+            return ''.join(data)
+        try:
+            data.append(decompressor.decompress(chunk))
+        except zlib.error:
+            return None
+        if decompressor.unused_data:
+            in_file.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+            return ''.join(data)
+
+
+def iter_frames(in_file):
+    """
+    Yields the offset and the uncompressed data of every complete frame of
+    in_file, starting from its current position.
+    """
+    while True:
+        offset = in_file.tell()
+        data = read_frame(in_file)
+        if data is None:
+            return
+        yield offset, data
+
+
+def is_compressed(path):
+    with open(path, 'rb') as in_file:
+        return in_file.read(2) == GZIP_MAGIC
+
+
+def iter_lines(path):
+    """
+    Yields, without reading the whole file into memory, the lines of the
+    file at path, which can either be a plain or a compressed file.
+    """
+    with open(path, 'rb') as in_file:
+        if in_file.read(2) != GZIP_MAGIC:
+            in_file.seek(0)
+            for line in in_file:
+                yield line
+            return
+        in_file.seek(0)
+        for _, data in iter_frames(in_file):
+            for line in data.splitlines(True):
+                yield line
+
+
+def truncate_partial_line(path):
+    """
+    Truncates the file at path after its last complete line, getting rid of
+    the partially written line that a crash may have left at its end. Files
+    that are compressed are truncated after their last complete frame.
+
+    Returns the number of bytes that were removed.
+    """
+    if is_compressed(path):
+        with open(path, 'r+b') as f:
+            end = 0
+            for _ in iter_frames(f):
+                end = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if end != size:
+                f.truncate(end)
+            return size - end
+
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        end = size
+        while end > 0:
+            chunk_start = max(end - 4096, 0)
+            f.seek(chunk_start)
+            chunk = f.read(end - chunk_start)
+            newline = chunk.rfind('\n')
+            if newline != -1:
+                end = chunk_start + newline + 1
+                break
+            end = chunk_start
+        if end != size:
+            f.truncate(end)
+        return size - end
+
+
+class BufferedWriter(object):
+    """
+    Writes data to a file in groups, instead of flushing it on every write.
+
+    The buffered data is written to the file every flush_entries writes or
+    flush_interval seconds after the first buffered write, whichever comes
+    first. If neither is set every write goes to the file right away.
+
+    fsync controls when the data is also synced to the disk and can be one
+    of "never", "close" or "flush" (every time the data is written).
+
+    on_flush is called after every time the buffered data is written.
+
+    If compress is True every group of writes is written as a compressed
+    frame (see read_frame) and write returns the offset of the frame.
+
+    Whatever is buffered is also written when the reactor shuts down.
+    """
+    def __init__(self, path, mode='w', flush_entries=None,
+                 flush_interval=None, fsync="close", on_flush=None,
+                 compress=False, _reactor=reactor):
+        self.path = path
+        self.compress = compress
+        self.flushEntries = flush_entries
+        self.flushInterval = flush_interval
+        self.fsync = fsync
+        self.onFlush = on_flush
+        self._reactor = _reactor
+
+        self._stream = open(path, mode)
+        self._stream.seek(0, os.SEEK_END)
+        self._offset = self._stream.tell()
+        self._buffer = []
+        self._flushCall = None
+        self._shutdownTrigger = self._reactor.addSystemEventTrigger(
+            'before', 'shutdown', self.flush)
+
+    @property
+    def closed(self):
+        return self._stream.closed
+
+    def write(self, data):
+        """
+        Buffers data and returns the offset in the file it will be written
+        at.
+        """
+        offset = self._offset
+        self._buffer.append(data)
+        if not self.compress:
+            self._offset += len(data)
+        if self.flushEntries and len(self._buffer) >= self.flushEntries:
+            self.flush()
+        elif self.flushInterval:
+            if self._flushCall is None:
+                self._flushCall = self._reactor.callLater(self.flushInterval,
+                                                          self.flush)
+        elif not self.flushEntries:
+            self.flush()
+        return offset
+
+    def _sync(self):
+        untilConcludes(os.fsync, self._stream.fileno())
+
+    def flush(self):
+        if self._stream.closed:
+            return
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if not self._buffer:
+            return
+
+        data, self._buffer = ''.join(self._buffer), []
+        if self.compress:
+            data = compress_frame(data)
+            self._offset += len(data)
+        self._stream.write(data)
+        untilConcludes(self._stream.flush)
+        if self.fsync == "flush":
+            self._sync()
+        if self.onFlush is not None:
+            self.onFlush()
+
+    def close(self):
+        if self._stream.closed:
+            return
+        self.flush()
+        if self.fsync in ("close", "flush"):
+            self._sync()
+        self._stream.close()
+        self._reactor.removeSystemEventTrigger(self._shutdownTrigger)
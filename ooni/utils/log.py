@@ -136,24 +136,42 @@ class MsecLogObserver(LogLevelObserver):
             tzSign, tzHour, tzMin)
 
 class OONILogger(object):
+    def __init__(self):
+        # The lowest level emitted by the observers added by start(). Until
+        # then it's None and every message is passed on to twisted, as there
+        # is no telling which observers are listening.
+        self.log_level = None
+
+    def isEnabledFor(self, level):
+        """
+        Returns True if messages of the given level would be emitted, so that
+        callers can skip building expensive messages that would be dropped.
+        """
+        return self.log_level is None or level >= self.log_level
+
+    def _log(self, level, msg, args, prefix=""):
+        # Check the level before doing any work, debug messages are logged
+        # in the hot paths and are usually dropped.
+        if not self.isEnabledFor(level):
+            return
+        if args:
+            msg = msg % args
+        tw_log.msg(prefix + log_encode(msg), log_level=level, source="ooni")
+
     def msg(self, msg, *arg, **kw):
-        text = log_encode(msg)
-        tw_log.msg(text, log_level=levels['INFO'], source="ooni")
+        self._log(levels['INFO'], msg, arg)
 
     def debug(self, msg, *arg, **kw):
-        text = log_encode(msg)
-        tw_log.msg(text, log_level=levels['DEBUG'], source="ooni")
+        self._log(levels['DEBUG'], msg, arg)
 
     def err(self, msg, *arg, **kw):
         if isinstance(msg, str) or isinstance(msg, unicode):
-            text = "[!] " + log_encode(msg)
-            tw_log.msg(text, log_level=levels['ERROR'], source="ooni")
+            self._log(levels['ERROR'], msg, arg, prefix="[!] ")
         else:
             tw_log.err(msg, source="ooni")
 
     def warn(self, msg, *arg, **kw):
-        text = log_encode(msg)
-        tw_log.msg(text, log_level=levels['WARNING'], source="ooni")
+        self._log(levels['WARNING'], msg, arg)
 
     def exception(self, error):
         """
@@ -204,12 +222,14 @@ class OONILogger(object):
 
         tw_log.startLoggingWithObserver(self.fileObserver.emit)
         tw_log.addObserver(self.stdoutObserver.emit)
+        self.log_level = min(file_log_level, stdout_log_level)
 
         tw_log.msg("Starting %s on %s (%s UTC)" % (application_name,
                                                    otime.prettyDateNow(),
                                                    otime.prettyDateNowUTC()))
 
     def stop(self):
+        self.log_level = None
         self.stdoutObserver.stop()
         self.fileObserver.stop()
 
@@ -225,3 +245,4 @@ debug = oonilogger.debug
 err = oonilogger.err
 warn = oonilogger.warn
 exception = oonilogger.exception
+isEnabledFor = oonilogger.isEnabledFor
@@ -7,8 +7,6 @@ from twisted.internet import defer
 from twisted.internet.protocol import Factory, Protocol
 from twisted.web.iweb import IBodyProducer
 
-from scapy.config import conf
-
 from ooni.errors import IfaceError
 
 # This is our own connectProtocol to avoid noisy twisted cluttering our logs
@@ -99,21 +97,63 @@ class StringProducer(object):
 
 
 class BodyReceiver(Protocol):
-    def __init__(self, finished, content_length=None, body_processor=None):
+    """
+    Collects the body of an HTTP response and fires ``finished`` with it.
+
+    The received chunks are accumulated in a list and joined only once the
+    body is complete, so that receiving a large body does not lead to
+    quadratic string concatenation.
+
+    Args:
+
+        finished (Deferred): fired with the (optionally processed) body.
+
+        content_length (int): the expected length of the body, if known.
+
+        body_processor (func): called with the complete body, its return
+            value is what ``finished`` is fired with.
+
+        max_body_length (int): if set, stop reading the body once this many
+            bytes have been received. The body will be truncated to this
+            length and ``truncated`` will be set to True.
+
+        chunk_processor (func): called with every chunk of the body as it
+            arrives, to allow parsing the body incrementally.
+    """
+    def __init__(self, finished, content_length=None, body_processor=None,
+                 max_body_length=None, chunk_processor=None):
         self.finished = finished
         self.data = ""
+        self.chunks = []
+        self.bytes_received = 0
         self.bytes_remaining = content_length
         self.body_processor = body_processor
+        self.chunk_processor = chunk_processor
+        self.max_body_length = max_body_length
+        self.truncated = False
 
     def dataReceived(self, b):
-        self.data += b
-        if self.bytes_remaining:
-            if self.bytes_remaining == 0:
-                self.connectionLost(None)
-            else:
-                self.bytes_remaining -= len(b)
+        if self.truncated:
+            return
+        if self.max_body_length is not None:
+            available = self.max_body_length - self.bytes_received
+            if len(b) > available:
+                b = b[:available]
+                self.truncated = True
+        self.chunks.append(b)
+        self.bytes_received += len(b)
+        if self.bytes_remaining is not None:
+            self.bytes_remaining -= len(b)
+        if self.chunk_processor:
+            self.chunk_processor(b)
+        if self.truncated and self.transport is not None:
+            self.transport.stopProducing()
 
     def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        self.data = "".join(self.chunks)
+        self.chunks = [self.data]
         try:
             if self.body_processor:
                 self.data = self.body_processor(self.data)
@@ -123,21 +163,25 @@ class BodyReceiver(Protocol):
 
 
 class Downloader(Protocol):
+    """
+    Writes the body of an HTTP response to ``download_path`` as it arrives.
+    """
     def __init__(self, download_path,
                  finished, content_length=None):
         self.finished = finished
+        self.bytes_received = 0
         self.bytes_remaining = content_length
         self.fp = open(download_path, 'w+')
 
     def dataReceived(self, b):
         self.fp.write(b)
-        if self.bytes_remaining:
-            if self.bytes_remaining == 0:
-                self.connectionLost(None)
-            else:
-                self.bytes_remaining -= len(b)
+        self.bytes_received += len(b)
+        if self.bytes_remaining is not None:
+            self.bytes_remaining -= len(b)
 
     def connectionLost(self, reason):
+        if self.finished.called:
+            return
         self.fp.flush()
         self.fp.close()
         self.finished.callback(None)
@@ -174,6 +218,8 @@ def randomFreePort(addr="127.0.0.1"):
 
 def getDefaultIface():
     """ Return the default interface or raise IfaceError """
+    from scapy.config import conf
+
     iface = conf.route.route('0.0.0.0', verbose=0)[0]
     if len(iface) > 0:
         return iface
@@ -0,0 +1,194 @@
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+
+from ooni.settings import config
+
+
+def destination_keys(*hosts):
+    """
+    Returns the keys identifying the destinations reached when connecting to
+    the specified hosts, which can be either hostnames or IP addresses.
+    """
+    keys = set()
+    for host in hosts:
+        if not host:
+            continue
+        if isIPAddress(host) or isIPv6Address(host):
+            keys.add("ip:" + host)
+        else:
+            keys.add("host:" + host.lower())
+    return sorted(keys)
+
+
+class _Destination(object):
+    def __init__(self, tokens, now):
+        self.in_flight = 0
+        self.waiting = deque()
+        self.tokens = tokens
+        self.last_refill = now
+        self.call = None
+
+
+class DestinationLimiter(object):
+    """
+    Limits how many operations can be in flight at the same time towards the
+    same destination and, optionally, the rate at which they are started.
+
+    The rate is enforced with a token bucket holding at most burst tokens
+    that refills at rate tokens per second.
+
+    If they are not set, the limits are read from the advanced section of
+    ooniprobe.conf (destination_concurrency, destination_rate and
+    destination_burst).
+    """
+    # Destinations that are rate limited are remembered until their bucket
+    # is full again, every this many destinations the ones that are full are
+    # forgotten.
+    maxDestinations = 1024
+
+    def __init__(self, max_in_flight=None, rate=None, burst=None,
+                 _reactor=reactor, _time=time.time):
+        self._max_in_flight = max_in_flight
+        self._rate = rate
+        self._burst = burst
+        self._reactor = _reactor
+        self._time = _time
+        self._destinations = {}
+
+    @property
+    def maxInFlight(self):
+        if self._max_in_flight is not None:
+            return self._max_in_flight
+        return config.advanced.get('destination_concurrency', None)
+
+    @property
+    def rate(self):
+        if self._rate is not None:
+            return self._rate
+        return config.advanced.get('destination_rate', None)
+
+    @property
+    def burst(self):
+        if self._burst is not None:
+            return self._burst
+        return config.advanced.get('destination_burst', None) or 1
+
+    @property
+    def enabled(self):
+        return bool(self.maxInFlight or self.rate)
+
+    def _refill(self, destination):
+        now = self._time()
+        destination.tokens = min(
+            self.burst,
+            destination.tokens + (now - destination.last_refill) * self.rate
+        )
+        destination.last_refill = now
+
+    def _process(self, key):
+        destination = self._destinations[key]
+        destination.call = None
+        max_in_flight = self.maxInFlight
+        while destination.waiting:
+            if max_in_flight and destination.in_flight >= max_in_flight:
+                break
+            if self.rate:
+                self._refill(destination)
+                if destination.tokens < 1:
+                    delay = (1 - destination.tokens) / self.rate
+                    destination.call = self._reactor.callLater(
+                        delay, self._process, key)
+                    break
+                destination.tokens -= 1
+            destination.in_flight += 1
+            destination.waiting.popleft().callback(None)
+
+        # Firing a waiting deferred may have led to this destination being
+        # processed, and forgotten, already.
+        if (self._destinations.get(key) is destination and
+                self._isIdle(destination)):
+            del self._destinations[key]
+
+    def _isIdle(self, destination):
+        """
+        A destination is idle, and can be forgotten, when nothing is in flight
+        or waiting and its bucket is full again.
+        """
+        if (destination.in_flight > 0 or destination.waiting or
+                destination.call is not None):
+            return False
+        if self.rate:
+            self._refill(destination)
+            return destination.tokens >= self.burst
+        return True
+
+    def _purge(self):
+        for key, destination in self._destinations.items():
+            if self._isIdle(destination):
+                del self._destinations[key]
+
+    def acquire(self, key):
+        """
+        Returns a deferred that fires once an operation towards the
+        destination identified by key can be started. release() must be
+        called once the operation is done.
+        """
+        try:
+            destination = self._destinations[key]
+        except KeyError:
+            if len(self._destinations) >= self.maxDestinations:
+                self._purge()
+            destination = _Destination(self.burst, self._time())
+            self._destinations[key] = destination
+
+        def cancel(d):
+            destination.waiting.remove(d)
+        d = defer.Deferred(cancel)
+        destination.waiting.append(d)
+        if destination.call is None:
+            self._process(key)
+        return d
+
+    def release(self, key):
+        destination = self._destinations[key]
+        destination.in_flight -= 1
+        if destination.call is None:
+            self._process(key)
+
+    @defer.inlineCallbacks
+    def run(self, keys, f, *args, **kw):
+        """
+        Calls f once an operation can be started towards all the destinations
+        identified by keys and returns a deferred firing with its result.
+        The destinations are held until the deferred returned by f fires.
+        """
+        if not self.enabled:
+            result = yield f(*args, **kw)
+            defer.returnValue(result)
+
+        acquired = []
+        try:
+            # The keys are always acquired in the same order to avoid
+            # deadlocks between operations sharing more than one of them.
+            for key in sorted(set(keys)):
+                yield self.acquire(key)
+                acquired.append(key)
+            result = yield f(*args, **kw)
+        finally:
+            for key in acquired:
+                self.release(key)
+        defer.returnValue(result)
+
+    def stats(self):
+        """
+        Returns for every destination that is currently being limited how
+        many operations are in flight and how many are waiting.
+        """
+        return dict((key, {'in_flight': destination.in_flight,
+                           'waiting': len(destination.waiting)})
+                    for key, destination in self._destinations.items())
+
+destination_limiter = DestinationLimiter()
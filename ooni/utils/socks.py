@@ -12,8 +12,10 @@ SOCKS5ClientFactory.noisy = False
 
 class TrueHeadersSOCKS5Agent(SOCKS5Agent):
     def __init__(self, *args, **kw):
+        pool = kw.pop('pool', None)
         super(TrueHeadersSOCKS5Agent, self).__init__(*args, **kw)
-        pool = HTTPConnectionPool(reactor, False)
+        if pool is None:
+            pool = HTTPConnectionPool(reactor, False)
         #
         # With Twisted > 15.0 txsocksx wraps the twisted agent using a
         # wrapper class, hence we must set the _pool attribute in the
@@ -157,8 +157,8 @@ class ScapySender(ScapyProtocol):
         """
 
     def processAnswer(self, packet, answer_hr):
-        log.debug("Got a packet from %s" % packet.src)
-        log.debug("%s" % self.__hash__)
+        log.debug("Got a packet from %s", packet.src)
+        log.debug("%s", self.__hash__)
         for i in range(len(answer_hr)):
             if packet.answers(answer_hr[i]):
                 self.answered_packets.append((answer_hr[i], packet))
@@ -247,7 +247,7 @@ class ParasiticTraceroute(ScapyProtocol):
     def sendPacket(self, packet):
         self.factory.send(packet)
         self.sent_packets.append(packet)
-        log.debug("Sent packet to %s with ttl %d" % (packet.dst, packet.ttl))
+        log.debug("Sent packet to %s with ttl %d", packet.dst, packet.ttl)
 
     def packetReceived(self, packet):
         try:
@@ -259,7 +259,8 @@ class ParasiticTraceroute(ScapyProtocol):
         if isinstance(packet.getlayer(3), TCPerror):
             self.received_packets.append(packet)
             # Live traceroute?
-            log.debug("%s replied with icmp-ttl-exceeded for %s" % (packet.src, packet[IPerror].dst))
+            log.debug("%s replied with icmp-ttl-exceeded for %s",
+                      packet.src, packet[IPerror].dst)
             return
         elif packet.dst in self.hosts:
             if random.randint(1, 100) > self.rate:
@@ -292,19 +293,19 @@ class ParasiticTraceroute(ScapyProtocol):
                     and isinstance(packet.getlayer(1), TCP):
 
                 self.hosts[packet.dst] = {'ttl': genttl()}
-                log.debug("Tracing to %s" % packet.dst)
+                log.debug("Tracing to %s", packet.dst)
                 return
             if packet.src not in self.hosts \
                     and packet.src not in self.addresses \
                     and isinstance(packet.getlayer(1), TCP):
                 self.hosts[packet.src] = {'ttl': genttl(packet),
                                           'ttl_max': maxttl(packet)}
-                log.debug("Tracing to %s" % packet.src)
+                log.debug("Tracing to %s", packet.src)
                 return
 
         if packet.src in self.hosts and not 'ttl_max' in self.hosts[packet.src]:
             self.hosts[packet.src]['ttl_max'] = ttl_max = maxttl(packet)
-            log.debug("set ttl_max to %d for host %s" % (ttl_max, packet.src))
+            log.debug("set ttl_max to %d for host %s", ttl_max, packet.src)
             ttl = []
             for t in self.hosts[packet.src]['ttl']:
                 if t < ttl_max:
@@ -405,7 +406,7 @@ class MPTraceroute(ScapyProtocol):
                     self.matched_packets[p].extend(self.received_packets[k])
                 else:
                     self.matched_packets[p] = self.received_packets[k]
-                log.debug("Packet %s matched %s" % ([p], self.received_packets[k]))
+                log.debug("Packet %s matched %s", [p], self.received_packets[k])
                 return 1
             return 0
 
@@ -443,7 +444,7 @@ class MPTraceroute(ScapyProtocol):
                 i += matchResponse(('udp', l.dport, l.sport), p)
                 i += matchResponse(('udp', l.sport, l.dport), p)
             if i == 0:
-                log.debug("No response for packet %s" % [p])
+                log.debug("No response for packet %s", [p])
 
         del self._recvbuf
 
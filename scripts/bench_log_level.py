@@ -0,0 +1,67 @@
+"""
+Times MeasurementManager.succeeded, which is called once per measurement,
+with the log level at INFO.
+
+"before" lets every debug message through to the twisted observers, which
+is what happened before OONILogger learnt to skip the levels its observers
+would drop. "after" is the normal behaviour.
+
+Usage: python scripts/bench_log_level.py [number]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+from twisted.python import log as tw_log
+
+from ooni.utils import log
+from ooni.managers import MeasurementManager
+
+
+class FakeMeasurement(object):
+    def __repr__(self):
+        return "<Measurement http_requests http://example.com/>"
+
+
+def make_result():
+    headers = [["X-Header-%d" % idx, "value %d" % idx] for idx in range(20)]
+    return {
+        'input': 'http://example.com/',
+        'requests': [{
+            'request': {'method': 'GET', 'url': 'http://example.com/',
+                        'headers': {}, 'body': None},
+            'response': {'code': 200, 'headers': headers,
+                         'body': 'A' * 1024}
+        }],
+        'failure': None
+    }
+
+
+def bench(manager, number, repeat=3):
+    result, measurement = make_result(), FakeMeasurement()
+    timer = timeit.Timer(lambda: manager.succeeded(result, measurement))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    devnull = open(os.devnull, 'w')
+    observer = log.MsecLogObserver(devnull, log_level=log.levels['INFO'])
+    tw_log.startLoggingWithObserver(observer.emit, setStdout=False)
+
+    manager = MeasurementManager()
+
+    log.oonilogger.log_level = None
+    before = bench(manager, number)
+
+    log.oonilogger.log_level = log.levels['INFO']
+    after = bench(manager, number)
+
+    print("before: %.2fus per measurement" % (before * 1e6))
+    print("after:  %.2fus per measurement" % (after * 1e6))
+
+if __name__ == "__main__":
+    main()